@@ -0,0 +1,218 @@
+"""
+Author: David Jorge
+
+This library advects particles on the U and V current fields with a fourth order Runge-Kutta scheme, as parcels'
+AdvectionRK4 kernel does, but integrates every particle at once with NumPy instead of generating and compiling a C
+kernel per run.
+
+Velocities are interpolated bilinearly in space and linearly in time, missing values count as still water, and
+metres per second are converted to degrees on a spherical mesh with the same constants as parcels, so trajectories
+match the parcels backend up to floating point error.
+"""
+
+import numpy as np
+
+# Metres in one degree of latitude, as used by parcels' spherical mesh. The fields library crops with it too
+METRES_PER_DEGREE = 1852 * 60.0
+
+
+class velocityField:
+    """
+    Class for interpolating the U and V fields of a rectilinear lat/lon grid at particle positions
+    """
+
+    def __init__(self, data, variables, dimensions, start):
+        """
+        Class constructor.
+
+        :param data: xarray Dataset with the U and V variables on (time, lat, lon) dimensions.
+        :param variables: Dictionary of the variable name of each field, {'U': ..., 'V': ...}.
+        :param dimensions: Dictionary of the dimension names, {'lat': ..., 'lon': ..., 'time': ...}.
+        :param start: datetime64 the simulation clock counts seconds from.
+        """
+        latDim, lonDim, timeDim = dimensions['lat'], dimensions['lon'], dimensions['time']
+        u = data[variables['U']].transpose(timeDim, latDim, lonDim)
+        v = data[variables['V']].transpose(timeDim, latDim, lonDim)
+        lat = data[latDim].values.astype(np.float64)
+        lon = data[lonDim].values.astype(np.float64)
+        latOrder = np.argsort(lat)
+        lonOrder = np.argsort(lon)
+        self.lat = lat[latOrder]
+        self.lon = lon[lonOrder]
+        self.latStep = self.spacing(self.lat)
+        self.lonStep = self.spacing(self.lon)
+        self.time = (data[timeDim].values - start) / np.timedelta64(1, 's')
+        # Ascending axes, with missing values as zero velocity. U and V are packed as the real and imaginary parts of
+        # one complex grid per time step, flattened, so a single 1D take gathers both at a corner.
+        u = np.nan_to_num(u.values[:, latOrder][:, :, lonOrder].astype(np.float64))
+        v = np.nan_to_num(v.values[:, latOrder][:, :, lonOrder].astype(np.float64))
+        self.uv = (u + 1j * v).reshape(len(self.time), -1)
+        self.grids = {}
+
+    @staticmethod
+    def spacing(axis):
+        """
+        :param axis: Ascending coordinate array.
+        :return: Grid step if the axis is evenly spaced, so cells are found arithmetically, otherwise None.
+        """
+        if len(axis) < 2:
+            return None
+        steps = np.diff(axis)
+        return float(steps.mean()) if np.allclose(steps, steps[0], rtol=1e-6, atol=0) else None
+
+    @staticmethod
+    def locate(axis, x, step=None):
+        """
+        :param axis: Ascending coordinate array.
+        :param x: Positions, scalar or array.
+        :param step: Grid step of an evenly spaced axis, from spacing().
+        :return: (index of the cell, weight of the next coordinate) tuple. Positions beyond the axis are clamped.
+        """
+        if len(axis) == 1:
+            return np.zeros_like(x, dtype=np.int64), np.zeros_like(x, dtype=np.float64)
+        if step:
+            position = (x - axis[0]) / step
+            i = np.clip(np.floor(position).astype(np.int64), 0, len(axis) - 2)
+            return i, np.clip(position - i, 0.0, 1.0)
+        i = np.clip(np.searchsorted(axis, x, 'right') - 1, 0, len(axis) - 2)
+        w = np.clip((x - axis[i]) / (axis[i + 1] - axis[i]), 0.0, 1.0)
+        return i, w
+
+    def grid(self, t):
+        """
+        Interpolates the velocity grid linearly in time. RK4 evaluates the field at three times per step, and the
+        grids of the latest ones are kept, so each is blended only once.
+
+        :param t: Simulation clock, in seconds from the start.
+        :return: Flattened complex U + iV grid.
+        """
+        if t not in self.grids:
+            ti, tw = self.locate(self.time, t)
+            grid = self.uv[ti] if tw == 0 else (1 - tw) * self.uv[ti] + tw * self.uv[ti + 1]
+            if len(self.grids) >= 3:
+                del self.grids[min(self.grids)]
+            self.grids[t] = grid
+        return self.grids[t]
+
+    def interpolate(self, t, lat, lon):
+        """
+        Interpolates the velocities at particle positions.
+
+        :param t: Simulation clock, in seconds from the start.
+        :param lat: Latitude array.
+        :param lon: Longitude array.
+        :return: (u, v) arrays in metres per second.
+        """
+        yi, yw = self.locate(self.lat, lat, self.latStep)
+        xi, xw = self.locate(self.lon, lon, self.lonStep)
+        nx = len(self.lon)
+        row = yi * nx
+        row2 = np.minimum(yi + 1, len(self.lat) - 1) * nx
+        xi2 = np.minimum(xi + 1, nx - 1)
+        if np.size(lat) * 8 < self.uv.shape[1]:
+            # Few particles on a large grid, blending the corners in time is cheaper than blending the whole grid
+            ti, tw = self.locate(self.time, t)
+            grids = (self.uv[ti],) if tw == 0 else (self.uv[ti], self.uv[ti + 1])
+        else:
+            grids = (self.grid(t),)
+        uv = []
+        for grid in grids:
+            south = (1 - xw) * grid.take(row + xi) + xw * grid.take(row + xi2)
+            north = (1 - xw) * grid.take(row2 + xi) + xw * grid.take(row2 + xi2)
+            uv.append((1 - yw) * south + yw * north)
+        uv = uv[0] if len(uv) == 1 else (1 - tw) * uv[0] + tw * uv[1]
+        return uv.real, uv.imag
+
+    def velocity(self, t, lat, lon):
+        """
+        :param t: Simulation clock, in seconds from the start.
+        :param lat: Latitude array.
+        :param lon: Longitude array.
+        :return: (dlat/dt, dlon/dt) arrays in degrees per second.
+        """
+        u, v = self.interpolate(t, lat, lon)
+        return v / METRES_PER_DEGREE, u / (METRES_PER_DEGREE * np.cos(np.radians(lat)))
+
+
+def randomWalk(rng, sigma, n):
+    """
+    :param rng: numpy Generator, or list of Generators drawing for equally sized consecutive groups of the particles.
+    :param sigma: Standard deviation of the steps.
+    :param n: Number of particles.
+    :return: Array of normally distributed steps.
+    """
+    if isinstance(rng, list):
+        return np.concatenate([g.normal(0, sigma, n // len(rng)) for g in rng])
+    return rng.normal(0, sigma, n)
+
+
+def integrateRK4(field, lats, lons, times, endtime, dt=300, outputdt=3600, kh=0.0, rng=None):
+    """
+    Advects particles with RK4 steps on a shared clock. Particles wait at their release position until the clock
+    reaches their release time. Positions are recorded at every multiple of outputdt and at the end time.
+
+    :param field: velocityField, or any object with the same velocity method.
+    :param lats: Release latitudes.
+    :param lons: Release longitudes.
+    :param times: Release times, in seconds from the start. Multiples of dt keep the releases on the clock.
+    :param endtime: Seconds from the start at which the simulation stops.
+    :param dt: RK4 time step in seconds.
+    :param outputdt: Seconds between two recorded positions.
+    :param kh: Horizontal diffusivity in m^2/s. When positive, a random walk step is added after every RK4 step.
+    :param rng: numpy Generator drawing the random walk, or a list of Generators, one per consecutive group of equally
+                many particles, such as the members of an ensemble. With a list every particle must be released at
+                the same time.
+    :return: (seconds array, released boolean array, lat array, lon array) tuple of the recorded positions. The
+             last three have one row per particle and one column per recorded time.
+    """
+    lat = np.asarray(lats, dtype=np.float64).copy()
+    lon = np.asarray(lons, dtype=np.float64).copy()
+    times = np.asarray(times, dtype=np.float64)
+    if not len(lat):
+        return np.empty(0), np.empty((0, 0), dtype=bool), np.empty((0, 0), np.float32), np.empty((0, 0), np.float32)
+    first = float(times.min())
+    steps = int(np.ceil((endtime - first) / dt))
+    clocks, released, trackLat, trackLon = [], [], [], []
+    for n in range(steps + 1):
+        clock = min(first + n * dt, endtime)
+        if n == 0 or n == steps or clock % outputdt == 0:
+            clocks.append(clock)
+            released.append(times <= clock)
+            trackLat.append(lat.astype(np.float32))
+            trackLon.append(lon.astype(np.float32))
+        if n == steps:
+            break
+        h = min(first + (n + 1) * dt, endtime) - clock
+        # Once every particle is released the whole arrays are stepped, without masking
+        active = slice(None) if first + n * dt >= times.max() else times <= clock
+        la, lo = lat[active], lon[active]
+        k1 = field.velocity(clock, la, lo)
+        k2 = field.velocity(clock + h / 2, la + k1[0] * h / 2, lo + k1[1] * h / 2)
+        k3 = field.velocity(clock + h / 2, la + k2[0] * h / 2, lo + k2[1] * h / 2)
+        k4 = field.velocity(clock + h, la + k3[0] * h, lo + k3[1] * h)
+        la = la + (k1[0] + 2 * k2[0] + 2 * k3[0] + k4[0]) * h / 6
+        lo = lo + (k1[1] + 2 * k2[1] + 2 * k3[1] + k4[1]) * h / 6
+        if kh > 0:
+            sigma = np.sqrt(2 * kh * h) / METRES_PER_DEGREE
+            la = la + randomWalk(rng, sigma, len(la))
+            lo = lo + randomWalk(rng, sigma, len(lo)) / np.cos(np.radians(la))
+        lat[active] = la
+        lon[active] = lo
+    return np.array(clocks), np.stack(released, axis=1), np.stack(trackLat, axis=1), np.stack(trackLon, axis=1)
+
+
+def advectRK4(field, lats, lons, times, endtime, dt=300, outputdt=3600):
+    """
+    Advects particles with integrateRK4 and splits the recorded positions into one trajectory per particle.
+
+    :param field: velocityField.
+    :param lats: Release latitudes.
+    :param lons: Release longitudes.
+    :param times: Release times, in seconds from the start. Multiples of dt keep the releases on the clock.
+    :param endtime: Seconds from the start at which the simulation stops.
+    :param dt: RK4 time step in seconds.
+    :param outputdt: Seconds between two recorded positions.
+    :return: List of (seconds array, lat array, lon array) tuples, one per particle, starting at the release.
+    """
+    clocks, released, trackLat, trackLon = integrateRK4(field, lats, lons, times, endtime, dt, outputdt)
+    return [(clocks[released[p]], trackLat[p][released[p]], trackLon[p][released[p]]) for p in range(len(released))]
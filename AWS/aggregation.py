@@ -0,0 +1,124 @@
+"""
+Author: David Jorge
+
+This library bins the detections into zoom dependent grid cells for the dashboard map, so the number of markers
+sent to the browser depends on the map view and not on the size of the detection history.
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Sensor readings averaged over the detections of a cell
+SENSOR_COLUMNS = ["temp", "humidity", "pressure", "pitch", "roll", "yaw"]
+
+
+def cellSize(zoom, cellPixels=32):
+    """
+    Gets the grid cell size that covers roughly the same number of screen pixels at any mapbox zoom level.
+
+    :param zoom: Integer mapbox zoom level. The world is 512 pixels wide at zoom 0.
+    :param cellPixels: Approximate cell width in pixels.
+    :return: Cell size in degrees.
+    """
+    return 360.0 / (2 ** zoom * 512 / cellPixels)
+
+
+def gridAggregate(map_data, cell):
+    """
+    Bins detections into square lat/lon cells.
+
+    :param map_data: Detections dataframe.
+    :param cell: Cell size in degrees.
+    :return: Dataframe with one row per non empty cell: mean detection position, number of detections, mean number
+             of clusters, mean sensor readings and the date of the latest detection.
+    """
+    map_data = map_data.dropna(subset=["lat", "lon"])
+    if not len(map_data):
+        return pd.DataFrame(columns=["lat", "lon", "Detections", "Number of Clusters"] + SENSOR_COLUMNS + ["Date"])
+    lat = map_data["lat"].to_numpy(dtype=np.float64)
+    lon = map_data["lon"].to_numpy(dtype=np.float64)
+    columns = int(np.ceil(360.0 / cell)) + 1
+    key = np.floor((lat + 90) / cell).astype(np.int64) * columns + np.floor((lon + 180) / cell).astype(np.int64)
+    keys, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+
+    def mean(values):
+        return np.bincount(inverse, weights=values, minlength=len(keys)) / counts
+
+    cells = {"lat": mean(lat), "lon": mean(lon), "Detections": counts,
+             "Number of Clusters": mean(map_data["Number of Clusters"].to_numpy(dtype=np.float64))}
+    for col in SENSOR_COLUMNS:
+        cells[col] = mean(map_data[col].to_numpy(dtype=np.float64))
+    # map_data is in time order, so the latest detection of a cell is its last row
+    last = np.zeros(len(keys), dtype=np.int64)
+    np.maximum.at(last, inverse, np.arange(len(inverse)))
+    cells["Date"] = map_data["Date"].to_numpy()[last]
+    return pd.DataFrame(cells)
+
+
+def inBounds(cells, bounds, margin=0.25):
+    """
+    Selects the cells inside a map view.
+
+    :param cells: Aggregated cells dataframe.
+    :param bounds: (west, south, east, north) of the view in degrees, or None for the whole world.
+    :param margin: Fraction of the view size added on every side, so small pans do not show empty edges.
+    :return: Dataframe of the cells in view.
+    """
+    if bounds is None:
+        return cells
+    west, south, east, north = bounds
+    padLon = ((east - west) % 360 or 360) * margin
+    padLat = (north - south) * margin
+    lat = cells["lat"]
+    lon = cells["lon"]
+    inLat = (lat >= south - padLat) & (lat <= north + padLat)
+    if east - west + 2 * padLon >= 360:
+        return cells[inLat]
+    west = (west - padLon + 180) % 360 - 180
+    east = (east + padLon + 180) % 360 - 180
+    # A view crossing the antimeridian has its west edge east of its east edge
+    inLon = (lon >= west) & (lon <= east) if west <= east else (lon >= west) | (lon <= east)
+    return cells[inLat & inLon]
+
+
+class spatialAggregator:
+    """
+    Class for serving the aggregated cells of a map view. The whole world is binned once per data version and zoom
+    level, and views only filter the cached cells.
+    """
+
+    def __init__(self, maxZoom=18, cacheSize=32):
+        """
+        Class constructor.
+
+        :param maxZoom: Zoom level past which cells stop getting smaller.
+        :param cacheSize: Number of (data version, zoom level) aggregations kept.
+        """
+        self.maxZoom = maxZoom
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def view(self, version, map_data, zoom, bounds=None):
+        """
+        Gets the aggregated cells of a map view.
+
+        :param version: Data version of map_data.
+        :param map_data: Detections dataframe.
+        :param zoom: Mapbox zoom level of the view.
+        :param bounds: (west, south, east, north) of the view in degrees, or None for the whole world.
+        :return: Dataframe of the cells in view.
+        """
+        level = int(min(max(np.floor(zoom), 0), self.maxZoom))
+        key = (version, level)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                self.cache[key] = gridAggregate(map_data, cellSize(level))
+                if len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+            cells = self.cache[key]
+        return inBounds(cells, bounds)
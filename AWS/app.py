@@ -5,13 +5,20 @@ This is the app script for launching the dashboard for the Ocean Pollution and F
 """
 
 import os
+import threading
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+import flask
+from dash import dcc, html
+import numpy as np
+import pandas as pd
 import plotly.express as px
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import forecasting
 import pullS3
+import state
+import worker
+import aggregation
+import query
 
 # Load mapbox token
 token = os.getenv("MAPBOX_TOKEN")
@@ -24,23 +31,257 @@ app = dash.Dash(__name__)
 app.config.suppress_callback_exceptions = True
 app.title = "Ocean Pollution Tracking Dashboard"
 
-# Initialize AWS API library
-aws = pullS3.pullS3()
-aws.pull()
+# WSGI entry point, for serving the dashboard from several processes, e.g. gunicorn --workers 4 app:server
+# (without --preload, so every worker starts its own background thread)
+server = app.server
 
-# Initialize the forecasting simulation library and run initial simulation
-fc = forecasting.forecasting(aws.map_data['lat'].tolist(), aws.map_data['lon'].tolist(), "particle_sim.nc")
-fc.run_forecasting(days=14)
-fc.output_sim()
+# Initialize AWS API library, the detection history is loaded from the local store and only new entries are pulled
+aws = pullS3.pullS3(incremental=True)
 
-# Initialize initial map section on the dashboard with data from the AWS API
-fig = px.scatter_mapbox(aws.map_data, lat="lat", lon="lon", hover_name="Date",
-                        hover_data=["Number of Clusters", "temp", "humidity", "pressure", "pitch", "roll",
-                                    "yaw"],
-                        color="Number of Clusters", size="_size_",
-                        color_continuous_scale=px.colors.cyclical.IceFire, size_max=15, zoom=3, height=500)
-# fig.update_layout(mapbox_style="open-street-map")
-fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
+# Initialize the forecasting simulation library. The dashboard starts on the detections and forecast saved by the
+# previous run, marked as stale, and the first background cycle pulls new entries and reruns the simulation.
+# FORECAST_BACKEND=numpy swaps parcels for the vectorized NumPy advection engine.
+fc = forecasting.forecasting(aws.map_data['lat'].tolist(), aws.map_data['lon'].tolist(), "particle_sim.nc",
+                             aws.map_data['start_key'].tolist(), backend=os.getenv("FORECAST_BACKEND", "parcels"))
+
+# Hand the pull and forecast cycle over to a background worker, the callback only reads its published results.
+# With several server processes only the one holding the lock file pulls and forecasts, the others follow the
+# versions it publishes in the manifest and read the data it writes to disk.
+# RENDER_MOVIE=1 also renders the drift movie to assets/sim.mp4 after every forecast.
+ingestion = worker.ingestionWorker(aws, fc, interval=int(os.getenv("PULL_INTERVAL", 120)), days=14,
+                                   leader=state.leaderLock(), manifest=state.manifestFile(),
+                                   movie=os.getenv("RENDER_MOVIE") == "1")
+ingestion.start()
+
+
+def hourlyFigure(hourly):
+    """
+    Builds the hourly detections bar graph.
+
+    :param hourly: Hourly detections dataframe.
+    :return: Figure dictionary.
+    """
+    return {
+        "data": [
+            {"x": hourly["Date"], "y": hourly["Count"], "type": "bar", },
+        ],
+        "layout": {
+            "xaxis": {"fixedrange": True},
+            "yaxis": {
+                "fixedrange": True,
+            },
+            "colorway": ["#E12D39"],
+        },
+    }
+
+
+def statusText(latest):
+    """
+    :param latest: Results published by the ingestion worker.
+    :return: Data status line shown under the dashboard description.
+    """
+    if latest.stale:
+        return "Showing data saved by the previous run, refreshing from AWS..."
+    return ""
+
+
+def hourlyPatch(latest, revision):
+    """
+    Builds a partial update of the hourly bar graph, holding only the buckets that changed since the histogram
+    revision the client shows. Buckets are applied in date order at their final index, so new buckets can be
+    inserted between existing ones.
+
+    :param latest: Results published by the ingestion worker.
+    :param revision: (histogram id, revision) pair the client shows.
+    :return: dash.Patch, or None if the client needs the whole figure.
+    """
+    histogram = aws.histogram
+    # Revisions of another process or of a reloaded histogram do not compare
+    if not revision or revision[0] != histogram.id or latest.hourlyRevision[0] != histogram.id:
+        return None
+    changed = histogram.changedSince(revision[1], latest.hourlyRevision[1], 60 * 60)
+    if changed is None or len(changed) > len(latest.hourly) // 2:
+        return None
+    seconds = latest.hourly["Date"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+    counts = latest.hourly["Count"].to_numpy()
+    patch = dash.Patch()
+    for key, created in changed:
+        i = int(np.searchsorted(seconds, key * 60 * 60))
+        if created:
+            patch["data"][0]["x"].insert(i, pd.Timestamp(key * 60 * 60, unit="s", tz="UTC").isoformat())
+            patch["data"][0]["y"].insert(i, int(counts[i]))
+        else:
+            patch["data"][0]["y"][i] = int(counts[i])
+    return patch
+
+
+def mapFigure(cells):
+    """
+    Builds the dashboard map from detections aggregated into grid cells.
+
+    :param cells: Aggregated cells dataframe.
+    :return: Plotly figure.
+    """
+    mapFig = px.scatter_mapbox(cells, lat="lat", lon="lon", hover_name="Date",
+                               hover_data=["Detections", "Number of Clusters", "temp", "humidity", "pressure",
+                                           "pitch", "roll", "yaw"],
+                               color="Number of Clusters", size="Detections",
+                               color_continuous_scale=px.colors.cyclical.IceFire, size_max=15, zoom=3, height=500)
+    # fig.update_layout(mapbox_style="open-street-map")
+    # Forecast particles, moved frame by frame in the browser by the clientside callbacks of assets/forecast.js
+    mapFig.add_scattermapbox(lat=[], lon=[], mode="markers", name="Forecast", marker={"color": "#AB2200", "size": 6},
+                             hoverinfo="skip", showlegend=False)
+    # A constant uirevision keeps the user's zoom and pan when the figure is replaced
+    mapFig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, uirevision="map")
+    return mapFig
+
+
+# Map view before the user zooms or pans: zoom level and (west, south, east, north) bounds
+DEFAULT_VIEW = {"zoom": 3, "bounds": None}
+
+
+def mapView(relayoutData, view):
+    """
+    Updates a client's map view from the map's relayout event.
+
+    :param relayoutData: relayoutData property of the map graph, it only holds the properties that changed.
+    :param view: Previous map view of the client.
+    :return: Map view dictionary.
+    """
+    view = dict(view or DEFAULT_VIEW)
+    if relayoutData:
+        if "mapbox.zoom" in relayoutData:
+            view["zoom"] = relayoutData["mapbox.zoom"]
+        corners = relayoutData.get("mapbox._derived", {}).get("coordinates")
+        if corners:
+            # Corners run clockwise from the north west corner
+            lats = [corner[1] for corner in corners]
+            view["bounds"] = [corners[0][0], min(lats), corners[1][0], max(lats)]
+    return view
+
+
+# Detections are binned once per data version and zoom level, whatever the number of clients
+aggregator = aggregation.spatialAggregator()
+
+# Figures are built once per published data version and shared by every client
+figureCache = {"version": None}
+figureLock = threading.Lock()
+
+
+def getFigures(latest):
+    """
+    Gets the figures of a published data version, building them on the first request for that version.
+
+    :param latest: Results published by the ingestion worker.
+    :return: Hourly bar graph, map figure of the default view.
+    """
+    with figureLock:
+        if figureCache["version"] != latest.version:
+            cells = aggregator.view(latest.version, latest.map_data, DEFAULT_VIEW["zoom"])
+            figureCache.update(version=latest.version, hourly=hourlyFigure(latest.hourly), map=mapFigure(cells))
+        return figureCache["hourly"], figureCache["map"]
+
+
+def viewFigure(latest, view):
+    """
+    Gets the map figure of a client's map view.
+
+    :param latest: Results published by the ingestion worker.
+    :param view: Map view dictionary.
+    :return: Plotly figure.
+    """
+    if view == DEFAULT_VIEW:
+        return getFigures(latest)[1]
+    return mapFigure(aggregator.view(latest.version, latest.map_data, view["zoom"], view["bounds"]))
+
+
+# Detections are indexed once per data version for the query endpoint
+queryIndex = query.indexCache()
+
+
+@server.route("/api/detections")
+def detectionsQuery():
+    """
+    JSON query endpoint over the detections of the latest data version, for tools that poll the detections.
+
+    Query string parameters, all optional: start and end (ISO 8601, UTC unless an offset is given, end excluded),
+    bbox (west,south,east,north in degrees), min_clusters and limit. The response carries the data version as its
+    ETag, so a poll with If-None-Match gets an empty 304 until new detections are published.
+
+    :return: Flask response.
+    """
+    latest = ingestion.latest()
+    etag = str(latest.version)
+    if flask.request.if_none_match.contains(etag):
+        return flask.Response(status=304, headers={"ETag": '"{}"'.format(etag)})
+    try:
+        kwargs = query.parseArgs(flask.request.args)
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
+    matches = queryIndex.get(latest.version, latest.map_data).query(**kwargs)
+    response = flask.jsonify(version=latest.version, count=len(matches), detections=query.toRecords(matches))
+    response.set_etag(etag)
+    return response
+
+
+@server.route("/snapshots/<name>.jpg")
+@server.route("/snapshots/thumbs/<name>.jpg", defaults={"thumb": True})
+def snapshot(name, thumb=False):
+    """
+    Serves a snapshot or its thumbnail, from memory for the latest ones. Snapshot names are never reused for other
+    images, so browsers may cache them for good, and the ETag lets them revalidate without a download.
+
+    :param name: Snapshot name.
+    :param thumb: Flags whether to serve the thumbnail.
+    :return: Flask response.
+    """
+    entry = aws.snapshots.get(name, thumb)
+    if entry is None:
+        flask.abort(404)
+    response = flask.Response(entry[0], mimetype="image/jpeg")
+    response.set_etag(entry[1])
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(flask.request)
+
+
+# Forecast export written by the ingestion worker after every simulation
+FORECAST_FILE = "forecast.json.gz"
+
+
+@server.route("/api/forecast")
+def forecastFrames():
+    """
+    Serves the forecast trajectories exported by forecasting.export_sim, for the browser to animate on the map. The
+    file is gzipped on disk and sent as is, with an ETag that changes when a new forecast is exported.
+
+    :return: Flask response.
+    """
+    try:
+        st = os.stat(FORECAST_FILE)
+    except FileNotFoundError:
+        flask.abort(404)
+    etag = "{}-{}".format(st.st_mtime_ns, st.st_size)
+    if flask.request.if_none_match.contains(etag):
+        return flask.Response(status=304, headers={"ETag": '"{}"'.format(etag)})
+    with open(FORECAST_FILE, "rb") as f:
+        response = flask.Response(f.read(), mimetype="application/json")
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Cache-Control"] = "no-cache"
+    response.set_etag(etag)
+    return response
+
+
+def snapshotUrl(name):
+    """
+    :param name: Snapshot name.
+    :return: URL of the snapshot route.
+    """
+    return app.get_relative_path("/snapshots/{}.jpg".format(name))
+
+
+# Initialize initial map and bar graph sections on the dashboard with data from the AWS API
+initial = ingestion.latest()
+figHourly, fig = getFigures(initial)
 
 # Define the dashboard HTML layout
 app.layout = html.Div(
@@ -58,6 +299,11 @@ app.layout = html.Div(
                                                " stored in AWS.",
                                       className="header-description",
                                   ),
+                                  html.P(
+                                      id="data-status",
+                                      children=statusText(initial),
+                                      className="header-description",
+                                  ),
                               ]
                               ),
                      html.Div(className='eight columns div-for-charts bg-grey',
@@ -95,20 +341,30 @@ app.layout = html.Div(
                                                   "font-weight": "bold",
                                               },
                                           ),
-                                          html.Video(
-                                              id="live-update-forecasting",
-                                              src=app.get_asset_url("sim.mp4"),
-                                              autoPlay=True,
-                                              controls=True,
-                                              loop=True,
+                                          # The forecast is animated on the pollution map, in the browser
+                                          html.Button(
+                                              "Pause",
+                                              id="forecast-play",
+                                          ),
+                                          html.Span(
+                                              id="forecast-time",
                                               style={
-                                                  # "display": "block",
-                                                  # "margin-left": "auto",
-                                                  # "margin-right": "auto",
-                                                  "max-width": "100%",
-                                                  # "width": "70%",
+                                                  "margin-left": "20px",
                                               },
-                                          )
+                                          ),
+                                          dcc.Interval(
+                                              id='forecast-clock',
+                                              interval=150,  # in milliseconds
+                                              n_intervals=0,
+                                          ),
+                                          # Forecast version the browser has downloaded, and where from
+                                          dcc.Store(
+                                              id='forecast-loaded',
+                                          ),
+                                          dcc.Store(
+                                              id='forecast-url',
+                                              data=app.get_relative_path("/api/forecast"),
+                                          ),
                                       ],
                                       style={
                                           "width": "98%",
@@ -131,19 +387,7 @@ app.layout = html.Div(
                                           ),
                                           dcc.Graph(
                                               id="bar-graph",
-                                              figure={
-                                                  "data": [
-                                                      {"x": aws.hourly["Date"], "y": aws.hourly["Count"],
-                                                       "type": "bar", },
-                                                  ],
-                                                  "layout": {
-                                                      "xaxis": {"fixedrange": True},
-                                                      "yaxis": {
-                                                          "fixedrange": True,
-                                                      },
-                                                      "colorway": ["#E12D39"],
-                                                  },
-                                              }
+                                              figure=figHourly,
                                           ),
                                       ],
                                       style={
@@ -165,7 +409,7 @@ app.layout = html.Div(
                                           ),
                                           html.Img(
                                               id="live-update-img",
-                                              src=app.get_asset_url("{}.png".format(aws.mostRecent)),
+                                              src=snapshotUrl(initial.mostRecent),
                                               style={
                                                   "display": "block",
                                                   "margin-left": "auto",
@@ -187,6 +431,17 @@ app.layout = html.Div(
                                       interval=60 * 2000,  # in milliseconds
                                       n_intervals=0
                                   ),
+                                  # Data and forecast versions the client is showing
+                                  dcc.Store(
+                                      id='data-version',
+                                      data={"data": initial.version, "forecast": initial.forecastVersion,
+                                            "hourly": list(initial.hourlyRevision)},
+                                  ),
+                                  # Map view the client is showing
+                                  dcc.Store(
+                                      id='map-view',
+                                      data=DEFAULT_VIEW,
+                                  ),
                               ])
                  ])
     ]
@@ -195,47 +450,57 @@ app.layout = html.Div(
 
 
 # Define callback function to implement live update of data on the dashboard.
+# Outputs whose data version the client already shows are left untouched with dash.no_update, and the hourly bar
+# graph is patched with the buckets that changed.
+# Zooming or panning the map only re-aggregates the map for the new view.
 @app.callback(Output(component_id='live-update-img', component_property='src'),
-              Output(component_id='live-update-forecasting', component_property='src'),
               Output(component_id="bar-graph", component_property="figure"),
               Output(component_id="map-graph", component_property="figure"),
-              Input(component_id='interval', component_property='n_intervals'))
-def update(n_intervals):
-    # Get up to date data
-    aws.pull()
-
-    # Run simulation with new data
-    fc.update_particles(aws.map_data['lat'].tolist(), aws.map_data['lon'].tolist())
-    fc.run_forecasting(days=14)
-    fc.output_sim()
-
-    # Update hourly detections bar graph
-    updatedFigHourly = {
-        "data": [
-            {"x": aws.hourly["Date"], "y": aws.hourly["Count"], "type": "bar", },
-        ],
-        "layout": {
-            "xaxis": {"fixedrange": True},
-            "yaxis": {
-                "fixedrange": True,
-            },
-            "colorway": ["#E12D39"],
-        },
-    }
+              Output(component_id="data-version", component_property="data"),
+              Output(component_id="map-view", component_property="data"),
+              Output(component_id="data-status", component_property="children"),
+              Input(component_id='interval', component_property='n_intervals'),
+              Input(component_id='map-graph', component_property='relayoutData'),
+              State(component_id="data-version", component_property="data"),
+              State(component_id="map-view", component_property="data"))
+def update(n_intervals, relayoutData, shown, view):
+    # Get the latest data published by the background worker
+    latest = ingestion.latest()
+    shown = shown or {}
+    versions = {"data": latest.version, "forecast": latest.forecastVersion, "hourly": list(latest.hourlyRevision)}
+    newView = mapView(relayoutData, view)
+
+    img, updatedFigHourly, updatedMapFig, status = dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    if shown.get("data") != latest.version:
+        img = snapshotUrl(latest.mostRecent)
+        status = statusText(latest)
+        # Only the hourly buckets that changed are sent, unless the client is too far behind
+        updatedFigHourly = hourlyPatch(latest, shown.get("hourly")) or getFigures(latest)[0]
+    if shown.get("data") != latest.version or newView != view:
+        updatedMapFig = viewFigure(latest, newView)
+
+    return (img, updatedFigHourly, updatedMapFig, versions if shown != versions else dash.no_update,
+            newView if newView != view else dash.no_update, status)
 
-    # Update dashboard map
-    updatedMapFig = px.scatter_mapbox(aws.map_data, lat="lat", lon="lon", hover_name="Date",
-                                      hover_data=["Number of Clusters", "temp", "humidity", "pressure", "pitch", "roll",
-                                                  "yaw"],
-                                      color="Number of Clusters", size="_size_",
-                                      color_continuous_scale=px.colors.cyclical.IceFire, size_max=15, zoom=3,
-                                      height=500)
-    # fig.update_layout(mapbox_style="open-street-map")
-    updatedMapFig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
 
-    return app.get_asset_url("{}.png".format(aws.mostRecent)), app.get_asset_url(
-        "sim.mp4"), updatedFigHourly, updatedMapFig
+# The browser downloads the forecast when the data-version store shows a new forecast version, and animates it on
+# the map without a round trip to the server per frame
+app.clientside_callback(ClientsideFunction(namespace="forecast", function_name="load"),
+                        Output(component_id="forecast-loaded", component_property="data"),
+                        Input(component_id="data-version", component_property="data"),
+                        State(component_id="forecast-url", component_property="data"),
+                        State(component_id="forecast-loaded", component_property="data"))
+app.clientside_callback(ClientsideFunction(namespace="forecast", function_name="tick"),
+                        Output(component_id="forecast-time", component_property="children"),
+                        Input(component_id="forecast-clock", component_property="n_intervals"),
+                        Input(component_id="forecast-loaded", component_property="data"))
+app.clientside_callback(ClientsideFunction(namespace="forecast", function_name="toggle"),
+                        Output(component_id="forecast-clock", component_property="disabled"),
+                        Output(component_id="forecast-play", component_property="children"),
+                        Input(component_id="forecast-play", component_property="n_clicks"),
+                        State(component_id="forecast-clock", component_property="disabled"),
+                        prevent_initial_call=True)
 
 
 if __name__ == "__main__":
-    app.run_server(debug=False)
+    app.run(debug=False)
@@ -0,0 +1,65 @@
+/*
+Clientside callbacks animating the drift forecast on the dashboard map.
+
+The forecast is downloaded once per forecast version from /api/forecast and kept in the browser, each clock tick
+only moves the particles of the map's "Forecast" trace to the positions of the next frame.
+*/
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    forecast: {
+        // Forecast frames of the version last downloaded
+        frames: null,
+        frame: 0,
+
+        // Downloads the forecast when the server publishes a new version
+        load: async function (shown, url, loaded) {
+            const version = shown ? shown.forecast : null;
+            if (version === null || version === undefined || version === loaded) {
+                return window.dash_clientside.no_update;
+            }
+            const response = await fetch(url + "?v=" + version);
+            if (!response.ok) {
+                return window.dash_clientside.no_update;
+            }
+            const payload = await response.json();
+            const forecast = window.dash_clientside.forecast;
+            forecast.frames = {
+                start: payload.start ? Date.parse(payload.start) : 0,
+                step: payload.step * 1000,
+                offsets: payload.offsets,
+                lat: Float64Array.from(payload.lat, (v) => v / payload.scale),
+                lon: Float64Array.from(payload.lon, (v) => v / payload.scale),
+            };
+            forecast.frame = 0;
+            return version;
+        },
+
+        // Shows the next frame on the map
+        tick: function (n_intervals, loaded) {
+            const forecast = window.dash_clientside.forecast;
+            const frames = forecast.frames;
+            const graph = document.querySelector("#map-graph .js-plotly-plot");
+            if (!frames || !graph || !graph.data || frames.offsets.length < 2) {
+                return window.dash_clientside.no_update;
+            }
+            const trace = graph.data.findIndex((t) => t.name === "Forecast");
+            if (trace < 0) {
+                return window.dash_clientside.no_update;
+            }
+            const t = forecast.frame % (frames.offsets.length - 1);
+            forecast.frame = t + 1;
+            const first = frames.offsets[t], last = frames.offsets[t + 1];
+            window.Plotly.restyle(graph, {
+                lat: [Array.from(frames.lat.subarray(first, last))],
+                lon: [Array.from(frames.lon.subarray(first, last))],
+            }, [trace]);
+            const time = new Date(frames.start + t * frames.step);
+            return time.toISOString().slice(0, 16).replace("T", " ") + " UTC";
+        },
+
+        // Pauses and resumes the animation
+        toggle: function (n_clicks, paused) {
+            return [!paused, paused ? "Pause" : "Play"];
+        },
+    },
+});
@@ -0,0 +1,134 @@
+"""
+Author: David Jorge
+
+This script compares the NumPy advection engine with the parcels AdvectionRK4 path, on the OSCAR current files
+used by the dashboard or, with --synthetic, on generated fields with the same layout (5 day time steps, a singleton
+depth dimension, 1/3 degree grid with descending latitudes).
+
+Usage: python benchmark_advection.py [--particles 1000] [--days 14] [--synthetic]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import fields
+import advection
+
+# Region the dashboard's forecast movie shows, particles are released in it
+REGION = (-44, 35, 10, 70)
+
+
+def synthetic(directory, days):
+    """
+    Writes OSCAR shaped U and V files with smooth, slowly varying gyres.
+
+    :param directory: Directory the files are written to.
+    :param days: Number of days the files must cover.
+    :return: Dictionary of the file path of each field.
+    """
+    import xarray as xr
+
+    lat = np.arange(80, -80 - 1e-9, -1 / 3)
+    lon = np.arange(-180, 180, 1 / 3)
+    times = pd.date_range("2021-01-01", periods=int(np.ceil(days / 5)) + 2, freq="5D")
+    y, x = np.meshgrid(np.radians(lat), np.radians(lon), indexing="ij")
+    paths = {}
+    for name, var in (("U", "u"), ("V", "v")):
+        data = np.empty((len(times), 1, len(lat), len(lon)), dtype=np.float32)
+        for t in range(len(times)):
+            phase = t * 0.3
+            if name == "U":
+                data[t, 0] = 0.4 * np.sin(6 * y + phase) * np.cos(3 * x)
+            else:
+                data[t, 0] = 0.3 * np.cos(6 * y) * np.sin(3 * x + phase)
+        paths[name] = os.path.join(directory, "ocean_currents_{}.nc".format(name))
+        xr.Dataset({var: (("time", "depth", "latitude", "longitude"), data)},
+                   coords={"time": times, "depth": [15.0], "latitude": lat, "longitude": lon}).to_netcdf(paths[name])
+    return paths
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    :return: Great circle distance array in km.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def runNumpy(loader, lats, lons, days):
+    """
+    :return: (seconds taken, final latitudes, final longitudes).
+    """
+    started = time.perf_counter()
+    loader.open()
+    start = loader.data[loader.dimensions['time']].values[0]
+    field = advection.velocityField(loader.subset(lats, lons, days), loader.variables, loader.dimensions, start)
+    tracks = advection.advectRK4(field, lats, lons, np.zeros(len(lats)), days * 24 * 60 * 60)
+    taken = time.perf_counter() - started
+    return taken, np.array([t[1][-1] for t in tracks]), np.array([t[2][-1] for t in tracks])
+
+
+def runParcels(loader, lats, lons, days):
+    """
+    :return: (seconds taken, final latitudes, final longitudes), in particle order.
+    """
+    from datetime import timedelta
+    from parcels import ParticleSet, JITParticle, AdvectionRK4
+
+    started = time.perf_counter()
+    pset = ParticleSet(fieldset=loader.fieldset(lats, lons, days), pclass=JITParticle, lon=lons, lat=lats)
+    pset.execute(AdvectionRK4, runtime=timedelta(days=days), dt=timedelta(minutes=5))
+    taken = time.perf_counter() - started
+    return taken, np.array([p.lat for p in pset]), np.array([p.lon for p in pset])
+
+
+def compare(filenames, particles, days):
+    """
+    Runs both engines on the same particles and prints their timings and the difference of their end positions.
+
+    :param filenames: Dictionary of the file path of each field.
+    :param particles: Number of particles.
+    :param days: Number of days simulated.
+    """
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(REGION[1], REGION[3], particles)
+    lons = rng.uniform(REGION[0], REGION[2], particles)
+
+    def loader():
+        return fields.fieldLoader(filenames, {'U': 'u', 'V': 'v'},
+                                  {'lat': 'latitude', 'lon': 'longitude', 'time': 'time'})
+
+    taken, npLat, npLon = runNumpy(loader(), lats, lons, days)
+    print("numpy:   {:8.2f} s for {} particles over {} days".format(taken, particles, days))
+    try:
+        taken, pLat, pLon = runParcels(loader(), lats.tolist(), lons.tolist(), days)
+    except ImportError:
+        print("parcels: not installed, skipped")
+        return
+    print("parcels: {:8.2f} s".format(taken))
+    error = distance(npLat, npLon, pLat, pLon)
+    print("final position difference: mean {:.4f} km, max {:.4f} km".format(error.mean(), error.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--particles", type=int, default=1000)
+    parser.add_argument("--days", type=float, default=14)
+    parser.add_argument("--synthetic", action="store_true", help="Generate OSCAR shaped fields instead.")
+    args = parser.parse_args()
+
+    # The synthetic fields are removed with the directory once both engines have run
+    with tempfile.TemporaryDirectory() as directory:
+        if args.synthetic:
+            filenames = synthetic(directory, args.days)
+        else:
+            filenames = {'U': 'ocean_currents_U.nc', 'V': 'ocean_currents_V.nc'}
+        compare(filenames, args.particles, args.days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Author: David Jorge
+
+This library keeps a local, content-addressed copy of the raw S3 bucket entries, so that restarts and
+reprocessing runs do not need to download them again.
+"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+
+# Stand-in for a boto3 object summary, used when listing the bucket from the cache
+cachedObject = namedtuple("cachedObject", ["key", "e_tag", "last_modified"])
+
+
+class chunkCache:
+    """
+    Class for caching raw object bodies on disk, keyed by S3 key and ETag.
+
+    Bodies are stored once per sha256 digest (so identical entries such as "{Image End}" share a file), an
+    sqlite index maps (key, ETag) to the digest, and the least recently used entries are evicted once the
+    stored bytes exceed the size cap. Every read is checked against its digest.
+    """
+
+    def __init__(self, path=".chunk_cache", max_bytes=512 * 1024 ** 2):
+        """
+        Class constructor.
+
+        :param path: Cache directory.
+        :param max_bytes: Size cap in bytes of the stored bodies.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                        "digest TEXT, size INTEGER, atime REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self.db.commit()
+        self.tick = self.db.execute("SELECT COALESCE(MAX(atime), 0) FROM entries").fetchone()[0]
+        self.bytes = self.size()
+
+    def blobPath(self, digest):
+        """
+        :param digest: sha256 hex digest of a body.
+        :return: File path of the body.
+        """
+        return os.path.join(self.path, digest[:2], digest)
+
+    def size(self):
+        """
+        :return: Number of bytes currently stored, counted from the index.
+        """
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)"
+                               ).fetchone()[0]
+
+    def get(self, key, etag):
+        """
+        Looks up a cached body.
+
+        :param key: S3 object key.
+        :param etag: S3 object ETag.
+        :return: Body as bytes, or None on a miss or a failed integrity check.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT digest FROM entries WHERE key = ? AND etag = ?", (key, etag)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.blobPath(row[0]), "rb") as f:
+                    body = f.read()
+            except OSError:
+                body = None
+            if body is None or hashlib.sha256(body).hexdigest() != row[0]:
+                self._delete([key])
+                self.db.commit()
+                return None
+            self.tick += 1
+            self.db.execute("UPDATE entries SET atime = ? WHERE key = ?", (self.tick, key))
+            self.db.commit()
+            return body
+
+    def put(self, key, etag, lastModified, body):
+        """
+        Stores a body and evicts the least recently used entries if the cache is over its size cap.
+
+        :param key: S3 object key.
+        :param etag: S3 object ETag.
+        :param lastModified: LastModified datetime of the object.
+        :param body: Body as bytes.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.blobPath(digest)
+        with self.lock:
+            self._delete([key])
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = "{}.{}.tmp".format(path, threading.get_ident())
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+                self.bytes += len(body)
+            self.tick += 1
+            self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, etag, lastModified.isoformat(), digest, len(body), self.tick))
+            self._evict()
+            self.db.commit()
+
+    def listObjects(self, after=None):
+        """
+        Lists the cached entries as if listing the bucket, so a warm cache can be reprocessed without any network
+        calls. Entries that have been evicted are missing from the listing.
+
+        :param after: Only list keys after this one.
+        :return: List of cachedObject tuples in key order.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT key, etag, last_modified FROM entries WHERE key > ? ORDER BY key",
+                                   (after or "",)).fetchall()
+        return [cachedObject(key, etag, datetime.datetime.fromisoformat(lastModified))
+                for key, etag, lastModified in rows]
+
+    def _delete(self, keys):
+        """
+        Removes index entries, and their bodies when no other entry shares them. The caller holds the lock.
+
+        :param keys: List of S3 object keys.
+        :return: Number of bytes freed on disk.
+        """
+        freed = 0
+        for key in keys:
+            row = self.db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                continue
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if not self.db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (row[0],)).fetchone():
+                freed += row[1]
+                try:
+                    os.remove(self.blobPath(row[0]))
+                except OSError:
+                    pass
+        self.bytes -= freed
+        return freed
+
+    def _evict(self):
+        """
+        Evicts least recently used entries until the cache is within its size cap. The caller holds the lock.
+        """
+        if self.bytes <= self.max_bytes:
+            return
+        for (key,) in self.db.execute("SELECT key FROM entries ORDER BY atime").fetchall():
+            self._delete([key])
+            if self.bytes <= self.max_bytes:
+                break
@@ -0,0 +1,189 @@
+"""
+Author: David Jorge
+
+This library holds the in-memory data structures the parsed detections are accumulated in, before they are
+handed to the dashboard as pandas dataframes.
+"""
+
+import bisect
+import uuid
+import numpy as np
+import pandas as pd
+
+# Column schema of the map_data dataframe shown on the dashboard
+MAP_COLUMNS = ['Number of Clusters', 'Date', "lat", "lon", "temp", "humidity", "pressure", "pitch", "roll", "yaw",
+               "_size_"]
+MAP_DTYPES = [np.float64, object, np.float64, np.float64, np.float64, np.float64, np.float64, np.float64,
+              np.float64, np.float64, np.float64]
+
+# Column schema of the detection store, map_data plus the entry time and identity
+STORE_COLUMNS = MAP_COLUMNS + ["timestamp", "device", "start_key"]
+
+# Columns kept in memory by pullS3, the map schema plus the entry time the query index sorts on and the key of the
+# entry's {Image Start}, which identifies the detection's forecast particle
+FRAME_COLUMNS = MAP_COLUMNS + ["timestamp", "start_key"]
+STORE_DTYPES = MAP_DTYPES + [np.float64, object, object]
+
+
+def extendFrame(frame, new):
+    """
+    Appends the rows of one dataframe to another in a single copy.
+
+    :param frame: Existing dataframe.
+    :param new: Dataframe with the rows to append, same columns.
+    :return: Extended dataframe with a fresh range index.
+    """
+    if len(new) == 0:
+        return frame
+    if len(frame) == 0:
+        return new.reset_index(drop=True)
+    return pd.concat([frame, new], ignore_index=True)
+
+
+class columnBuffer:
+    """
+    Class for accumulating rows column by column in preallocated numpy arrays, which grow by doubling.
+    """
+
+    def __init__(self, columns=MAP_COLUMNS, dtypes=MAP_DTYPES, capacity=1024):
+        """
+        Class constructor.
+
+        :param columns: List of column names.
+        :param dtypes: List of numpy dtypes, one per column.
+        :param capacity: Number of rows preallocated.
+        """
+        self.columns = columns
+        self.arrays = [np.empty(capacity, dtype=dtype) for dtype in dtypes]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, row):
+        """
+        Appends a row to the buffer.
+
+        :param row: Dictionary of column name to value.
+        """
+        if self.length == len(self.arrays[0]):
+            self.arrays = [np.concatenate([arr, np.empty(len(arr), dtype=arr.dtype)]) for arr in self.arrays]
+        for col, arr in zip(self.columns, self.arrays):
+            arr[self.length] = row[col]
+        self.length += 1
+
+    def toFrame(self):
+        """
+        :return: Dataframe of the rows in the buffer.
+        """
+        return pd.DataFrame({col: arr[:self.length] for col, arr in zip(self.columns, self.arrays)},
+                            columns=self.columns)
+
+    def clear(self):
+        """
+        Empties the buffer, keeping the allocated capacity.
+        """
+        self.length = 0
+
+
+class timeHistogram:
+    """
+    Class for counting detections in time buckets, with O(1) increments.
+
+    A dictionary keyed by bucket number (epoch seconds divided by the bucket width) is kept for each configured
+    bucket width, so hourly, 15 minute and daily series are all available from the same timestamps.
+
+    Every add bumps a revision number, and the buckets each revision touched are logged, so a client showing the
+    histogram as of an older revision can be sent only the buckets that changed since. Revisions are only
+    comparable within one histogram, which is told apart by its random id.
+    """
+
+    def __init__(self, widths=(15 * 60, 60 * 60, 24 * 60 * 60), logSize=1024):
+        """
+        Class constructor.
+
+        :param widths: Bucket widths in seconds.
+        :param logSize: Number of revisions the change log keeps.
+        """
+        self.buckets = {width: {} for width in widths}
+        self.created = {width: {} for width in widths}
+        self.id = uuid.uuid4().hex
+        self.revision = 0
+        self.log = []
+        self.logSize = logSize
+
+    def _count(self, keysByWidth):
+        """
+        Adds counts to the buckets as one new revision.
+
+        :param keysByWidth: Dictionary of bucket width to (keys, counts) lists.
+        """
+        revision = self.revision + 1
+        for width, (keys, values) in keysByWidth.items():
+            counts = self.buckets[width]
+            for key, value in zip(keys, values):
+                if key not in counts:
+                    self.created[width][key] = revision
+                counts[key] = counts.get(key, 0) + value
+        self.log.append((revision, {width: keys for width, (keys, values) in keysByWidth.items()}))
+        if len(self.log) > self.logSize:
+            del self.log[0]
+        self.revision = revision
+
+    def add(self, dt):
+        """
+        Counts a detection in the bucket nearest to its timestamp, for every bucket width.
+
+        :param dt: Timezone aware datetime of the detection.
+        """
+        ts = dt.timestamp()
+        self._count({width: ([int((ts + width / 2) // width)], [1]) for width in self.buckets})
+
+    def addMany(self, timestamps):
+        """
+        Counts many detections at once.
+
+        :param timestamps: Pandas series of timezone aware datetimes.
+        """
+        ts = timestamps.to_numpy(dtype="datetime64[us]").astype(np.int64) / 1e6
+        keysByWidth = {}
+        for width in self.buckets:
+            keys, values = np.unique(((ts + width / 2) // width).astype(np.int64), return_counts=True)
+            keysByWidth[width] = (keys.tolist(), values.tolist())
+        self._count(keysByWidth)
+
+    def changedSince(self, revision, upto, width=60 * 60):
+        """
+        Gets the buckets that changed between two revisions.
+
+        :param revision: Revision the client shows.
+        :param upto: Revision the client is brought up to.
+        :param width: Bucket width in seconds, one of the configured widths.
+        :return: Sorted list of (bucket number, whether the bucket was created after revision) tuples, or None if
+                 the change log no longer reaches back to revision.
+        """
+        if revision is None or (revision < upto and (not self.log or self.log[0][0] > revision + 1)):
+            return None
+        log = self.log[:]
+        start = bisect.bisect_right([entry[0] for entry in log], revision)
+        keys = set()
+        for entryRevision, keysByWidth in log[start:]:
+            if entryRevision > upto:
+                break
+            keys.update(keysByWidth[width])
+        created = self.created[width]
+        return [(key, created[key] > revision) for key in sorted(keys)]
+
+    def toFrame(self, width=60 * 60):
+        """
+        Exports the buckets of one width as a dataframe for the bar chart.
+
+        :param width: Bucket width in seconds, one of the configured widths.
+        :return: Dataframe with the "Date" (bucket time, UTC) and "Count" columns, sorted by date.
+        """
+        counts = self.buckets[width]
+        keys = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        order = np.argsort(keys)
+        return pd.DataFrame({"Date": pd.to_datetime(keys[order] * width, unit='s', utc=True),
+                             "Count": values[order]})
@@ -0,0 +1,251 @@
+"""
+Author: David Jorge
+
+This library runs ensemble drift forecasts. Every member releases the detections at randomly jittered positions,
+for the GPS error, and advects them with the NumPy engine on randomly scaled and biased currents plus a random walk,
+for the error of the OSCAR currents.
+
+Members run in batches across a process pool, each batch is reduced in its worker, and the batch results are merged
+in order into a running reduction: per time step density grids of the particle positions, and per detection mean and
+spread. Memory therefore depends on the grid and the number of detections, not on the number of
+members.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import advection
+
+# Velocity field of the worker process, built once per worker from the fields sent to its initializer
+workerField = None
+
+
+class perturbedField:
+    """
+    Class for a velocity field scaled and biased by the current error of the ensemble members. Members are advected
+    together, so the errors are given per particle, and every particle must be stepped at once, i.e. released at the
+    same time.
+    """
+
+    def __init__(self, field, scale, bias):
+        """
+        Class constructor.
+
+        :param field: velocityField.
+        :param scale: Array of the factor each particle's current speed is multiplied by.
+        :param bias: (u, v) tuple of the velocity arrays in metres per second added to each particle's currents.
+        """
+        self.field = field
+        self.scale = scale
+        self.bias = bias
+
+    def velocity(self, t, lat, lon):
+        """
+        :param t: Simulation clock, in seconds from the start.
+        :param lat: Latitude array.
+        :param lon: Longitude array.
+        :return: (dlat/dt, dlon/dt) arrays in degrees per second.
+        """
+        dlat, dlon = self.field.velocity(t, lat, lon)
+        return (dlat * self.scale + self.bias[1] / advection.METRES_PER_DEGREE,
+                dlon * self.scale + self.bias[0] / (advection.METRES_PER_DEGREE * np.cos(np.radians(lat))))
+
+
+class ensembleReduction:
+    """
+    Class for accumulating ensemble members: position counts on a lat/lon grid for every recorded time, and the
+    running sum and sum of squares of every detection's position for its mean and standard deviation.
+    """
+
+    def __init__(self, bounds, resolution, times, particles):
+        """
+        Class constructor.
+
+        :param bounds: (west, south, east, north) of the density grid in degrees.
+        :param resolution: Density grid cell size in degrees.
+        :param times: Number of recorded times.
+        :param particles: Number of detections.
+        """
+        self.bounds = bounds
+        self.resolution = resolution
+        self.nx = max(int(np.ceil((bounds[2] - bounds[0]) / resolution)), 1)
+        self.ny = max(int(np.ceil((bounds[3] - bounds[1]) / resolution)), 1)
+        self.members = 0
+        self.clocks = None
+        self.counts = np.zeros((times, self.ny, self.nx), dtype=np.uint32)
+        self.n = np.zeros((particles, times), dtype=np.uint32)
+        self.sum = np.zeros((particles, times, 2))
+        self.sumsq = np.zeros((particles, times, 2))
+
+    def add(self, clocks, released, lat, lon):
+        """
+        Folds one member in.
+
+        :param clocks: Seconds array of the recorded times.
+        :param released: Boolean array, particle by recorded time, of the released particles.
+        :param lat: Latitude array, particle by recorded time.
+        :param lon: Longitude array, particle by recorded time.
+        """
+        self.members += 1
+        self.clocks = clocks
+        west, south = self.bounds[0], self.bounds[1]
+        x = np.floor((lon - west) / self.resolution).astype(np.int64)
+        y = np.floor((lat - south) / self.resolution).astype(np.int64)
+        inside = released & (x >= 0) & (x < self.nx) & (y >= 0) & (y < self.ny)
+        cells = self.ny * self.nx
+        for t in range(len(clocks)):
+            keep = inside[:, t]
+            self.counts[t] += np.bincount(y[keep, t] * self.nx + x[keep, t], minlength=cells).reshape(
+                self.ny, self.nx).astype(np.uint32)
+        positions = np.stack([lat, lon], axis=-1).astype(np.float64) * released[..., None]
+        self.n += released
+        self.sum += positions
+        self.sumsq += positions ** 2
+
+    def merge(self, other):
+        """
+        Adds the members of another reduction over the same grid and detections.
+
+        :param other: ensembleReduction.
+        :return: This reduction.
+        """
+        self.members += other.members
+        self.clocks = other.clocks if self.clocks is None else self.clocks
+        self.counts += other.counts
+        self.n += other.n
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return self
+
+    def density(self):
+        """
+        :return: Fraction of the member particles in each grid cell, by recorded time, lat and lon.
+        """
+        return self.counts / max(self.members * len(self.n), 1)
+
+    def spread(self):
+        """
+        :return: (mean, standard deviation) arrays of the detections' positions, by detection, recorded time and
+                 (lat, lon). NaN before a detection is released.
+        """
+        n = np.where(self.n > 0, self.n, np.nan)[..., None]
+        mean = self.sum / n
+        std = np.sqrt(np.maximum(self.sumsq / n - mean ** 2, 0))
+        return mean, std
+
+    def save(self, path, start, ids):
+        """
+        Saves the reduction as a netcdf file, through a temporary file and a rename. The 5th and 95th percentile
+        envelopes of each detection are estimated from its mean and standard deviation, assuming normal spread.
+
+        :param path: netcdf file path.
+        :param start: datetime64 the recorded seconds count from.
+        :param ids: List of the detection ids.
+        """
+        import xarray as xr
+
+        mean, std = self.spread()
+        time = start + self.clocks.astype('timedelta64[s]')
+        lat = self.bounds[1] + (np.arange(self.ny) + 0.5) * self.resolution
+        lon = self.bounds[0] + (np.arange(self.nx) + 0.5) * self.resolution
+        data = {"density": (("time", "lat", "lon"), self.density().astype(np.float32)),
+                "detection": (("traj",), np.array(ids, dtype=object))}
+        for i, name in enumerate(("lat", "lon")):
+            data["mean_" + name] = (("traj", "time"), mean[..., i].astype(np.float32))
+            data["std_" + name] = (("traj", "time"), std[..., i].astype(np.float32))
+            data[name + "_p05"] = (("traj", "time"), (mean[..., i] - 1.645 * std[..., i]).astype(np.float32))
+            data[name + "_p95"] = (("traj", "time"), (mean[..., i] + 1.645 * std[..., i]).astype(np.float32))
+        ds = xr.Dataset(data, coords={"time": time, "lat": lat, "lon": lon}, attrs={"members": self.members})
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        ds.to_netcdf(tmp)
+        os.replace(tmp, path)
+
+
+def initWorker(data, variables, dimensions, start):
+    """
+    Process pool initializer, builds the worker's velocity field once.
+    """
+    global workerField
+    workerField = advection.velocityField(data, variables, dimensions, start)
+
+
+def runMembers(seeds, lats, lons, endtime, bounds, options):
+    """
+    Runs a batch of ensemble members in a worker process, as one vectorized run. Every member draws its perturbations
+    and its random walk from its own generator, so a member's trajectories do not depend on the batch it runs in.
+
+    :param seeds: List of numpy SeedSequences, one per member.
+    :param lats: Release latitudes.
+    :param lons: Release longitudes.
+    :param endtime: Seconds from the start at which the simulation stops.
+    :param bounds: (west, south, east, north) of the density grid in degrees.
+    :param options: Dictionary of the runEnsemble perturbation and output options.
+    :return: ensembleReduction of the members.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    n = len(lats)
+    jitter = options["positionSigma"] / advection.METRES_PER_DEGREE
+    batch = [np.random.default_rng(seed) for seed in seeds]
+    lat = np.concatenate([lats + rng.normal(0, jitter, n) for rng in batch])
+    lon = np.concatenate([lons + rng.normal(0, jitter, n) / np.cos(np.radians(lats)) for rng in batch])
+    scale = np.repeat([rng.normal(1, options["currentSigma"]) for rng in batch], n)
+    bias = np.repeat([rng.normal(0, options["currentBias"], 2) for rng in batch], n, axis=0)
+    field = perturbedField(workerField, scale, (bias[:, 0], bias[:, 1]))
+    clocks, released, trackLat, trackLon = advection.integrateRK4(
+        field, lat, lon, np.zeros(len(lat)), endtime, options["dt"], options["outputdt"], options["kh"], batch)
+    reduction = ensembleReduction(bounds, options["resolution"], len(clocks), n)
+    for m in range(len(batch)):
+        member = slice(m * n, (m + 1) * n)
+        reduction.add(clocks, released[member], trackLat[member], trackLon[member])
+    return reduction
+
+
+def runEnsemble(data, variables, dimensions, start, lats, lons, days, bounds, members=32, processes=None, seed=0,
+                positionSigma=50.0, currentSigma=0.1, currentBias=0.02, kh=10.0, dt=300, outputdt=6 * 60 * 60,
+                resolution=0.25, batch=50000):
+    """
+    Runs an ensemble forecast of detections released at the start of the fields.
+
+    Members are split into batches of consecutive members, whatever the number of processes, and the batch results
+    are merged in batch order, so the same seed and batch size give the same ensemble on any machine. At most two
+    batches per process are waiting to be merged, which bounds memory.
+
+    :param data: xarray Dataset of the U and V fields, cropped to the particles' reach.
+    :param variables: Dictionary of the variable name of each field, {'U': ..., 'V': ...}.
+    :param dimensions: Dictionary of the dimension names, {'lat': ..., 'lon': ..., 'time': ...}.
+    :param start: datetime64 of the start of the simulation.
+    :param lats: Release latitudes.
+    :param lons: Release longitudes.
+    :param days: Number of days simulated.
+    :param bounds: (west, south, east, north) of the density grid in degrees.
+    :param members: Number of ensemble members.
+    :param processes: Number of worker processes, all cores by default.
+    :param seed: Seed of the member perturbations.
+    :param positionSigma: Standard deviation of the release position error, in metres.
+    :param currentSigma: Standard deviation of the relative current speed error.
+    :param currentBias: Standard deviation of the current bias of each member, in metres per second.
+    :param kh: Horizontal diffusivity of the random walk, in m^2/s.
+    :param dt: RK4 time step in seconds.
+    :param outputdt: Seconds between two recorded positions.
+    :param resolution: Density grid cell size in degrees.
+    :param batch: Number of particles a worker advects at once, members are batched up to it.
+    :return: ensembleReduction of all the members.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(members)
+    size = max(batch // max(len(lats), 1), 1)
+    batches = deque(seeds[first:first + size] for first in range(0, members, size))
+    processes = min(processes or os.cpu_count() or 1, len(batches))
+    options = {"positionSigma": positionSigma, "currentSigma": currentSigma, "currentBias": currentBias, "kh": kh,
+               "dt": dt, "outputdt": outputdt, "resolution": resolution}
+    endtime = days * 24 * 60 * 60
+    total = None
+    with ProcessPoolExecutor(processes, initializer=initWorker, initargs=(data, variables, dimensions, start)) as pool:
+        pending = deque()
+        while batches or pending:
+            while batches and len(pending) < 2 * processes:
+                pending.append(pool.submit(runMembers, batches.popleft(), lats, lons, endtime, bounds, options))
+            result = pending.popleft().result()
+            total = result if total is None else total.merge(result)
+    return total
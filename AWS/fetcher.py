@@ -0,0 +1,77 @@
+"""
+Author: David Jorge
+
+This library downloads S3 object bodies concurrently, handing them back in bucket listing (key) order so the
+image chunks can be reassembled as they arrive.
+"""
+
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+class chunkFetcher:
+    """
+    Class for fetching bucket entries with a bounded thread pool over a shared boto3 client
+    """
+
+    def __init__(self, client, bucketname, concurrency=16, retries=4, backoff=0.25, cache=None):
+        """
+        Class constructor.
+
+        :param client: boto3 S3 client. Clients are thread safe, so a single pooled client is shared by all threads.
+        :param bucketname: S3 bucket name.
+        :param concurrency: Maximum number of downloads in flight.
+        :param retries: Number of times a failed download is retried before giving up.
+        :param backoff: Base delay in seconds of the exponential backoff between retries.
+        :param cache: Optional chunkcache.chunkCache consulted before, and filled after, every download.
+        """
+        self.client = client
+        self.bucketname = bucketname
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+
+    def fetch(self, obj):
+        """
+        Gets a single object body from the cache, or downloads it retrying with exponential backoff and jitter.
+
+        :param obj: S3 object summary.
+        :return: Object body as bytes.
+        """
+        if self.cache:
+            body = self.cache.get(obj.key, obj.e_tag)
+            if body is not None:
+                return body
+        for attempt in range(self.retries + 1):
+            try:
+                body = self.client.get_object(Bucket=self.bucketname, Key=obj.key)['Body'].read()
+                if self.cache:
+                    self.cache.put(obj.key, obj.e_tag, obj.last_modified, body)
+                return body
+            except (BotoCoreError, ClientError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+
+    def iterBodies(self, objects):
+        """
+        Downloads the bodies of the given objects concurrently and yields them in the order they were given.
+        At most twice the concurrency limit of bodies are held in memory at any time.
+
+        :param objects: Iterable of S3 object summaries, in key order.
+        :return: Generator of (object summary, body bytes) tuples, in the same order.
+        """
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for obj in objects:
+                window.append((obj, pool.submit(self.fetch, obj)))
+                if len(window) >= 2 * self.concurrency:
+                    obj, future = window.popleft()
+                    yield obj, future.result()
+            while window:
+                obj, future = window.popleft()
+                yield obj, future.result()
@@ -0,0 +1,177 @@
+"""
+Author: David Jorge
+
+This library prepares the ocean current fields the drift simulations run on. The current files are opened once and
+kept open until they change on disk, and every simulation only reads the part of the grid its particles can reach
+in the simulated time, instead of decoding the whole global grid.
+"""
+
+import os
+import numpy as np
+from advection import METRES_PER_DEGREE
+
+# xarray and parcels are imported inside the methods that use them, like in forecasting, so importing this module
+# does not pay for them until a simulation actually runs
+
+
+class fieldLoader:
+    """
+    Class for loading the U and V current fields of a simulation, cropped to the particles' bounding box plus the
+    furthest any particle can drift in the simulated time.
+
+    The drift margin is the maximum current speed in the files times the simulated time. Interpolated velocities
+    never exceed the speed at the grid nodes, so no particle can leave the cropped grid. The last crop is kept in
+    memory and reused for as long as the files do not change and it still covers the particles and time range.
+    """
+
+    def __init__(self, filenames, variables, dimensions):
+        """
+        Class constructor.
+
+        :param filenames: Dictionary of the netcdf file path of each field, e.g. {'U': 'u.nc', 'V': 'v.nc'}.
+        :param variables: Dictionary of the netcdf variable name of each field, e.g. {'U': 'u', 'V': 'v'}.
+        :param dimensions: Dictionary of the netcdf dimension names, {'lat': ..., 'lon': ..., 'time': ...}.
+        """
+        self.filenames = filenames
+        self.variables = variables
+        self.dimensions = dimensions
+        self.key = None
+        self.files = []
+        self.data = None
+        self.maxSpeed = None
+        self.crop = None
+        self.bounds = None
+
+    def signature(self):
+        """
+        :return: Tuple of the path, modification time and size of the files, which changes when they are replaced.
+        """
+        signature = []
+        for path in sorted(set(self.filenames.values())):
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def open(self):
+        """
+        Opens the files lazily, only the coordinates are read up front. Files that changed since they were last
+        opened are reopened, and the maximum current speed, the only pass over the whole files, is computed again one
+        time step at a time.
+        """
+        import xarray as xr
+
+        key = self.signature()
+        if key == self.key:
+            return
+        for ds in self.files:
+            ds.close()
+        self.files = []
+        fields = {}
+        for name, path in self.filenames.items():
+            self.files.append(xr.open_dataset(path))
+            var = self.files[-1][self.variables[name]]
+            # Singleton dimensions parcels is not told about, such as OSCAR's depth, are dropped
+            extra = {d: 0 for d in var.dims if d not in self.dimensions.values() and var.sizes[d] == 1}
+            fields[self.variables[name]] = var.isel(extra, drop=True)
+        self.data = xr.Dataset(fields)
+        u = self.data[self.variables['U']]
+        v = self.data[self.variables['V']]
+        speed = 0.0
+        for t in range(self.data.sizes[self.dimensions['time']]):
+            step = {self.dimensions['time']: t}
+            speed = max(speed, float(np.nanmax(np.hypot(u[step].values, v[step].values), initial=0.0)))
+        self.maxSpeed = speed
+        self.key = key
+        self.crop = None
+
+    def region(self, lats, lons, days):
+        """
+        Gets the region the particles can reach.
+
+        :param lats: List of the particle latitudes.
+        :param lons: List of the particle longitudes.
+        :param days: Number of days simulated.
+        :return: (west, south, east, north) in degrees, or None if there are no particle positions.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        valid = np.isfinite(lats) & np.isfinite(lons)
+        if not valid.any():
+            return None
+        # Same conversion as the integrators, so the margin holds the furthest drift they can compute
+        margin = self.maxSpeed * days * 24 * 60 * 60 / METRES_PER_DEGREE
+        south = max(lats[valid].min() - margin, -90.0)
+        north = min(lats[valid].max() + margin, 90.0)
+        # A degree of longitude shrinks towards the poles
+        lonMargin = margin / max(np.cos(np.radians(max(abs(south), abs(north)))), 0.05)
+        return lons[valid].min() - lonMargin, south, lons[valid].max() + lonMargin, north
+
+    def subset(self, lats, lons, days):
+        """
+        Gets the current fields cropped to the particles' reach and to the simulated time range, read into memory.
+
+        :param lats: List of the particle latitudes.
+        :param lons: List of the particle longitudes.
+        :param days: Number of days simulated, from the first time step of the files.
+        :return: xarray Dataset.
+        """
+        self.open()
+        bounds = self.region(lats, lons, days)
+        if self.crop is not None and self.covers(bounds, days):
+            return self.crop
+        latDim, lonDim, timeDim = self.dimensions['lat'], self.dimensions['lon'], self.dimensions['time']
+        select = {}
+        if bounds is not None:
+            west, south, east, north = bounds
+            lat = self.data[latDim].values
+            lon = self.data[lonDim].values
+            # Selecting by index keeps one grid cell beyond the bounds and works whatever the coordinate order
+            select[latDim] = self.around(lat, south, north)
+            select[lonDim] = self.around(lon, west, east)
+        time = self.data[timeDim].values
+        end = time[0] + np.timedelta64(int(days * 24 * 60 * 60), 's')
+        select[timeDim] = slice(0, int(np.searchsorted(time, end, 'left')) + 1)
+        self.crop = self.data.isel(select).load()
+        self.bounds = (bounds, days)
+        return self.crop
+
+    @staticmethod
+    def around(coordinate, low, high):
+        """
+        :param coordinate: 1D coordinate array, ascending or descending.
+        :param low: Lower bound.
+        :param high: Upper bound.
+        :return: Slice of the coordinates between the bounds, padded by one index on each side.
+        """
+        index = np.flatnonzero((coordinate >= low) & (coordinate <= high))
+        if not len(index):
+            # Bounds between two grid points, or beyond the grid
+            index = [int(np.argmin(np.abs(coordinate - (low + high) / 2)))]
+        return slice(max(index[0] - 1, 0), index[-1] + 2)
+
+    def covers(self, bounds, days):
+        """
+        :param bounds: Region the particles can reach, from region().
+        :param days: Number of days simulated.
+        :return: Boolean, whether the cached crop holds that region and time range.
+        """
+        cached, cachedDays = self.bounds
+        if days > cachedDays:
+            return False
+        if cached is None or bounds is None:
+            return cached is None
+        return (cached[0] <= bounds[0] and cached[1] <= bounds[1] and cached[2] >= bounds[2] and
+                cached[3] >= bounds[3])
+
+    def fieldset(self, lats, lons, days):
+        """
+        Builds the parcels FieldSet of a simulation.
+
+        :param lats: List of the particle latitudes.
+        :param lons: List of the particle longitudes.
+        :param days: Number of days simulated.
+        :return: parcels FieldSet.
+        """
+        from parcels import FieldSet
+
+        return FieldSet.from_xarray_dataset(self.subset(lats, lons, days), self.variables, self.dimensions)
@@ -8,15 +8,21 @@ Credit:
 ESR. 2009. OSCAR third deg. Ver. 1. PO.DAAC, CA, USA. Dataset accessed [2021-08-28] at https://doi.org/10.5067/OSCAR-03D01
 """
 
+import gzip
+import json
+import os
 from datetime import timedelta
-import xarray as xr
-import matplotlib.animation as animation
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import cartopy
 import numpy as np
-from parcels import FieldSet, ParticleSet, JITParticle, AdvectionRK4
 import pullS3
+import fields
+import trajectories
+import advection
+import ensemble
+import render
+import state
+
+# parcels and xarray are imported inside the methods that use them, and matplotlib and cartopy inside render's, so
+# importing this module (and starting the dashboard) does not pay for them until a simulation actually runs
 
 
 class forecasting:
@@ -24,34 +30,126 @@ class forecasting:
     Class for managing the drift simulations
     """
 
-    def __init__(self, lats, lons, sim_fname):
+    def __init__(self, lats, lons, sim_fname, ids=None, backend="parcels"):
         """
         Class constructor.
 
         :param lats: list of the latitude of the points to simulate.
         :param lons: list of the longitude of the points to simulate.
         :param sim_fname: file name for simulation raw data output.
+        :param ids: Optional list of the detection ids of the points. Points are identified by their position in the
+                    lists otherwise.
+        :param backend: Advection engine, "parcels" or "numpy" for the vectorized RK4 engine of the advection library.
         """
         self.lats = lats
         self.lons = lons
+        self.ids = ids
         self.sim_fname = sim_fname
+        if backend not in ("parcels", "numpy"):
+            raise ValueError("Unknown advection backend {}".format(backend))
+        self.backend = backend
+        # Trajectories of earlier runs, loaded on the first run
+        self.trajectories = None
 
-    def update_particles(self, lats, lons):
+        # Get ocean current data from files. The fields are cached across runs and cropped to the particles' reach
+        filenames = {'U': 'ocean_currents_U.nc', 'V': 'ocean_currents_V.nc'}
+        variables = {'U': 'u', 'V': 'v'}
+        dimensions = {'lat': 'latitude', 'lon': 'longitude', 'time': 'time'}
+        self.fields = fields.fieldLoader(filenames, variables, dimensions)
+
+    def update_particles(self, lats, lons, ids=None):
         """
-        Updates latitude and longitude list instance variables.
+        Updates latitude, longitude and detection id list instance variables.
 
         :param lats: Updated latitude list.
         :param lons: Updated longitude list.
+        :param ids: Optional updated detection id list.
         """
         self.lats = lats
         self.lons = lons
+        self.ids = ids
 
     def run_forecasting(self, days):
         """
         Runs the simulation on the points stored in the class instance variables and saves the raw output to a file.
 
+        Particles are identified by detection id and their trajectories are kept across runs, so only detections
+        without a trajectory are simulated from the start, and trajectories ending before the forecast horizon are
+        extended from their last position. Everything is simulated again when the current files change.
+
         :param days: Number of days in the future to forecast drift.
         """
+        if self.trajectories is None:
+            self.trajectories = trajectories.trajectoryStore(self.sim_fname)
+        ids = [str(i) for i in range(len(self.lats))] if self.ids is None else list(self.ids)
+        self.fields.open()
+        # The file signature goes through JSON, so it compares equal to the one saved with the trajectories
+        signature = json.loads(json.dumps(self.fields.key))
+        if self.trajectories.fields != signature:
+            self.trajectories.reset(signature)
+        start = self.fields.data[self.fields.dimensions['time']].values[0]
+        horizon = start + np.timedelta64(int(days * 24 * 60 * 60), 's')
+
+        # Release new detections at the start of the simulation, and existing ones where their trajectory ends
+        jobs = []
+        for detection, lat, lon in zip(ids, self.lats, self.lons):
+            if detection not in self.trajectories:
+                jobs.append((detection, start, lat, lon))
+            elif self.trajectories.end(detection)[0] < horizon:
+                jobs.append((detection,) + self.trajectories.end(detection))
+        if jobs:
+            self.advect(jobs, start, days)
+        self.trajectories.keep(ids)
+        self.trajectories.save(ids)
+        print("Simulation Complete!")
+
+    def advect(self, jobs, start, days):
+        """
+        Simulates particles up to the forecast horizon with the selected backend and adds their positions to the
+        stored trajectories.
+
+        :param jobs: List of (detection id, release datetime64, lat, lon) tuples.
+        :param start: datetime64 of the start of the simulation.
+        :param days: Number of days from the start to the forecast horizon.
+        """
+        if self.backend == "numpy":
+            self.advect_numpy(jobs, start, days)
+        else:
+            self.advect_parcels(jobs, start, days)
+
+    def advect_numpy(self, jobs, start, days):
+        """
+        Simulates particles with the vectorized NumPy RK4 engine, with the same time step and output interval as
+        the parcels backend.
+
+        :param jobs: List of (detection id, release datetime64, lat, lon) tuples.
+        :param start: datetime64 of the start of the simulation.
+        :param days: Number of days from the start to the forecast horizon.
+        """
+        lats = [job[2] for job in jobs]
+        lons = [job[3] for job in jobs]
+        times = [(job[1] - start) / np.timedelta64(1, 's') for job in jobs]
+        field = advection.velocityField(self.fields.subset(lats, lons, days), self.fields.variables,
+                                        self.fields.dimensions, start)
+        tracks = advection.advectRK4(field, lats, lons, times, days * 24 * 60 * 60, dt=5 * 60, outputdt=60 * 60)
+        for job, (seconds, lat, lon) in zip(jobs, tracks):
+            self.trajectories.extend(job[0], start + seconds.astype('timedelta64[s]'), lat, lon)
+
+    def advect_parcels(self, jobs, start, days):
+        """
+        Simulates particles with parcels' AdvectionRK4 kernel.
+
+        :param jobs: List of (detection id, release datetime64, lat, lon) tuples.
+        :param start: datetime64 of the start of the simulation.
+        :param days: Number of days from the start to the forecast horizon.
+        """
+        from parcels import ParticleSet, JITParticle, AdvectionRK4
+        import xarray as xr
+
+        lats = [job[2] for job in jobs]
+        lons = [job[3] for job in jobs]
+        times = [(job[1] - start) / np.timedelta64(1, 's') for job in jobs]
+
         # import netCDF4 as nc
         # fn = 'ocean_currents_U.nc'
         # ds = nc.Dataset(fn)
@@ -59,94 +157,112 @@ class forecasting:
 
         # fname = 'ocean_currents_V.nc'
 
-        # Get ocean current data from files
-        filenames = {'U': 'ocean_currents_U.nc', 'V': 'ocean_currents_V.nc'}
-        variables = {'U': 'u', 'V': 'v'}
-        dimensions = {'U': {'lat': 'latitude', 'lon': 'longitude', 'time': 'time'},
-                      # In the GlobCurrent data the dimensions are also called 'lon', 'lat' and 'time'
-                      'V': {'lat': 'latitude', 'lon': 'longitude', 'time': 'time'}}
-
         # Initialize fieldset class instance for simulation (defines the 'field' of the simulation)
-        fieldset = FieldSet.from_netcdf(filenames, variables, dimensions)
+        fieldset = self.fields.fieldset(lats, lons, days)
 
         # Initialize the particleset class instance for simulation (defines the 'particles' to be simulated)
         pset = ParticleSet(fieldset=fieldset,  # the fields on which the particles are advected
                            pclass=JITParticle,  # the type of particles (JITParticle or ScipyParticle)
-                           lon=self.lons,  # release longitude
-                           lat=self.lats)  # release latitude
+                           lon=lons,  # release longitude
+                           lat=lats,  # release latitude
+                           time=times)  # release time, in seconds from the start of the fields
+        detections = {p.id: job[0] for p, job in zip(pset, jobs)}
 
         # pset = ParticleSet.from_line(fieldset=fieldset, size=5, pclass=JITParticle,
         #                             start=(-23, 52), finish=(-23, 53))
 
         # Initialize particlefile class instance for saving raw simulation output to a file
-        output_file = pset.ParticleFile(name=self.sim_fname, outputdt=timedelta(hours=1))
+        run_fname = os.path.splitext(self.sim_fname)[0] + "_run.nc"
+        output_file = pset.ParticleFile(name=run_fname, outputdt=timedelta(hours=1))
 
         # Run simulation
-        pset.execute(AdvectionRK4, runtime=timedelta(days=days), dt=timedelta(minutes=5), output_file=output_file)
+        # parcels only takes the end as a datetime or as seconds from the start of the fields, like the release times
+        pset.execute(AdvectionRK4, endtime=days * 24 * 60 * 60, dt=timedelta(minutes=5), output_file=output_file)
 
         # pset.show(domain={'N': -31, 'S': -35, 'E': 33, 'W': 26})
 
         # Only want raw data as .nc file
         output_file.close()
 
+        # Merge the positions of this run into the stored trajectories
+        with xr.open_dataset(run_fname) as ds:
+            trajectory = ds['trajectory'].values
+            time = ds['time'].values
+            lat = ds['lat'].values
+            lon = ds['lon'].values
+        for row in range(len(trajectory)):
+            valid = ~np.isnat(time[row])
+            if valid.any():
+                detection = detections[int(trajectory[row][valid][0])]
+                self.trajectories.extend(detection, time[row][valid], lat[row][valid], lon[row][valid])
+        os.remove(run_fname)
+
         # plotTrajectoriesFile(self.sim_fname, mode='movie2d')
-        print("Simulation Complete!")
+
+    def run_ensemble(self, days, fname="particle_ensemble.nc", members=32, processes=None, **perturbations):
+        """
+        Runs an ensemble of perturbed simulations of the points stored in the class instance variables, all released
+        at the start of the fields, and saves their density grids and per detection envelopes to a netcdf file.
+
+        :param days: Number of days in the future to forecast drift.
+        :param fname: File name for the ensemble output.
+        :param members: Number of ensemble members.
+        :param processes: Number of worker processes, all cores by default.
+        :param perturbations: Optional ensemble.runEnsemble perturbation, seed and resolution keyword arguments.
+        """
+        ids = [str(i) for i in range(len(self.lats))] if self.ids is None else list(self.ids)
+        if not ids:
+            return
+        self.fields.open()
+        start = self.fields.data[self.fields.dimensions['time']].values[0]
+        reduction = ensemble.runEnsemble(self.fields.subset(self.lats, self.lons, days), self.fields.variables,
+                                         self.fields.dimensions, start, self.lats, self.lons, days,
+                                         self.fields.region(self.lats, self.lons, days), members, processes,
+                                         **perturbations)
+        reduction.save(fname, start, ids)
+        print("Ensemble Complete!")
 
     def output_sim(self):
         """
-        Save raw simulation data as an mp4 file. Plots background for UI convinience.
-        """
-        # Load raw simulation data from file
-        filename = self.sim_fname
-        pfile = xr.open_dataset(str(filename), decode_cf=True)
-        lon = np.ma.filled(pfile.variables['lon'], np.nan)
-        lat = np.ma.filled(pfile.variables['lat'], np.nan)
-        time = np.ma.filled(pfile.variables['time'], np.nan)
-
-        # print(time)
-        pfile.close()
-
-        # Get animation time intervals
-        plottimes = np.arange(time[0, 0], np.nanmax(time), np.timedelta64(1, 'h'))
-
-        # print(plottimes)
-        starttime = 0
-        b = time == plottimes[0 + starttime]
-
-        # Initialize animation figure
-        fig = plt.figure(figsize=(8, 4))
-        # gs = gridspec.GridSpec(ncols=8, nrows=4, figure=fig)
-
-        ### Plot Background and Points
-        ax1 = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
-        ax1.set_facecolor('#1EB7D0')
-        ax1.add_feature(cartopy.feature.LAND, zorder=1)
-        ax1.coastlines()
-        lat1, lon1, lat2, lon2 = -44, 10, 35, 70
-        ax1.set_extent([lat1, lon1, lat2, lon2], crs=ccrs.PlateCarree())
-        scat1 = ax1.scatter(lon[b], lat[b], marker='.', s=95, c='#AB2200', edgecolor='white', linewidth=0.15,
-                            transform=ccrs.PlateCarree())
-
-        frames = np.arange(0, len(plottimes))
-
-        # Define function for updating figure for each frame
-        def animate(t):
-            b = time == plottimes[t + starttime]
-            scat1.set_offsets(np.vstack((lon[b], lat[b])).transpose())
-            # scat2.set_offsets(np.vstack((lon[b], lat[b])).transpose())
-            return scat1  # , scat2
-
-        # Save animation to mp4 file
-        anim = animation.FuncAnimation(fig, animate, frames=frames, interval=150, blit=False)
-        fig.canvas.draw()  # needed for tight_layout to work with cartopy
-        plt.tight_layout()
-        # writergif = PillowWriter(fps=30)
-        # Set up formatting for the movie files
-        Writer = animation.writers['ffmpeg']
-        writer = Writer(fps=30, metadata=dict(artist='Me'), bitrate=1800)
-        anim.save('assets/sim.mp4', writer=writer)
+        Save raw simulation data as an mp4 file. Plots background for UI convinience. Runs without particles keep the
+        previous movie.
+        """
+        # Load raw simulation data from file, indexed by animation frame at hourly intervals
+        frames = trajectories.frameIndex.load(self.sim_fname)
+        if not len(frames):
+            return
+
+        # The background is drawn once and the particles are stamped on it, frame ranges are rendered in parallel
+        # Rendered to a temporary file and renamed into place, so the dashboard never serves a partial movie
+        tmp = 'assets/.sim.{}.mp4'.format(os.getpid())
+        render.renderMovie(frames, tmp, fps=30, bitrate=1800)
+        os.replace(tmp, 'assets/sim.mp4')
         print("Saved Animation!")
 
+    def export_sim(self, fname="forecast.json.gz", scale=1000):
+        """
+        Save raw simulation data as gzipped JSON, for the dashboard to animate the particles on the map in the
+        browser. Positions are quantized to integers of 1/scale degrees and listed frame by frame, at hourly
+        intervals: the positions of frame t are lat[offsets[t]:offsets[t + 1]] and lon[offsets[t]:offsets[t + 1]].
+
+        :param fname: File name for the export.
+        :param scale: Number of quantization steps per degree, 1000 is about 100 metres.
+        """
+        step = np.timedelta64(1, 'h')
+        # Without particles the export has no frames, and the dashboard animates nothing
+        payload = {"start": None, "step": int(step / np.timedelta64(1, 's')), "scale": scale, "offsets": [0],
+                   "lat": [], "lon": []}
+        if len(self.lats):
+            frames = trajectories.frameIndex.load(self.sim_fname, step)
+            if len(frames):
+                payload.update(start=str(frames.times[0].astype("datetime64[s]")) + "Z",
+                               offsets=frames.offsets.tolist(),
+                               lat=np.round(frames.lat.astype(np.float64) * scale).astype(np.int64).tolist(),
+                               lon=np.round(frames.lon.astype(np.float64) * scale).astype(np.int64).tolist())
+        # Written through a temporary file and a rename, so the dashboard never serves a partial export
+        state.atomicWrite(fname, gzip.compress(json.dumps(payload, separators=(",", ":")).encode()))
+        print("Saved Export!")
+
 
 if __name__ == "__main__":
     import netCDF4 as nc
@@ -156,7 +272,8 @@ if __name__ == "__main__":
 
     # https://podaac.jpl.nasa.gov/dataset/OSCAR_L4_OC_third-deg
 
-    obj = forecasting(aws.map_data['lat'].tolist(), aws.map_data['lon'].tolist(), "particle_sim.nc")
+    obj = forecasting(aws.map_data['lat'].tolist(), aws.map_data['lon'].tolist(), "particle_sim.nc",
+                      aws.map_data['start_key'].tolist())
     obj.run_forecasting(days=14)
     obj.output_sim()
 
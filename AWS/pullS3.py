@@ -5,12 +5,18 @@ This library acts as an API between the dashboard app and AWS. It allows for dat
 from AWS, and parsed/saved accordingly into more convenient formats.
 """
 
-import binascii
 import boto3
+from botocore.config import Config
 import pandas as pd
-from PIL import Image, ImageFile
-from io import BytesIO
 import datetime
+import itertools
+import state
+import fetcher
+import chunkcache
+import detections
+import reassembly
+import store
+import snapshots
 
 
 def datetimeToString(dt):
@@ -23,6 +29,20 @@ def datetimeToString(dt):
     return str(dt)[:10] + "-" + str(dt)[11:13] + "-" + str(dt)[14:16] + "-" + str(dt)[17:19]
 
 
+def snapshotName(dt, device):
+    """
+    Gets the name an entry's snapshot is saved under. The device is appended so that snapshots from different
+    devices finishing in the same second do not collide.
+
+    :param dt: LastModified datetime of the entry.
+    :param device: Device name of the entry.
+    :return: string.
+    """
+    if not device:
+        return datetimeToString(dt)
+    return datetimeToString(dt) + "-" + device.replace("/", "-")
+
+
 def roundTime(dt=None, roundTo=60):
     """Round a datetime object to any time lapse in seconds
     dt : datetime.datetime object, default now.
@@ -35,47 +55,68 @@ def roundTime(dt=None, roundTo=60):
     return dt + datetime.timedelta(0, rounding - seconds, -dt.microsecond)
 
 
-def getIndexes(dfObj, value):
-    """ Get index positions of value in dataframe i.e. dfObj."""
-    listOfPos = list()
-    # Get bool dataframe with True at positions where the given value exists
-    result = dfObj.isin([value])
-    # Get list of columns that contains the value
-    seriesObj = result.any()
-    columnNames = list(seriesObj[seriesObj == True].index)
-    # Iterate over list of columns and fetch the rows indexes where value exists
-    for col in columnNames:
-        rows = list(result[col][result[col] == True].index)
-        for row in rows:
-            listOfPos.append((row, col))
-    # Return a list of tuples indicating the positions of value in the dataframe
-    return listOfPos
-
-
 class pullS3:
     """
     Class for managing and processing data pulls from aws
     """
 
-    def __init__(self):
+    def __init__(self, bucketname='oceanpollution', incremental=False, cursor_path=".pull_cursor.json",
+                 concurrency=16, cache_dir=".chunk_cache", cache_size=512 * 1024 ** 2, index_path=".processed.sqlite",
+                 session_timeout=15 * 60, store_path="store", snapshot_path="./snapshots", keep_snapshots=50):
         """
-        files: List of filenames processed during instance lifetime
-        mostRecent: String - Most recently added filename from aws.
-        map_data: Pandas dataframe - stores number of object detections, date, latitude and longitude.
+        processed: processedIndex - Persistent index of the entries processed, survives restarts.
+        mostRecent: String - Name of the most recent snapshot from aws.
+        mostRecentTime: datetime - LastModified of the most recent snapshot, images are only shown if newer.
+        map_data: Pandas dataframe - stores number of object detections, date, entry time, latitude and longitude.
         hourly: Pandas dataframe - stores date and count information in hourly intervals.
+        histogram: timeHistogram - detection counts per time bucket, hourly is exported from it.
+        cursor: Dictionary - Last S3 key processed at an entry boundary in each top level key prefix, only used in
+                incremental mode.
+        prefixes: Set - Top level key prefixes found in the bucket, only used in incremental mode.
+        reassembler: reassembler - Per device image sessions, kept open across pulls.
+        store: detectionStore - Parquet detection history, map_data and hourly are loaded from it at startup.
+        loaded: Set - Store files map_data and hourly hold the rows of.
+        snapshots: snapshotStore - Latest snapshots saved as the JPEG files sent by the drones.
+
+        :param bucketname: S3 bucket name.
+        :param incremental: Flags whether pulls only list objects after the persisted cursors.
+        :param cursor_path: File path the incremental cursors are persisted to.
+        :param concurrency: Maximum number of object bodies downloaded in parallel.
+        :param cache_dir: Directory of the local cache of raw bucket entries. None disables the cache.
+        :param cache_size: Size cap in bytes of the local cache.
+        :param index_path: sqlite file of the processed entry index. None keeps the index in memory only.
+        :param session_timeout: Seconds after which an incomplete image upload is dropped.
+        :param store_path: Directory of the parquet detection store.
+        :param snapshot_path: Directory the snapshots are saved to.
+        :param keep_snapshots: Number of snapshots kept on disk.
         """
         self.s3 = boto3.resource(
             service_name='s3',
             region_name='eu-west-2',
             aws_access_key_id='#',
-            aws_secret_access_key='#'
+            aws_secret_access_key='#',
+            config=Config(max_pool_connections=concurrency)
         )
-        self.files = []
         self.mostRecent = None
-        self.map_data = pd.DataFrame(
-            columns=['Number of Clusters', 'Date', "lat", "lon", "temp", "humidity", "pressure", "pitch", "roll",
-                     "yaw", "_size_"])
+        self.mostRecentTime = None
+        self.map_data = pd.DataFrame(columns=detections.FRAME_COLUMNS)
         self.hourly = pd.DataFrame(columns=["Date", "Count"])
+        self.rows = detections.columnBuffer(detections.STORE_COLUMNS, detections.STORE_DTYPES)
+        self.histogram = detections.timeHistogram()
+        self.loaded = set()
+        self.bucketname = bucketname
+        self.incremental = incremental
+        self.cursorFile = state.cursorFile(cursor_path)
+        self.cursor = self.cursorFile.load() if incremental else {}
+        self.prefixes = set()
+        self.reassembler = reassembly.reassembler(session_timeout, self.cursor)
+        self.cache = chunkcache.chunkCache(cache_dir, cache_size) if cache_dir else None
+        self.fetcher = fetcher.chunkFetcher(self.s3.meta.client, bucketname, concurrency, cache=self.cache)
+
+        self.processed = state.processedIndex(index_path)
+        self.store = store.detectionStore(store_path)
+        self.snapshots = snapshots.snapshotStore(snapshot_path, keep_snapshots)
+        self.load()
 
     def flushBucket(self, bucketname='oceanpollution'):
         """
@@ -86,79 +127,206 @@ class pullS3:
         for obj in self.s3.Bucket(bucketname).objects.all():
             obj.delete()
 
-    def pull(self):
+    def load(self, files=None):
+        """
+        Loads map_data, hourly and mostRecent from the detection store, without touching S3.
+
+        :param files: Optional list of store files to add to the rows already loaded. The whole store by default.
+        """
+        if files is None:
+            files = self.store.files()
+        history = self.store.read(files=files)
+        self.loaded.update(files)
+        if not len(history):
+            return
+        self.map_data = detections.extendFrame(self.map_data, history[detections.FRAME_COLUMNS])
+        self.histogram.addMany(history["timestamp"])
+        self.hourly = self.histogram.toFrame(60 * 60)
+        self.updateMostRecent(history["timestamp"].iloc[-1], history["device"].iloc[-1])
+
+    def refresh(self):
+        """
+        Catches up with the detections another process appended to the store. Only the files not loaded yet are
+        read, unless loaded files were compacted away, in which case the whole store is reloaded.
+
+        :return: Boolean, whether new rows were loaded.
+        """
+        files = self.store.files()
+        if self.loaded.issubset(files):
+            new = [f for f in files if f not in self.loaded]
+            if new:
+                self.load(new)
+            return bool(new)
+        self.map_data = pd.DataFrame(columns=detections.FRAME_COLUMNS)
+        self.hourly = pd.DataFrame(columns=["Date", "Count"])
+        self.histogram = detections.timeHistogram()
+        self.loaded = set()
+        self.mostRecent = None
+        self.mostRecentTime = None
+        self.load(files)
+        return True
+
+    def resume(self):
+        """
+        Reloads the pull cursors and processed entry index persisted by another process, before this process takes
+        over the pulls from it. Image sessions left open by the other process are listed again from the cursors.
+        """
+        self.cursor = self.cursorFile.load() if self.incremental else {}
+        self.prefixes = set()
+        self.reassembler = reassembly.reassembler(self.reassembler.timeout, self.cursor)
+        self.processed.reload()
+
+    def rebuild(self):
+        """
+        Forgets the processed entries and the cursors when the detection store is empty while entries were
+        processed, for instance after the store directory was removed, so the next pull rebuilds the store from the
+        bucket.
+        """
+        if self.store.days() or not len(self.processed):
+            return
+        self.processed.clear()
+        self.cursor = {}
+        self.cursorFile.clear()
+        self.prefixes = set()
+        self.reassembler = reassembly.reassembler(self.reassembler.timeout)
+
+    def updateMostRecent(self, lastModified, device):
+        """
+        Points mostRecent at a snapshot, unless the current one is newer. Devices are listed one after the other, so
+        images do not arrive in time order.
+
+        :param lastModified: LastModified datetime of the snapshot's entry.
+        :param device: Device name of the entry.
+        """
+        if self.mostRecentTime is None or lastModified >= self.mostRecentTime:
+            self.mostRecent = snapshotName(lastModified, device)
+            self.mostRecentTime = lastModified
+
+    def record(self, entry, lastModified, metadata):
+        """
+        Adds a processed entry to the detection row buffer.
+
+        :param entry: (device, start key) identity of the entry.
+        :param lastModified: LastModified datetime of the entry.
+        :param metadata: List of entry header strings.
+        """
+        self.rows.append(
+            {"Number of Clusters": float(metadata[2]), "Date": datetimeToString(lastModified),
+             "lat": float(metadata[0]), "lon": float(metadata[1]), "temp": float(metadata[4]),
+             "humidity": float(metadata[5]), "pressure": float(metadata[6]), "pitch": float(metadata[7]),
+             "roll": float(metadata[8]), "yaw": float(metadata[9]), "_size_": float(metadata[2]) + 1,
+             "timestamp": lastModified.timestamp(), "device": entry[0], "start_key": entry[1]})
+
+    def takeRows(self):
+        """
+        Empties the detection row buffer.
+
+        :return: Dataframe of the buffered rows in the detection store schema.
+        """
+        frame = self.rows.toFrame()
+        frame["timestamp"] = pd.to_datetime(frame["timestamp"], unit="s", utc=True)
+        self.rows.clear()
+        return frame
+
+    def listObjects(self, offline=False):
+        """
+        Lists the bucket objects to be processed. In incremental mode every top level key prefix is listed on its
+        own, after its cursor, since keys of different devices do not sort in upload order: a device can upload a
+        key that sorts before the last key of another device.
+
+        :param offline: Flags whether to list the local cache instead of the bucket.
+        :return: Iterable of S3 object summaries, in key order within each prefix.
+        :raises ValueError: When listing offline without a local cache.
+        """
+        if offline:
+            if self.cache is None:
+                raise ValueError("Offline pulls need a local cache, cache_dir is None")
+            objects = self.cache.listObjects()
+            if not self.incremental:
+                return objects
+            return [obj for obj in objects if obj.key > self.cursor.get(reassembly.prefixOf(obj.key), "")]
+        bucket = self.s3.Bucket(self.bucketname)
+        if not self.incremental:
+            return bucket.objects.all()
+        return itertools.chain.from_iterable(self.listPrefix(bucket, prefix) for prefix in self.listPrefixes())
+
+    def listPrefixes(self):
+        """
+        Lists the top level key prefixes of the bucket. Prefixes are remembered once found, and after the first
+        listing the delimited listing starts after the cursor of the keys without a prefix, so the keys uploaded
+        before devices wrote under prefixes are not walked through on every pull. A prefix sorting before that
+        cursor is then only found by the first listing after a restart or takeover, and its entries are not lost.
+
+        :return: Sorted list of prefixes without the trailing slash, "" standing for the keys without a prefix.
+        """
+        paginator = self.s3.meta.client.get_paginator('list_objects')
+        kwargs = {"Bucket": self.bucketname, "Delimiter": "/"}
+        if self.prefixes and self.cursor.get(""):
+            kwargs["Marker"] = self.cursor[""]
+        self.prefixes.update(self.cursor)
+        self.prefixes.add("")
+        for page in paginator.paginate(**kwargs):
+            self.prefixes.update(p["Prefix"][:-1] for p in page.get("CommonPrefixes", []))
+        return sorted(self.prefixes)
+
+    def listPrefix(self, bucket, prefix):
+        """
+        :param bucket: boto3 Bucket.
+        :param prefix: Top level key prefix, "" for the keys without a prefix.
+        :return: Iterable of the S3 object summaries of the prefix after its cursor, in key order.
+        """
+        kwargs = {"Prefix": prefix + "/"} if prefix else {"Delimiter": "/"}
+        if self.cursor.get(prefix):
+            # Marker is the ListObjects equivalent of ListObjectsV2's StartAfter
+            kwargs["Marker"] = self.cursor[prefix]
+        return bucket.objects.filter(**kwargs)
+
+    def pull(self, offline=False):
         """
         Pulls data from S3 bucket in AWS and processes it.
 
-        :return: Most Recent file name, Parcel Condition Label
-        """
-        # Print available bucket names
-        for bucket in self.s3.buckets.all():
-            # print(bucket.name)
-            pass
-
-        # Get bucket size
-        size = 0
-        for obj in self.s3.Bucket('oceanpollution').objects.all():
-            size += 1
-            # print(obj.get()['Body'].read())
-
-        images = []  # List of images as byte arrays
-        parsing = False  # Flags whether or not an image the current AWS bucket entry is part of an image
-        metadata = None  # Entry metadata
-        """
-        Each detection by the camera is sent to AWS in the following format:
-        {Image Start,__headers__}   # marks the start of an entry, __headers__ is comma separated
-        image hex string            # There can be multiple image hex strings
-        {Image End}                 # marks the end of an entry
-        """
-        for obj in self.s3.Bucket('oceanpollution').objects.all():
-            if "Image Start" in obj.get()['Body'].read().decode():
-                parsing = True
-                arr = bytearray()
-                metadata = obj.get()['Body'].read().decode().replace('}', "").replace('[', "").replace(']', "").split(
-                    ',')[1:]
-                if len(metadata) < 10:
-                    parsing = False
-                continue
-            if parsing and obj.get()['Body'].read().decode() != "{Image Start}":
-                if obj.get()['Body'].read().decode() == "{Image End}":
-                    images.append((arr, obj.get()['LastModified'], metadata))
-                    metadata = None
-                    parsing = False
-                    continue
-                arr.extend(binascii.unhexlify(obj.get()['Body'].read()))
-        # print(images)
-
-        # Get most recent entry
-        newest = None
-        if images:
-            newest = images[0]
-
-        # Save parsed images as files. Same entries are not processed more than once per instance
-        # map_data and hourly instance variables are updated accordingly
-        for img in images:
-            if not datetimeToString(img[1]) in self.files:
-                im = Image.open(BytesIO(img[0]))
-                # im.show()
-                im.save("./assets/{}.png".format(datetimeToString(img[1])))
-                if img[2]:
-                    self.map_data = self.map_data.append(
-                        {"Number of Clusters": float(img[2][2]), "Date": datetimeToString(img[1]),
-                         "lat": float(img[2][0]), "lon": float(img[2][1]), "temp": float(img[2][4]),
-                         "humidity": float(img[2][5]), "pressure": float(img[2][6]), "pitch": float(img[2][7]),
-                         "roll": float(img[2][8]), "yaw": float(img[2][9]), "_size_": float(img[2][2])+1},
-                        ignore_index=True)
-                self.files.append(datetimeToString(img[1]))
-                roundDate = roundTime(img[1], 60 * 60)
-                if roundDate not in self.hourly.values:
-                    self.hourly = self.hourly.append({"Date": roundDate, "Count": 0}, ignore_index=True)
-                loc = getIndexes(self.hourly, roundDate)[0][0]
-                self.hourly.at[loc, "Count"] += 1
-
-            newest = img
+        The bucket is listed once and every object body is downloaded exactly once, concurrently, then fed to the
+        reassembler in key order, which emits images as each device's upload completes.
+        In incremental mode no prefix's cursor is ever moved past the start of an image that is still being
+        uploaded, so its chunks are listed again on the next pull after a restart. Uploads silent for longer than the
+        session timeout at the time of the pull are dropped, which releases the cursor.
+
+        :param offline: Flags whether to reprocess the local cache without any network calls.
+        :return: Number of new entries processed.
+        :raises ValueError: When pulling offline without a local cache.
+        """
+        self.rebuild()
+
+        # Save parsed images as files. Same entries are never processed more than once, even across restarts
+        # map_data and hourly instance variables are updated accordingly, in one batch per pull
+        self.rows.clear()
+        added = []
+        saved = []
+        completed = []
+        entries = self.fetcher.iterBodies(self.listObjects(offline))
+        for img in self.reassembler.stream(entries, datetime.datetime.now(datetime.timezone.utc)):
+            if img[3] not in self.processed:
+                saved.append((snapshotName(img[1], img[3][0]), bytes(img[0])))
+                self.record(img[3], img[1], img[2])
+                added.append((img[3], img[1]))
+            completed.append((img[1], img[3][0]))
+        self.snapshots.save(saved)
+        new = self.takeRows()
+        self.store.append(new)
+        self.loaded = set(self.store.files())
+        self.processed.add(added)
+        self.map_data = detections.extendFrame(self.map_data, new[detections.FRAME_COLUMNS])
+        if added:
+            self.histogram.addMany(new["timestamp"])
+            self.hourly = self.histogram.toFrame(60 * 60)
         print("Pulled Data from AWS!")
-        self.mostRecent = datetimeToString(newest[1])
+        if completed:
+            self.updateMostRecent(*max(completed, key=lambda img: img[0]))
+        resumeKeys = self.reassembler.safeKeys()
+        if self.incremental and resumeKeys != self.cursor:
+            self.cursor = resumeKeys
+            self.cursorFile.save(resumeKeys)
+        return len(added)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+"""
+Author: David Jorge
+
+This library indexes the detections by time and position, for the JSON query endpoint of the dashboard. Queries
+cost O(log n + k) for k matching detections instead of a scan of the whole history.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+
+# Columns returned by the query endpoint, time is added as an ISO 8601 string
+RESULT_COLUMNS = ["lat", "lon", "Number of Clusters", "temp", "humidity", "pressure", "pitch", "roll", "yaw"]
+
+
+class detectionIndex:
+    """
+    Class for querying the detections of one data version by time range, bounding box and minimum cluster count.
+
+    Rows are ranked by time, so a time range is a contiguous range of ranks found by binary search. The ranks are
+    also grouped by square lat/lon grid cell, each group sorted, so a bounding box only visits the cells it covers
+    and only the ranks inside the time range within each of them.
+    """
+
+    def __init__(self, map_data, cell=1.0):
+        """
+        Class constructor.
+
+        :param map_data: Detections dataframe with a timezone aware "timestamp" column.
+        :param cell: Grid cell size in degrees.
+        """
+        self.cell = cell
+        self.columns = int(np.ceil(360.0 / cell)) + 1
+        times = pd.to_datetime(map_data["timestamp"], utc=True).dt.tz_localize(None)
+        times = times.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        order = np.argsort(times, kind="stable")
+        self.times = times[order]
+        self.rows = map_data.iloc[order].reset_index(drop=True)
+        self.lat = self.rows["lat"].to_numpy(dtype=np.float64)
+        self.lon = self.rows["lon"].to_numpy(dtype=np.float64)
+        self.clusters = self.rows["Number of Clusters"].to_numpy(dtype=np.float64)
+
+        # Ranks grouped by cell, in rank order within each cell. Rows without a position are left out of the grid.
+        ranks = np.flatnonzero(np.isfinite(self.lat) & np.isfinite(self.lon))
+        keys = self.cellKeys(self.lat[ranks], self.lon[ranks])
+        byCell = np.lexsort((ranks, keys))
+        self.cellRanks = ranks[byCell]
+        self.cells, self.cellStarts = np.unique(keys[byCell], return_index=True)
+        self.cellEnds = np.append(self.cellStarts[1:], len(self.cellRanks))
+
+    def __len__(self):
+        return len(self.times)
+
+    def cellKeys(self, lat, lon):
+        """
+        :param lat: Latitude array.
+        :param lon: Longitude array.
+        :return: Grid cell key array.
+        """
+        return (np.floor((lat + 90) / self.cell).astype(np.int64) * self.columns +
+                np.floor((lon + 180) / self.cell).astype(np.int64))
+
+    def timeRange(self, start=None, end=None):
+        """
+        :param start: Optional timezone aware datetime, only detections at or after it match.
+        :param end: Optional timezone aware datetime, only detections before it match.
+        :return: (first, last) half open range of the matching ranks.
+        """
+        first = 0 if start is None else int(np.searchsorted(self.times, pd.Timestamp(start).value, "left"))
+        last = len(self.times) if end is None else int(np.searchsorted(self.times, pd.Timestamp(end).value, "left"))
+        return first, max(first, last)
+
+    def boxRanks(self, first, last, bbox):
+        """
+        Gets the ranks inside a time range whose cells intersect a bounding box.
+
+        :param first: First rank of the time range.
+        :param last: Rank after the time range.
+        :param bbox: (west, south, east, north) in degrees. A west edge east of the east edge crosses the
+                     antimeridian.
+        :return: Array of candidate ranks, to be filtered by exact position.
+        """
+        if not len(self.cells):
+            # No detection has a position yet
+            return np.empty(0, dtype=np.int64)
+        west, south, east, north = bbox
+        rows = np.arange(np.floor((max(south, -90) + 90) / self.cell),
+                         np.floor((min(north, 90) + 90) / self.cell) + 1)
+        spans = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+        columns = np.concatenate([np.arange(np.floor((w + 180) / self.cell), np.floor((e + 180) / self.cell) + 1)
+                                  for w, e in spans])
+        covered = (rows[:, None] * self.columns + columns[None, :]).astype(np.int64).ravel()
+        found = np.searchsorted(self.cells, covered)
+        found = found[(found < len(self.cells)) & (self.cells[np.minimum(found, len(self.cells) - 1)] == covered)]
+        # Visiting a cell costs about as much as filtering a few dozen rows, so large boxes scan the time range
+        if len(found) * 64 >= last - first:
+            return np.arange(first, last)
+        parts = []
+        for i in found:
+            group = self.cellRanks[self.cellStarts[i]:self.cellEnds[i]]
+            parts.append(group[np.searchsorted(group, first):np.searchsorted(group, last)])
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    def query(self, start=None, end=None, bbox=None, minClusters=None, limit=None):
+        """
+        Gets the detections matching every given predicate.
+
+        :param start: Optional timezone aware datetime, only detections at or after it match.
+        :param end: Optional timezone aware datetime, only detections before it match.
+        :param bbox: Optional (west, south, east, north) bounding box in degrees, edges included.
+        :param minClusters: Optional minimum number of clusters.
+        :param limit: Optional maximum number of detections returned, the earliest ones are kept.
+        :return: Dataframe of the matching detections in time order.
+        """
+        first, last = self.timeRange(start, end)
+        if bbox is None:
+            ranks = np.arange(first, last)
+        else:
+            ranks = self.boxRanks(first, last, bbox)
+            west, south, east, north = bbox
+            lat, lon = self.lat[ranks], self.lon[ranks]
+            inLon = (lon >= west) & (lon <= east) if west <= east else (lon >= west) | (lon <= east)
+            ranks = ranks[(lat >= south) & (lat <= north) & inLon]
+        if minClusters is not None:
+            ranks = ranks[self.clusters[ranks] >= minClusters]
+        if limit is not None:
+            ranks = ranks[:limit]
+        return self.rows.iloc[ranks]
+
+
+class indexCache:
+    """
+    Class for building the detection index once per published data version, shared by every request.
+    """
+
+    def __init__(self, cell=1.0):
+        """
+        Class constructor.
+
+        :param cell: Grid cell size in degrees.
+        """
+        self.cell = cell
+        self.version = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def get(self, version, map_data):
+        """
+        :param version: Data version of map_data.
+        :param map_data: Detections dataframe.
+        :return: detectionIndex of the data version.
+        """
+        with self.lock:
+            if self.version != version:
+                self.index = detectionIndex(map_data, self.cell)
+                self.version = version
+            return self.index
+
+
+def toRecords(frame):
+    """
+    Converts query results to JSON serializable records.
+
+    :param frame: Dataframe returned by detectionIndex.query.
+    :return: List of dictionaries.
+    """
+    records = frame[RESULT_COLUMNS].astype(object).where(frame[RESULT_COLUMNS].notna(), None)
+    records.insert(0, "time", pd.to_datetime(frame["timestamp"], utc=True).map(pd.Timestamp.isoformat))
+    return records.to_dict("records")
+
+
+def parseTime(value):
+    """
+    :param value: ISO 8601 date or datetime string, read as UTC if it has no offset.
+    :return: Timezone aware pandas timestamp.
+    """
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts
+
+
+def parseArgs(args):
+    """
+    Parses the query string of the query endpoint.
+
+    :param args: Mapping of the query string parameters: start, end, bbox (west,south,east,north), min_clusters
+                 and limit, all optional.
+    :return: Dictionary of detectionIndex.query keyword arguments.
+    :raises ValueError: On a malformed parameter.
+    """
+    kwargs = {}
+    for name in ("start", "end"):
+        if args.get(name):
+            kwargs[name] = parseTime(args[name])
+    if args.get("bbox"):
+        bbox = [float(v) for v in args["bbox"].split(",")]
+        if len(bbox) != 4 or not all(np.isfinite(bbox)):
+            raise ValueError("bbox must be west,south,east,north")
+        kwargs["bbox"] = tuple(bbox)
+    if args.get("min_clusters"):
+        kwargs["minClusters"] = float(args["min_clusters"])
+    if args.get("limit"):
+        kwargs["limit"] = int(args["limit"])
+        if kwargs["limit"] < 0:
+            raise ValueError("limit must not be negative")
+    return kwargs
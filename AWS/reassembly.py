@@ -0,0 +1,218 @@
+"""
+Author: David Jorge
+
+This library reassembles the images sent by the drones from the individual S3 bucket entries.
+
+Each detection by the camera is sent to AWS in the following format:
+{Image Start,__headers__}   # marks the start of an entry, __headers__ is comma separated
+offset:image hex string     # There can be multiple image hex strings, offset is the byte offset of the chunk
+{Image End}                 # marks the end of an entry
+
+Older firmware sends the image hex strings without their offset.
+
+The IoT rule writes every entry under a key prefixed by the device that published it, so several devices can
+upload into the same bucket at once. Keys only sort in upload order within one prefix, so incremental pulls keep one
+cursor per top level prefix and list each prefix on its own.
+"""
+
+import binascii
+
+
+def deviceOf(key):
+    """
+    Gets the device an S3 key belongs to, from the key prefix the IoT rule writes the device's entries under.
+
+    :param key: S3 object key.
+    :return: Device name, empty if the key has no prefix.
+    """
+    return key.rpartition('/')[0]
+
+
+def prefixOf(key):
+    """
+    Gets the top level prefix an S3 key is listed under, which the pull cursors are kept by.
+
+    :param key: S3 object key.
+    :return: Prefix without the trailing slash, empty if the key has no prefix.
+    """
+    return key.partition('/')[0] if '/' in key else ""
+
+
+def parseHeader(body):
+    """
+    Parses the comma separated headers out of an {Image Start,__headers__} entry.
+
+    :param body: Decoded entry string.
+    :return: List of header strings.
+    """
+    return body.replace('}', "").replace('[', "").replace(']', "").split(',')[1:]
+
+
+class imageSession:
+    """
+    Class for buffering the chunks of one image being uploaded by one device
+    """
+
+    def __init__(self, device, startKey, header, metadata, lastModified, before):
+        """
+        Class constructor.
+
+        :param device: Device name.
+        :param startKey: S3 key of the {Image Start} entry.
+        :param header: Raw {Image Start} entry, used to spot redelivered headers.
+        :param metadata: List of header strings.
+        :param lastModified: LastModified datetime of the {Image Start} entry.
+        :param before: Last S3 key of the same prefix fed before the {Image Start} entry, resuming the prefix's
+                       listing after it lists the whole session.
+        """
+        self.device = device
+        self.startKey = startKey
+        self.header = header
+        self.metadata = metadata
+        self.lastSeen = lastModified
+        self.before = before
+        self.keys = set()
+        self.chunks = {}
+        self.offsets = {}
+
+    def add(self, key, body):
+        """
+        Buffers a chunk. Chunks sent with their offset are kept by it, so a chunk the broker delivered again under
+        a new key (MQTT QoS 1 republishes it after a lost acknowledgement) is only kept once. Chunks without an
+        offset are kept by key: nothing tells such a redelivery apart from image data that repeats, which flat
+        areas of a JPEG do, so only entries listed again under the same key are dropped.
+
+        :param key: S3 key of the entry.
+        :param body: Raw entry, "offset:hex string" or a bare hex string.
+        """
+        self.keys.add(key)
+        offset, separator, data = body.partition(b":")
+        if separator:
+            self.offsets[int(offset)] = data
+        else:
+            self.chunks[key] = body
+
+    def assemble(self):
+        """
+        Joins the chunks in offset order, or in key order for chunks sent without their offset.
+
+        :return: Image as a bytearray.
+        """
+        arr = bytearray()
+        if self.offsets:
+            for offset in sorted(self.offsets):
+                arr.extend(binascii.unhexlify(self.offsets[offset]))
+            return arr
+        for key in sorted(self.chunks):
+            arr.extend(binascii.unhexlify(self.chunks[key]))
+        return arr
+
+
+class reassembler:
+    """
+    Class that reassembles images from the bucket entries of many devices, keeping one session buffer per device.
+
+    Chunks are kept by key, and by offset when the device sends it, so entries that are listed again (for instance
+    when a pull resumes before a session that was still open) or delivered again are ignored, and the image is
+    joined in order once its {Image End} arrives. Sessions
+    that see no new entry for longer than the timeout are dropped, as soon as a newer entry of their prefix is fed,
+    and otherwise at the end of the pull, against the pull's clock. A device that dies mid-upload therefore does
+    not hold its prefix's cursor back forever.
+    """
+
+    def __init__(self, timeout=15 * 60, lastKeys=None):
+        """
+        Class constructor.
+
+        :param timeout: Seconds, in LastModified time, after which an incomplete session is dropped.
+        :param lastKeys: Dictionary of the key the listing of each prefix starts after.
+        """
+        self.timeout = timeout
+        self.sessions = {}
+        self.lastKeys = dict(lastKeys or {})
+        self.expired = 0
+
+    def feed(self, body, lastModified, key):
+        """
+        Processes the next bucket entry.
+
+        :param body: Raw object body as bytes.
+        :param lastModified: LastModified datetime of the object.
+        :param key: S3 key of the object.
+        :return: The completed (image bytearray, LastModified of the end entry, metadata, (device, start key))
+                 tuple if this entry ended an image, otherwise None.
+        """
+        prefix = prefixOf(key)
+        self.expire(lastModified, prefix)
+        device = deviceOf(key)
+        session = self.sessions.get(device)
+        before, self.lastKeys[prefix] = self.lastKeys.get(prefix), key
+        if session and (key == session.startKey or key in session.keys):
+            return None
+
+        if b"Image Start" in body:
+            # A redelivered header before any chunk keeps the session that is already open
+            if session and body == session.header and not session.keys:
+                return None
+            metadata = parseHeader(body.decode())
+            if len(metadata) < 10:
+                self.sessions.pop(device, None)
+            else:
+                self.sessions[device] = imageSession(device, key, body, metadata, lastModified, before)
+            return None
+        if not session:
+            return None
+        session.lastSeen = lastModified
+        if body == b"{Image End}":
+            del self.sessions[device]
+            return session.assemble(), lastModified, session.metadata, (device, session.startKey)
+        session.add(key, body)
+        return None
+
+    def stream(self, entries, now=None):
+        """
+        Feeds bucket entries through the reassembler, emitting images as they complete.
+
+        :param entries: Iterable of (S3 object summary, body bytes) tuples, in key order within each prefix.
+        :param now: Optional timezone aware datetime of the pull. Once every entry is fed, the sessions of all the
+                    prefixes silent for longer than the timeout at that time are dropped.
+        :return: Generator of completed image tuples.
+        """
+        for obj, body in entries:
+            image = self.feed(body, obj.last_modified, obj.key)
+            if image:
+                yield image
+        if now is not None:
+            self.expire(now)
+
+    def expire(self, now, prefix=None):
+        """
+        Drops the sessions that have been silent for longer than the timeout. Prefixes are listed one after the
+        other, so while a pull is under way entries of other prefixes say nothing about how long a session has been
+        silent, and only the sessions of the entry's own prefix are checked.
+
+        :param now: LastModified datetime of the most recent entry of the prefix, or time of the pull.
+        :param prefix: Optional top level key prefix to restrict the check to. All the sessions by default.
+        """
+        for device, session in list(self.sessions.items()):
+            if prefix is not None and prefixOf(session.startKey) != prefix:
+                continue
+            if (now - session.lastSeen).total_seconds() > self.timeout:
+                del self.sessions[device]
+                self.expired += 1
+
+    def safeKeys(self):
+        """
+        Gets the keys later listings can resume after without missing any chunk of a session still open.
+
+        :return: Dictionary of the S3 key to resume each prefix's listing after. Prefixes missing from it are listed
+                 from their start.
+        """
+        keys = dict(self.lastKeys)
+        for session in self.sessions.values():
+            prefix = prefixOf(session.startKey)
+            if session.before is None:
+                keys[prefix] = None
+            elif keys.get(prefix) is not None:
+                keys[prefix] = min(keys[prefix], session.before)
+        return {prefix: key for prefix, key in keys.items() if key is not None}
@@ -0,0 +1,197 @@
+"""
+Author: David Jorge
+
+This library renders the drift movie. The static background, sea colour, land and coastlines, is drawn with cartopy
+once, and every frame is that image with the particle marker stamped at each particle position, instead of a full
+matplotlib redraw per frame.
+
+Frame ranges are rendered across a process pool and piped to ffmpeg in order as raw RGB frames.
+"""
+
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# matplotlib and cartopy are imported inside the functions that use them, like in forecasting
+
+# Region the movie shows, (west, east, south, north) in degrees
+EXTENT = (-44, 10, 35, 70)
+
+# Particle marker style, as in the matplotlib scatter the movie was first drawn with
+MARKER = dict(marker='.', s=95, c='#AB2200', edgecolor='white', linewidth=0.15)
+
+# Background, marker and frames of the worker process, sent once to its initializer
+workerState = None
+
+
+def drawBasemap(extent=EXTENT, figsize=(8, 4), dpi=100):
+    """
+    Draws the static background of the movie.
+
+    :param extent: (west, east, south, north) in degrees.
+    :param figsize: Figure size in inches.
+    :param dpi: Figure resolution.
+    :return: (RGB image array, (x scale, x offset, y scale, y offset) pixel transform of lon and lat, (top, bottom,
+             left, right) pixel box of the map) tuple.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import cartopy.crs as ccrs
+    import cartopy
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    ax.set_facecolor('#1EB7D0')
+    ax.add_feature(cartopy.feature.LAND, zorder=1)
+    ax.coastlines()
+    ax.set_extent(list(extent), crs=ccrs.PlateCarree())
+    fig.canvas.draw()  # needed for tight_layout to work with cartopy
+    fig.tight_layout()
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+    return (image,) + mapping(fig, ax, extent)
+
+
+def mapping(fig, ax, extent):
+    """
+    :param fig: Drawn matplotlib Figure.
+    :param ax: Axes whose data coordinates are lon and lat.
+    :param extent: (west, east, south, north) in degrees.
+    :return: ((x scale, x offset, y scale, y offset), (top, bottom, left, right)) tuple of the pixel transform of lon
+             and lat, with rows counted from the top, and of the pixel box of the axes.
+    """
+    height = fig.canvas.get_width_height()[1]
+    west, east, south, north = extent
+    (x0, y0), (x1, y1) = ax.transData.transform([(west, south), (east, north)])
+    sx = (x1 - x0) / (east - west)
+    sy = -(y1 - y0) / (north - south)
+    box = ax.bbox.extents
+    transform = (sx, x0 - sx * west, sy, height - y0 - sy * south)
+    return transform, (int(round(height - box[3])), int(round(height - box[1])), int(round(box[0])),
+                       int(round(box[2])))
+
+
+def drawMarker(dpi=100, size=41):
+    """
+    Draws one particle marker on a transparent background.
+
+    :param dpi: Figure resolution, the same as the background's.
+    :param size: Odd side of the drawing in pixels, larger than the marker.
+    :return: (row offsets, column offsets, RGB array, alpha array) of the marker's visible pixels, relative to the
+             pixel holding the particle.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(size / dpi, size / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    ax.set_xlim(-1, 1)
+    ax.set_ylim(-1, 1)
+    ax.scatter([0], [0], **MARKER)
+    fig.canvas.draw()
+    rgba = np.asarray(fig.canvas.buffer_rgba()).astype(np.float64) / 255
+    rows, cols = np.nonzero(rgba[..., 3] > 0)
+    alpha = rgba[rows, cols, 3]
+    # Agg's buffer is premultiplied by alpha
+    rgb = rgba[rows, cols, :3] / alpha[:, None]
+    # The centre of the drawing is a pixel corner, and Agg snaps markers to the pixel down and right of it
+    return rows - (size + 1) // 2, cols - (size + 1) // 2, np.clip(rgb, 0, 1) * 255, alpha
+
+
+def composite(image, lat, lon, transform, box, marker):
+    """
+    Stamps the particle marker on a copy of the background.
+
+    :param image: RGB background array.
+    :param lat: Particle latitudes.
+    :param lon: Particle longitudes.
+    :param transform: Pixel transform of the background, from drawBasemap.
+    :param box: Pixel box of the map, from drawBasemap. Markers are clipped to it.
+    :param marker: Marker pixels, from drawMarker.
+    :return: RGB frame array.
+    """
+    frame = image.astype(np.float32)
+    sx, ox, sy, oy = transform
+    top, bottom, left, right = box
+    y = np.asarray(lat, dtype=np.float64) * sy + oy
+    x = np.asarray(lon, dtype=np.float64) * sx + ox
+    # Particles further off the map than a marker's size cannot show
+    near = (y > top - 64) & (y < bottom + 64) & (x > left - 64) & (x < right + 64)
+    row = np.round(y[near]).astype(np.int64)
+    col = np.round(x[near]).astype(np.int64)
+    for dy, dx, rgb, alpha in zip(*marker):
+        r = row + dy
+        c = col + dx
+        inside = (r >= top) & (r < bottom) & (c >= left) & (c < right)
+        r, c = r[inside], c[inside]
+        frame[r, c] = frame[r, c] * (1 - alpha) + rgb * alpha
+    return np.round(frame).astype(np.uint8)
+
+
+def initWorker(state):
+    """
+    Process pool initializer, keeps the background, marker and frame index in the worker.
+    """
+    global workerState
+    workerState = state
+
+
+def renderFrames(first, last):
+    """
+    Renders a range of frames in a worker process.
+
+    :param first: First frame number.
+    :param last: Frame number the range stops before.
+    :return: Bytes of the raw RGB frames, in order.
+    """
+    image, transform, box, marker, frames = workerState
+    return b"".join(composite(image, *frames.frame(t), transform, box, marker).tobytes() for t in range(first, last))
+
+
+def renderMovie(frames, path, fps=30, bitrate=1800, processes=None, chunk=8, extent=EXTENT, figsize=(8, 4), dpi=100):
+    """
+    Renders the drift movie to an mp4 file.
+
+    :param frames: trajectories.frameIndex of the particle positions.
+    :param path: mp4 file path.
+    :param fps: Frames per second.
+    :param bitrate: Video bitrate in kbit/s.
+    :param processes: Number of worker processes, all cores by default.
+    :param chunk: Number of frames a worker renders per task. At most two tasks per worker are waiting to be
+                  encoded, which bounds memory.
+    :param extent: (west, east, south, north) in degrees.
+    :param figsize: Frame size in inches.
+    :param dpi: Frame resolution.
+    """
+    import matplotlib
+
+    image, transform, box = drawBasemap(extent, figsize, dpi)
+    state = (image, transform, box, drawMarker(dpi), frames)
+    processes = processes or os.cpu_count() or 1
+    height, width = image.shape[:2]
+    # Same encoder settings as matplotlib's ffmpeg writer
+    encoder = subprocess.Popen([matplotlib.rcParams['animation.ffmpeg_path'], '-f', 'rawvideo', '-vcodec', 'rawvideo',
+                                '-s', '{}x{}'.format(width, height), '-pix_fmt', 'rgb24', '-framerate', str(fps),
+                                '-loglevel', 'error', '-i', 'pipe:', '-vcodec', matplotlib.rcParams['animation.codec'],
+                                '-pix_fmt', 'yuv420p', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                                '-b', '{}k'.format(bitrate), '-metadata', 'artist=Me', '-y', path],
+                               stdin=subprocess.PIPE)
+    try:
+        with ProcessPoolExecutor(processes, initializer=initWorker, initargs=(state,)) as pool:
+            ranges = deque((first, min(first + chunk, len(frames))) for first in range(0, len(frames), chunk))
+            pending = deque()
+            while ranges or pending:
+                while ranges and len(pending) < 2 * processes:
+                    pending.append(pool.submit(renderFrames, *ranges.popleft()))
+                encoder.stdin.write(pending.popleft().result())
+    finally:
+        encoder.stdin.close()
+        code = encoder.wait()
+    if code:
+        raise subprocess.CalledProcessError(code, encoder.args)
@@ -0,0 +1,163 @@
+"""
+Author: David Jorge
+
+This library saves the snapshots sent by the drones for the dashboard. The JPEG bytes compressed on the
+raspberry pi are written as they are, and only the latest snapshots are kept on disk. The most recently used
+snapshots are also held in memory, so serving them costs no disk I/O.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+def isJPEG(data):
+    """
+    Checks the JPEG start and end of image markers, a cheap stand in for decoding the image.
+
+    :param data: Image bytes.
+    :return: Boolean.
+    """
+    return data[:2] == b"\xff\xd8" and data.rstrip(b"\x00")[-2:] == b"\xff\xd9"
+
+
+class snapshotStore:
+    """
+    Class for persisting the latest N snapshots as JPEG files, with thumbnails generated on first use, and serving
+    them from an in-memory LRU cache with the disk as a bounded spillover
+    """
+
+    def __init__(self, path="./snapshots", keep=50, thumb_size=(160, 160), memory=20):
+        """
+        Class constructor.
+
+        :param path: Directory the snapshots are written to. Snapshot names sort in time order.
+        :param keep: Number of snapshots kept on disk, 0 keeps none. None keeps them all.
+        :param thumb_size: Maximum thumbnail width and height in pixels.
+        :param memory: Number of snapshots and thumbnails held in memory.
+        :raises ValueError: If keep is negative.
+        """
+        if keep is not None and keep < 0:
+            raise ValueError("keep must not be negative")
+        self.path = path
+        self.keep = keep
+        self.thumb_size = thumb_size
+        self.memory = memory
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, "thumbs"), exist_ok=True)
+
+    def filePath(self, name, thumb=False):
+        """
+        :param name: Snapshot name.
+        :param thumb: Flags whether to return the thumbnail path instead.
+        :return: File path of the snapshot.
+        """
+        if thumb:
+            return os.path.join(self.path, "thumbs", name + ".jpg")
+        return os.path.join(self.path, name + ".jpg")
+
+    def names(self):
+        """
+        :return: Sorted list of the names of the snapshots on disk, oldest first.
+        """
+        return sorted(f[:-4] for f in os.listdir(self.path) if f.endswith(".jpg"))
+
+    def save(self, snapshots):
+        """
+        Writes snapshots without decoding them, then removes all but the latest N from disk. On large backfills only
+        the snapshots that would survive the pruning are written. The latest snapshots are also cached in memory.
+
+        :param snapshots: List of (name, JPEG bytes) tuples in time order.
+        """
+        # A slice from -keep would keep every snapshot for keep=0
+        for name, data in snapshots[self.first(len(snapshots)):]:
+            if not isJPEG(data):
+                print("Skipped corrupt snapshot {}".format(name))
+                continue
+            tmp = os.path.join(self.path, "." + name)
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.filePath(name))
+            self.remember((name, False), data)
+        self.prune()
+
+    def remember(self, key, data):
+        """
+        Caches snapshot bytes in memory, evicting the least recently used entries past the cache size.
+
+        :param key: (name, thumbnail flag) tuple.
+        :param data: JPEG bytes.
+        :return: (JPEG bytes, ETag) tuple.
+        """
+        entry = (data, hashlib.sha1(data).hexdigest())
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.memory:
+                self.cache.popitem(last=False)
+        return entry
+
+    def get(self, name, thumb=False):
+        """
+        Gets a snapshot for serving, from memory if it is cached, otherwise from disk.
+
+        :param name: Snapshot name.
+        :param thumb: Flags whether to get the thumbnail instead.
+        :return: (JPEG bytes, ETag) tuple, or None if there is no such snapshot.
+        """
+        key = (name, thumb)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        # Names come from request URLs, only plain file names are looked up
+        if not name or name.startswith(".") or os.path.basename(name) != name:
+            return None
+        try:
+            path = self.thumbnail(name) if thumb else self.filePath(name)
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return self.remember(key, data)
+
+    def first(self, count):
+        """
+        :param count: Number of snapshots, in time order.
+        :return: Index of the first of them kept.
+        """
+        if self.keep is None:
+            return 0
+        return max(count - self.keep, 0)
+
+    def prune(self):
+        """
+        Removes all but the latest N snapshots, and their thumbnails.
+        """
+        names = self.names()
+        for name in names[:self.first(len(names))]:
+            for path in (self.filePath(name), self.filePath(name, thumb=True)):
+                if os.path.exists(path):
+                    os.remove(path)
+            with self.lock:
+                self.cache.pop((name, False), None)
+                self.cache.pop((name, True), None)
+
+    def thumbnail(self, name):
+        """
+        Gets the thumbnail of a snapshot, generating it on first use. JPEG draft mode lets PIL decode the image
+        directly at a reduced scale.
+
+        :param name: Snapshot name.
+        :return: File path of the thumbnail.
+        """
+        path = self.filePath(name, thumb=True)
+        if not os.path.exists(path):
+            with Image.open(self.filePath(name)) as im:
+                im.draft("RGB", self.thumb_size)
+                im.thumbnail(self.thumb_size)
+                im.save(path, "JPEG", quality=80)
+        return path
@@ -0,0 +1,190 @@
+"""
+Author: David Jorge
+
+This library persists the ingestion state of the dashboard to disk, so that it survives app restarts.
+"""
+
+import json
+import os
+import sqlite3
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the dashboard runs as a single process
+    fcntl = None
+
+
+def atomicWrite(path, data):
+    """
+    Writes bytes to a file through a temporary file and a rename, so readers never see a partial file.
+
+    :param path: Target file path.
+    :param data: Bytes to be written.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class cursorFile:
+    """
+    Class for persisting the incremental pull cursors (last fully processed S3 key of each top level key prefix).
+    """
+
+    def __init__(self, path=".pull_cursor.json"):
+        """
+        Class constructor.
+
+        :param path: File path the cursors are persisted to.
+        """
+        self.path = path
+
+    def load(self):
+        """
+        Loads the persisted cursors.
+
+        :return: Dictionary of the last fully processed S3 key of each prefix, empty if no cursor has been saved yet.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)["keys"]
+
+    def save(self, keys):
+        """
+        Persists the cursors.
+
+        :param keys: Dictionary of the last fully processed S3 key of each prefix.
+        """
+        atomicWrite(self.path, json.dumps({"keys": keys}).encode())
+
+    def clear(self):
+        """
+        Removes the persisted cursors, so the next pull starts from the beginning of the bucket.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class processedIndex:
+    """
+    Class for persisting which bucket entries have been processed, keyed by device and the key of the entry's
+    first chunk. The index is kept in sqlite and loaded into a set at startup for O(1) membership checks. The
+    detections themselves are kept in the detection store.
+    """
+
+    def __init__(self, path=".processed.sqlite"):
+        """
+        Class constructor.
+
+        :param path: sqlite database file path. None keeps the index in memory only.
+        """
+        self.db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS processed (device TEXT, start_key TEXT, last_modified TEXT, "
+                        "PRIMARY KEY (device, start_key))")
+        self.db.commit()
+        self.reload()
+
+    def __contains__(self, entry):
+        return entry in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def reload(self):
+        """
+        Reloads the index from sqlite, picking up entries recorded by another process.
+        """
+        self.entries = set(self.db.execute("SELECT device, start_key FROM processed").fetchall())
+
+    def add(self, entries):
+        """
+        Records processed entries.
+
+        :param entries: List of ((device, start key), LastModified datetime) tuples.
+        """
+        rows = [(entry[0], entry[1], lastModified.isoformat()) for entry, lastModified in entries
+                if entry not in self.entries]
+        self.db.executemany("INSERT OR IGNORE INTO processed VALUES (?, ?, ?)", rows)
+        self.db.commit()
+        self.entries.update((row[0], row[1]) for row in rows)
+
+    def clear(self):
+        """
+        Forgets every processed entry, so they are all processed again.
+        """
+        self.db.execute("DELETE FROM processed")
+        self.db.commit()
+        self.entries = set()
+
+
+class manifestFile:
+    """
+    Class for sharing the data and forecast versions published by the ingestion leader with the other dashboard
+    processes. The data itself is shared through the detection store, snapshots and forecast files on disk.
+    """
+
+    def __init__(self, path=".published.json"):
+        """
+        Class constructor.
+
+        :param path: File path the manifest is persisted to.
+        """
+        self.path = path
+
+    def load(self):
+        """
+        Loads the manifest.
+
+        :return: Manifest dictionary, or None if no manifest has been saved yet.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, manifest):
+        """
+        Persists the manifest.
+
+        :param manifest: Manifest dictionary.
+        """
+        atomicWrite(self.path, json.dumps(manifest).encode())
+
+
+class leaderLock:
+    """
+    Class for electing the one dashboard process that runs the pulls and forecasts. The lock is an exclusive flock
+    on a file, which the OS releases when the holder exits or dies, so another process takes over on its next try.
+    """
+
+    def __init__(self, path=".ingestion.lock"):
+        """
+        Class constructor.
+
+        :param path: Lock file path.
+        """
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """
+        Tries to take the lock, without blocking. Without fcntl the lock is always granted.
+
+        :return: Boolean, whether this process holds the lock.
+        """
+        if self.file is not None:
+            return True
+        f = open(self.path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        self.file = f
+        return True
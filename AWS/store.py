@@ -0,0 +1,144 @@
+"""
+Author: David Jorge
+
+This library persists the parsed detections as parquet files partitioned by day, so the dashboard can start from
+the stored history instead of crawling the whole S3 bucket.
+"""
+
+import datetime
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARTITIONING = ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive")
+
+
+class detectionStore:
+    """
+    Class for appending to and querying the on disk detection history.
+
+    Every append writes one parquet file per day touched, under <path>/day=YYYY-MM-DD/. Days that collect more
+    than max_files files are compacted into a single file. Reads only open the partitions and row groups that
+    can match the time and lat/lon predicates.
+    """
+
+    def __init__(self, path="store", max_files=32):
+        """
+        Class constructor.
+
+        :param path: Directory the parquet partitions are written to.
+        :param max_files: Number of files a day partition can have before it is compacted.
+        """
+        self.path = path
+        self.max_files = max_files
+        os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return self.dataset().count_rows() if self.days() else 0
+
+    def days(self):
+        """
+        :return: Sorted list of the day partitions in the store, as YYYY-MM-DD strings.
+        """
+        return sorted(name[4:] for name in os.listdir(self.path) if name.startswith("day="))
+
+    def parts(self, day):
+        """
+        :param day: Day partition, as a YYYY-MM-DD string.
+        :return: Sorted list of the parquet file paths of the partition.
+        """
+        directory = os.path.join(self.path, "day={}".format(day))
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("part-"))
+
+    def files(self):
+        """
+        :return: List of the parquet file paths of all the partitions, in day order.
+        """
+        return [part for day in self.days() for part in self.parts(day)]
+
+    def dataset(self, files=None):
+        """
+        :param files: Optional list of parquet file paths to restrict the dataset to.
+        :return: pyarrow dataset over all the partitions. Nothing is read until it is scanned.
+        """
+        if files is not None:
+            return ds.dataset(files, format="parquet", partitioning=PARTITIONING, partition_base_dir=self.path)
+        return ds.dataset(self.path, format="parquet", partitioning=PARTITIONING)
+
+    def append(self, frame):
+        """
+        Appends detections to the store.
+
+        :param frame: Dataframe with a timezone aware "timestamp" column.
+        """
+        if len(frame) == 0:
+            return
+        days = frame["timestamp"].dt.strftime("%Y-%m-%d")
+        for day, rows in frame.groupby(days, sort=True):
+            directory = os.path.join(self.path, "day={}".format(day))
+            os.makedirs(directory, exist_ok=True)
+            self._write(pa.Table.from_pandas(rows.sort_values("timestamp"), preserve_index=False), directory)
+            if len(self.parts(day)) > self.max_files:
+                self.compact(day)
+
+    def compact(self, day):
+        """
+        Rewrites the files of a day partition as a single file.
+
+        :param day: Day partition, as a YYYY-MM-DD string.
+        """
+        directory = os.path.join(self.path, "day={}".format(day))
+        parts = self.parts(day)
+        table = pa.concat_tables([pq.read_table(part) for part in parts])
+        self._write(table.sort_by("timestamp"), directory)
+        for part in parts:
+            os.remove(part)
+
+    def read(self, start=None, end=None, lat=None, lon=None, columns=None, files=None):
+        """
+        Reads detections, pushing the predicates down to the partitions and parquet row group statistics.
+
+        :param start: Optional timezone aware datetime, only detections at or after it are read.
+        :param end: Optional timezone aware datetime, only detections before it are read.
+        :param lat: Optional (min, max) latitude range, inclusive.
+        :param lon: Optional (min, max) longitude range, inclusive.
+        :param columns: Optional list of columns to read.
+        :param files: Optional list of parquet file paths to read, from files(). All the partitions by default.
+        :return: Dataframe of the matching detections in time order.
+        """
+        if not (self.days() if files is None else files):
+            return pd.DataFrame(columns=columns)
+        conditions = []
+        if start is not None:
+            conditions.append(ds.field("day") >= start.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d"))
+            conditions.append(ds.field("timestamp") >= pa.scalar(start, pa.timestamp("us", tz="UTC")))
+        if end is not None:
+            conditions.append(ds.field("day") <= end.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d"))
+            conditions.append(ds.field("timestamp") < pa.scalar(end, pa.timestamp("us", tz="UTC")))
+        for field, bounds in (("lat", lat), ("lon", lon)):
+            if bounds is not None:
+                conditions.append((ds.field(field) >= bounds[0]) & (ds.field(field) <= bounds[1]))
+        condition = None
+        for c in conditions:
+            condition = c if condition is None else condition & c
+        table = self.dataset(files).to_table(columns=columns, filter=condition)
+        frame = table.to_pandas()
+        if "timestamp" in frame:
+            frame = frame.sort_values("timestamp", kind="stable").reset_index(drop=True)
+        return frame.drop(columns=["day"], errors="ignore")
+
+    def _write(self, table, directory):
+        """
+        Writes a table as a new file of a partition, through a temporary file so readers never see a partial file.
+        Dataset discovery skips names starting with a dot, so the temporary file is never scanned.
+
+        :param table: pyarrow table.
+        :param directory: Partition directory.
+        """
+        name = "part-{:020d}-{}.parquet".format(time.time_ns(), os.getpid())
+        tmp = os.path.join(directory, "." + name)
+        pq.write_table(table, tmp)
+        os.replace(tmp, os.path.join(directory, name))
@@ -0,0 +1,79 @@
+"""
+Author: David Jorge
+
+Tests of the NumPy RK4 advection engine against analytic trajectories.
+
+Usage: python -m pytest test_advection.py
+"""
+
+import numpy as np
+import xarray as xr
+import advection
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def field(u, v, days=2):
+    """
+    Builds a velocityField uniform in space, with one time step per day.
+
+    :param u: Eastward velocity in m/s, or list of one velocity per day.
+    :param v: Northward velocity in m/s, or list of one velocity per day.
+    :param days: Number of days of the field.
+    :return: velocityField.
+    """
+    lat = np.arange(30.0, 60.5, 0.5)
+    lon = np.arange(-40.0, 0.5, 0.5)
+    time = np.datetime64("2021-09-01") + np.arange(days) * np.timedelta64(1, "D")
+    shape = (days, len(lat), len(lon))
+    data = xr.Dataset({"u": (("time", "latitude", "longitude"), np.ones(shape) * np.reshape(u, (-1, 1, 1))),
+                       "v": (("time", "latitude", "longitude"), np.ones(shape) * np.reshape(v, (-1, 1, 1)))},
+                      coords={"time": time, "latitude": lat, "longitude": lon})
+    return advection.velocityField(data, {"U": "u", "V": "v"},
+                                   {"lat": "latitude", "lon": "longitude", "time": "time"}, time[0])
+
+
+def test_uniform_field():
+    lats = np.array([40.0, 50.0, 55.0])
+    lons = np.array([-30.0, -20.0, -10.0])
+    clocks, released, lat, lon = advection.integrateRK4(field(0.5, 0.0), lats, lons, np.zeros(3), DAY)
+    assert np.array_equal(clocks, np.arange(0, DAY + 1, HOUR))
+    assert released.all()
+    # Due east along a parallel, the longitude speed is u / (metres per degree * cos(lat))
+    expected = lons[:, None] + 0.5 * clocks / (advection.METRES_PER_DEGREE * np.cos(np.radians(lats[:, None])))
+    assert np.allclose(lat, lats[:, None])
+    assert np.allclose(lon, expected, atol=1e-5)
+
+    clocks, released, lat, lon = advection.integrateRK4(field(0.0, -0.25), lats, lons, np.zeros(3), DAY)
+    assert np.allclose(lat, lats[:, None] - 0.25 * clocks / advection.METRES_PER_DEGREE, atol=1e-5)
+    assert np.allclose(lon, lons[:, None])
+
+
+def test_field_linear_in_time():
+    # v grows from 0 to 1 m/s over the day, RK4 integrates it exactly: lat(t) = lat0 + t^2 / (2 day) / metres
+    clocks, released, lat, lon = advection.integrateRK4(field(0.0, [0.0, 1.0]), [45.0], [-20.0], [0], DAY, dt=1000)
+    assert clocks[-1] == DAY
+    assert np.allclose(lat[0], 45.0 + clocks ** 2 / (2 * DAY) / advection.METRES_PER_DEGREE, atol=1e-5)
+
+
+def test_late_release():
+    velocity = field(0.0, 1.0)
+    clocks, released, lat, lon = advection.integrateRK4(velocity, [45.0, 45.0], [-20.0, -20.0], [0, 3 * HOUR],
+                                                        6 * HOUR)
+    assert released.tolist() == [[True] * 7, [False] * 3 + [True] * 4]
+    # The late particle waits at its release position, then drifts the same way three hours behind
+    assert np.allclose(lat[1, :4], 45.0)
+    assert np.allclose(lat[1, 3:], lat[0, :4], atol=1e-5)
+
+    trajectories = advection.advectRK4(velocity, [45.0, 45.0], [-20.0, -20.0], [0, 3 * HOUR], 6 * HOUR)
+    assert [len(seconds) for seconds, _, _ in trajectories] == [7, 4]
+    assert trajectories[1][0][0] == 3 * HOUR
+    assert np.array_equal(trajectories[1][1], lat[1, 3:])
+
+
+def test_off_step_end():
+    # An end time off the output grid is still recorded, after a shorter last step
+    clocks, released, lat, lon = advection.integrateRK4(field(0.0, 1.0), [45.0], [-20.0], [0], HOUR + 100)
+    assert clocks.tolist() == [0, HOUR, HOUR + 100]
+    assert np.isclose(lat[0, -1], 45.0 + (HOUR + 100) / advection.METRES_PER_DEGREE, atol=1e-5)
@@ -0,0 +1,70 @@
+"""
+Author: David Jorge
+
+Tests of the zoom dependent grid aggregation of the map detections.
+
+Usage: python -m pytest test_aggregation.py
+"""
+
+import numpy as np
+import pandas as pd
+import aggregation
+
+
+def detections(lats, lons, clusters=None):
+    """
+    :return: Detections dataframe in the map_data schema, in time order.
+    """
+    n = len(lats)
+    frame = pd.DataFrame({"lat": lats, "lon": lons,
+                          "Number of Clusters": np.ones(n) if clusters is None else clusters,
+                          "Date": ["2021-09-01-00-00-{:02d}".format(i) for i in range(n)]})
+    for col in aggregation.SENSOR_COLUMNS:
+        frame[col] = np.arange(n, dtype=np.float64)
+    return frame
+
+
+def test_cell_size_halves_per_zoom():
+    assert aggregation.cellSize(0) == 360.0 / 16
+    assert [aggregation.cellSize(z) / aggregation.cellSize(z + 1) for z in range(5)] == [2.0] * 5
+
+
+def test_grid_aggregate():
+    data = detections([10.1, 10.9, 10.5, -5.0, np.nan], [20.2, 20.8, 21.5, -5.0, 0.0], [1, 3, 2, 4, 9])
+    cells = aggregation.gridAggregate(data, 1.0).sort_values(["lat", "lon"]).reset_index(drop=True)
+    assert cells["Detections"].tolist() == [1, 2, 1]
+    assert np.allclose(cells["lat"], [-5.0, 10.5, 10.5])
+    assert np.allclose(cells["lon"], [-5.0, 20.5, 21.5])
+    assert np.allclose(cells["Number of Clusters"], [4, 2, 2])
+    assert np.allclose(cells["temp"], [3, 0.5, 2])
+    # The latest detection of the cell, the rows being in time order
+    assert cells["Date"].tolist()[1] == "2021-09-01-00-00-01"
+    assert cells["Detections"].sum() == 4
+
+    # Every detection lands in exactly one cell at any zoom
+    rng = np.random.default_rng(0)
+    data = detections(rng.uniform(-80, 80, 2000), rng.uniform(-180, 180, 2000))
+    for zoom in range(0, 10, 3):
+        cells = aggregation.gridAggregate(data, aggregation.cellSize(zoom))
+        assert cells["Detections"].sum() == 2000
+    assert len(aggregation.gridAggregate(data.iloc[:0], 1.0)) == 0
+
+
+def test_in_bounds_across_antimeridian():
+    cells = pd.DataFrame({"lat": [0.0, 0.0, 0.0, 50.0], "lon": [179.0, -179.0, 0.0, 179.5]})
+    view = aggregation.inBounds(cells, (170, -10, -170, 10), margin=0)
+    assert view["lon"].tolist() == [179.0, -179.0]
+    assert len(aggregation.inBounds(cells, None)) == 4
+    # A view wider than the world after the margin keeps every longitude
+    assert len(aggregation.inBounds(cells, (-180, -20, 180, 20))) == 3
+
+
+def test_aggregations_cached_per_version_and_zoom():
+    aggregator = aggregation.spatialAggregator(cacheSize=2)
+    data = detections([10.1, 10.9], [20.2, 20.8])
+    first = aggregator.view(1, data, 3.7)
+    assert aggregator.view(1, data, 3.2) is first
+    assert list(aggregator.cache) == [(1, 3)]
+    aggregator.view(2, data, 3.2)
+    aggregator.view(2, data, 30)
+    assert list(aggregator.cache) == [(2, 3), (2, 18)]
@@ -0,0 +1,126 @@
+"""
+Author: David Jorge
+
+Tests of the dashboard callbacks and routes, with the background worker left stopped.
+
+Usage: python -m pytest test_app.py
+"""
+
+import datetime
+import importlib
+import io
+import pandas as pd
+import pytest
+from moto import mock_aws
+from PIL import Image
+import detections
+import snapshots
+import worker
+
+UTC = datetime.timezone.utc
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    """
+    Imports the dashboard in an empty working directory, without starting the ingestion worker.
+    """
+    directory = tmp_path_factory.mktemp("dashboard")
+    (directory / ".mapbox_token").write_text("token")
+    with pytest.MonkeyPatch.context() as patch, mock_aws():
+        patch.chdir(directory)
+        patch.setenv("FORECAST_BACKEND", "numpy")
+        patch.setattr(worker.ingestionWorker, "start", lambda self: None)
+        yield importlib.import_module("app")
+
+
+def jpeg():
+    """
+    :return: Bytes of a flat red JPEG.
+    """
+    out = io.BytesIO()
+    Image.new("RGB", (64, 48), "red").save(out, "JPEG")
+    return out.getvalue()
+
+
+def hours(*offsets):
+    """
+    :return: Series of datetimes the given numbers of hours after 2021-09-01.
+    """
+    start = datetime.datetime(2021, 9, 1, tzinfo=UTC)
+    return pd.Series([start + datetime.timedelta(hours=h) for h in offsets])
+
+
+def published(histogram, version):
+    """
+    :return: Worker results holding the hourly series of the histogram at its current revision.
+    """
+    return worker.results(version, None, histogram.toFrame(), None, 0, (histogram.id, histogram.revision), False)
+
+
+def applyPatch(figure, patch):
+    """
+    Applies the operations of a dash.Patch to a figure dictionary, as the browser does.
+    """
+    for operation in patch.to_plotly_json()["operations"]:
+        *path, last = operation["location"]
+        target = figure
+        for key in path:
+            target = target[key]
+        if operation["operation"] == "Insert":
+            target[last].insert(operation["params"]["index"], operation["params"]["value"])
+        else:
+            assert operation["operation"] == "Assign"
+            target[last] = operation["params"]["value"]
+    return figure
+
+
+def bars(figure):
+    """
+    :return: (dates, counts) lists of the hourly bar graph.
+    """
+    trace = figure["data"][0]
+    return pd.to_datetime(list(trace["x"]), utc=True).tolist(), [int(y) for y in trace["y"]]
+
+
+def test_hourly_patch(app, monkeypatch):
+    histogram = detections.timeHistogram()
+    monkeypatch.setattr(app.aws, "histogram", histogram)
+    histogram.addMany(hours(*range(0, 20, 2)))
+    shown = published(histogram, 1)
+    figure = app.hourlyFigure(shown.hourly)
+    figure["data"][0]["x"] = list(figure["data"][0]["x"])
+    figure["data"][0]["y"] = list(figure["data"][0]["y"])
+
+    # One bucket inserted between existing ones, one updated and one appended
+    histogram.addMany(hours(3, 4, 4))
+    histogram.add(hours(25)[0].to_pydatetime())
+    latest = published(histogram, 2)
+    patch = app.hourlyPatch(latest, list(shown.hourlyRevision))
+    assert len(patch.to_plotly_json()["operations"]) == 5
+    assert bars(applyPatch(figure, patch)) == bars(app.hourlyFigure(latest.hourly))
+
+    # Clients of another histogram, or too far behind, get the whole figure
+    assert app.hourlyPatch(latest, ["other", 1]) is None
+    assert app.hourlyPatch(latest, None) is None
+    histogram.addMany(hours(*range(31, 60, 2)))
+    assert app.hourlyPatch(published(histogram, 3), list(shown.hourlyRevision)) is None
+
+
+def test_snapshot_revalidation(app, monkeypatch, tmp_path):
+    store = snapshots.snapshotStore(str(tmp_path))
+    store.save([("dev-1", jpeg())])
+    monkeypatch.setattr(app.aws, "snapshots", store)
+    client = app.server.test_client()
+    for url in ("/snapshots/dev-1.jpg", "/snapshots/thumbs/dev-1.jpg"):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == "image/jpeg"
+        assert "immutable" in response.headers["Cache-Control"]
+        etag = response.headers["ETag"]
+        # A browser revalidating with the ETag gets an empty 304 instead of the image
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+        assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+    assert client.get("/snapshots/dev-2.jpg").status_code == 404
@@ -0,0 +1,64 @@
+"""
+Author: David Jorge
+
+Tests of the local cache of raw bucket entries.
+
+Usage: python -m pytest test_chunkcache.py
+"""
+
+import datetime
+import os
+import chunkcache
+
+WHEN = datetime.datetime(2021, 9, 1, tzinfo=datetime.timezone.utc)
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = chunkcache.chunkCache(str(tmp_path), max_bytes=300)
+    for key in "abc":
+        cache.put(key, "etag-" + key, WHEN, key.encode() * 100)
+    # Reading a refreshes it, so b is the least recently used entry when d goes over the cap
+    assert cache.get("a", "etag-a") == b"a" * 100
+    cache.put("d", "etag-d", WHEN, b"d" * 100)
+    assert cache.get("b", "etag-b") is None
+    assert [cache.get(key, "etag-" + key) is not None for key in "acd"] == [True, True, True]
+    assert cache.bytes == cache.size() == 300
+
+    # The recency survives a restart
+    cache = chunkcache.chunkCache(str(tmp_path), max_bytes=300)
+    cache.get("c", "etag-c")
+    cache.get("d", "etag-d")
+    cache.put("e", "etag-e", WHEN, b"e" * 100)
+    assert [obj.key for obj in cache.listObjects()] == ["c", "d", "e"]
+
+
+def test_identical_bodies_stored_once(tmp_path):
+    cache = chunkcache.chunkCache(str(tmp_path))
+    cache.put("dev/1", "x", WHEN, b"{Image End}")
+    cache.put("dev/2", "x", WHEN, b"{Image End}")
+    assert cache.bytes == len(b"{Image End}")
+    blobs = [name for directory, _, names in os.walk(str(tmp_path)) for name in names if len(name) == 64]
+    assert len(blobs) == 1
+    cache.put("dev/1", "y", WHEN, b"other")
+    assert cache.get("dev/1", "x") is None
+    assert cache.get("dev/2", "x") == b"{Image End}"
+
+
+def test_corrupt_body_dropped(tmp_path):
+    cache = chunkcache.chunkCache(str(tmp_path))
+    cache.put("dev/1", "x", WHEN, b"0123abcd")
+    digest = cache.db.execute("SELECT digest FROM entries WHERE key = 'dev/1'").fetchone()[0]
+    with open(cache.blobPath(digest), "wb") as f:
+        f.write(b"0123abce")
+    assert cache.get("dev/1", "x") is None
+    assert cache.listObjects() == []
+    assert cache.bytes == 0
+
+
+def test_list_objects(tmp_path):
+    cache = chunkcache.chunkCache(str(tmp_path))
+    for key in ("dev2/1", "dev1/2", "dev1/1"):
+        cache.put(key, "etag", WHEN, key.encode())
+    assert [obj.key for obj in cache.listObjects()] == ["dev1/1", "dev1/2", "dev2/1"]
+    assert [obj.key for obj in cache.listObjects(after="dev1/2")] == ["dev2/1"]
+    assert cache.listObjects()[0].last_modified == WHEN
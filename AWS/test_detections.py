@@ -0,0 +1,52 @@
+"""
+Author: David Jorge
+
+Tests of the in-memory detection structures.
+
+Usage: python -m pytest test_detections.py
+"""
+
+import datetime
+import pandas as pd
+import detections
+
+UTC = datetime.timezone.utc
+HOUR = 60 * 60
+
+
+def hour(h):
+    """
+    :return: Datetime h hours after 2021-09-01.
+    """
+    return datetime.datetime(2021, 9, 1, tzinfo=UTC) + datetime.timedelta(hours=h)
+
+
+def bucket(h):
+    """
+    :return: Hourly bucket number of hour(h).
+    """
+    return int(hour(h).timestamp()) // HOUR
+
+
+def test_changed_since():
+    histogram = detections.timeHistogram()
+    histogram.addMany(pd.Series([hour(0), hour(0), hour(2)]))
+    histogram.add(hour(2))
+    histogram.add(hour(1))
+    assert histogram.revision == 3
+    assert histogram.changedSince(1, 3) == [(bucket(1), True), (bucket(2), False)]
+    assert histogram.changedSince(0, 3) == [(bucket(0), True), (bucket(1), True), (bucket(2), True)]
+    assert histogram.changedSince(1, 2) == [(bucket(2), False)]
+    assert histogram.changedSince(3, 3) == []
+    assert histogram.toFrame()["Count"].tolist() == [2, 1, 2]
+
+
+def test_changed_since_past_the_log():
+    histogram = detections.timeHistogram(logSize=2)
+    for h in range(4):
+        histogram.add(hour(h))
+    # Revisions 3 and 4 are logged, a client at revision 1 misses revision 2 and needs the whole series
+    assert histogram.changedSince(1, 4) is None
+    assert histogram.changedSince(None, 4) is None
+    assert histogram.changedSince(2, 4) == [(bucket(2), True), (bucket(3), True)]
+    assert histogram.changedSince(4, 4) == []
@@ -0,0 +1,55 @@
+"""
+Author: David Jorge
+
+Tests of the ensemble forecast reproducibility.
+
+Usage: python -m pytest test_ensemble.py
+"""
+
+import numpy as np
+import xarray as xr
+import ensemble
+
+DIMENSIONS = {"lat": "latitude", "lon": "longitude", "time": "time"}
+
+
+def currents():
+    """
+    :return: Two day xarray Dataset of a uniform north eastward current.
+    """
+    lat = np.arange(40.0, 50.5, 0.5)
+    lon = np.arange(-30.0, -19.5, 0.5)
+    time = np.datetime64("2021-09-01") + np.arange(2) * np.timedelta64(1, "D")
+    shape = (len(time), len(lat), len(lon))
+    return xr.Dataset({"u": (("time", "latitude", "longitude"), np.full(shape, 0.2)),
+                       "v": (("time", "latitude", "longitude"), np.full(shape, 0.1))},
+                      coords={"time": time, "latitude": lat, "longitude": lon})
+
+
+def run(**kwargs):
+    """
+    :return: ensembleReduction of 7 members of two detections, with 2 members per batch unless told otherwise.
+    """
+    data = currents()
+    options = {"members": 7, "processes": 1, "seed": 0, "dt": 3600, "outputdt": 6 * 3600, "batch": 4}
+    options.update(kwargs)
+    return ensemble.runEnsemble(data, {"U": "u", "V": "v"}, DIMENSIONS, data["time"].values[0],
+                                np.array([44.0, 46.0]), np.array([-26.0, -24.0]), 1, (-30, 40, -20, 50), **options)
+
+
+def fields(reduction):
+    """
+    :return: Tuple of the accumulated arrays of a reduction.
+    """
+    return reduction.counts, reduction.n, reduction.sum, reduction.sumsq
+
+
+def test_same_ensemble_on_any_number_of_processes():
+    reference = run()
+    assert reference.members == 7
+    assert reference.counts.sum() == 7 * 2 * len(reference.clocks)
+    for processes in (2, 3):
+        assert all(np.array_equal(a, b) for a, b in zip(fields(run(processes=processes)), fields(reference)))
+    # Members draw from their own generators, so the batch size only changes the summation order
+    assert all(np.allclose(a, b) for a, b in zip(fields(run(batch=2)), fields(reference)))
+    assert not np.allclose(run(seed=1).sum, reference.sum)
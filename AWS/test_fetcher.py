@@ -0,0 +1,90 @@
+"""
+Author: David Jorge
+
+Tests of the concurrent chunk downloads, on a stand-in for the boto3 client.
+
+Usage: python -m pytest test_fetcher.py
+"""
+
+import datetime
+import io
+import random
+import threading
+import time
+import pytest
+from botocore.exceptions import ClientError
+import chunkcache
+import fetcher
+
+
+class fakeObject:
+    """
+    Stand-in for a boto3 object summary.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.e_tag = '"{}"'.format(key)
+        self.last_modified = datetime.datetime(2021, 9, 1, tzinfo=datetime.timezone.utc)
+
+
+class fakeClient:
+    """
+    Stand-in for the boto3 S3 client, answering get_object after a random delay, with the key as the body.
+    """
+
+    def __init__(self, failures=0):
+        """
+        :param failures: Number of get_object calls of every key that fail before one succeeds.
+        """
+        self.failures = failures
+        self.calls = {}
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            self.calls[Key] = self.calls.get(Key, 0) + 1
+            failed = self.calls[Key] <= self.failures
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        time.sleep(random.uniform(0, 0.005))
+        with self.lock:
+            self.inFlight -= 1
+        if failed:
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "GetObject")
+        return {"Body": io.BytesIO(Key.encode())}
+
+
+def test_bodies_in_listing_order():
+    client = fakeClient()
+    objects = [fakeObject("dev/{:013d}".format(i)) for i in range(200)]
+    chunks = fetcher.chunkFetcher(client, "bucket", concurrency=8)
+    fetched = list(chunks.iterBodies(iter(objects)))
+    assert [obj.key for obj, body in fetched] == [obj.key for obj in objects]
+    assert all(body == obj.key.encode() for obj, body in fetched)
+    assert all(count == 1 for count in client.calls.values())
+    assert 1 < client.maxInFlight <= 8
+
+
+def test_retries():
+    client = fakeClient(failures=2)
+    chunks = fetcher.chunkFetcher(client, "bucket", concurrency=4, retries=2, backoff=0)
+    assert chunks.fetch(fakeObject("a")) == b"a"
+    assert client.calls["a"] == 3
+
+    chunks = fetcher.chunkFetcher(fakeClient(failures=3), "bucket", retries=2, backoff=0)
+    with pytest.raises(ClientError):
+        chunks.fetch(fakeObject("a"))
+
+
+def test_cache_hits_skip_downloads(tmp_path):
+    cache = chunkcache.chunkCache(str(tmp_path))
+    client = fakeClient()
+    objects = [fakeObject(key) for key in "abc"]
+    assert [body for obj, body in fetcher.chunkFetcher(client, "bucket", cache=cache).iterBodies(objects)] == \
+        [b"a", b"b", b"c"]
+    assert [body for obj, body in fetcher.chunkFetcher(client, "bucket", cache=cache).iterBodies(objects)] == \
+        [b"a", b"b", b"c"]
+    assert client.calls == {"a": 1, "b": 1, "c": 1}
@@ -0,0 +1,88 @@
+"""
+Author: David Jorge
+
+Smoke tests of the drift forecasts on small synthetic current files.
+
+Usage: python -m pytest test_forecasting.py
+"""
+
+import gzip
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import advection
+import forecasting
+
+
+def currents(directory, u=0.5, v=0.0, days=4):
+    """
+    Writes OSCAR shaped U and V files of a uniform current, under the names the forecasting class opens.
+
+    :param directory: Directory the files are written to.
+    :param u: Eastward current in metres per second.
+    :param v: Northward current in metres per second.
+    :param days: Number of days the files cover.
+    """
+    lat = np.arange(60, 39.9, -1 / 3)
+    lon = np.arange(-30, 0.1, 1 / 3)
+    times = pd.date_range("2021-01-01", periods=days + 1, freq="1D")
+    for name, var, speed in (("U", "u", u), ("V", "v", v)):
+        data = np.full((len(times), 1, len(lat), len(lon)), speed, dtype=np.float32)
+        xr.Dataset({var: (("time", "depth", "latitude", "longitude"), data)},
+                   coords={"time": times, "depth": [15.0], "latitude": lat,
+                           "longitude": lon}).to_netcdf(directory / "ocean_currents_{}.nc".format(name))
+
+
+@pytest.mark.parametrize("backend", ["numpy", "parcels"])
+def test_forecast_backend(backend, tmp_path, monkeypatch):
+    if backend == "parcels":
+        pytest.importorskip("parcels")
+    monkeypatch.chdir(tmp_path)
+    currents(tmp_path)
+    fc = forecasting.forecasting([50.0, 52.0], [-20.0, -15.0], str(tmp_path / "sim.nc"), ["a", "b"], backend=backend)
+    fc.run_forecasting(days=1)
+
+    with xr.open_dataset(tmp_path / "sim.nc") as ds:
+        assert [str(d) for d in ds["detection"].values] == ["a", "b"]
+        lon = ds["lon"].values
+        time = ds["time"].values
+    # One day at 0.5 m/s eastward, with hourly positions
+    assert (np.isfinite(lon).sum(axis=1) >= 24).all()
+    drift = (lon[:, 1:].max(axis=1) - lon[:, 0]) * advection.METRES_PER_DEGREE * np.cos(np.radians([50.0, 52.0]))
+    assert np.allclose(drift, 0.5 * 24 * 60 * 60, rtol=0.02)
+    assert (np.nanmax(time, axis=1) == np.datetime64("2021-01-02")).all()
+
+    # A second run only extends the trajectories, which already reach the horizon
+    fc.update_particles([50.0, 52.0, 45.0], [-20.0, -15.0, -25.0], ["a", "b", "c"])
+    fc.run_forecasting(days=1)
+    with xr.open_dataset(tmp_path / "sim.nc") as ds:
+        assert [str(d) for d in ds["detection"].values] == ["a", "b", "c"]
+        assert np.allclose(ds["lon"].values[:2, :lon.shape[1]], lon, equal_nan=True)
+
+
+def test_export(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    currents(tmp_path)
+    fc = forecasting.forecasting([50.0], [-20.0], str(tmp_path / "sim.nc"), ["a"], backend="numpy")
+    fc.run_forecasting(days=1)
+    fc.export_sim(str(tmp_path / "forecast.json.gz"))
+    with gzip.open(tmp_path / "forecast.json.gz") as f:
+        payload = json.load(f)
+    assert payload["start"] == "2021-01-01T00:00:00Z"
+    assert len(payload["offsets"]) == 25
+    assert payload["lat"][0] == 50000 and payload["lon"][0] == -20000
+
+
+def test_export_without_particles(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    currents(tmp_path)
+    fc = forecasting.forecasting([], [], str(tmp_path / "sim.nc"), [], backend="numpy")
+    fc.run_forecasting(days=1)
+    fc.export_sim(str(tmp_path / "forecast.json.gz"))
+    with gzip.open(tmp_path / "forecast.json.gz") as f:
+        payload = json.load(f)
+    assert payload["start"] is None
+    assert payload["offsets"] == [0]
+    assert payload["lat"] == payload["lon"] == []
@@ -0,0 +1,206 @@
+"""
+Author: David Jorge
+
+Tests of the incremental pull and the image reassembly against moto's local S3 stand-in.
+
+Usage: python -m pytest test_pullS3.py
+"""
+
+import binascii
+import io
+import shutil
+import time
+import boto3
+import pytest
+from moto import mock_aws
+from PIL import Image
+import pullS3
+
+BUCKET = "oceanpollution"
+
+# Chunk size of the hex strings sent by the drones
+CHUNK = 5120
+
+
+def jpeg(colour, size=(64, 48)):
+    """
+    :return: Bytes of a flat coloured JPEG, whose hex string has runs of identical chunks.
+    """
+    out = io.BytesIO()
+    Image.new("RGB", size, colour).save(out, "JPEG")
+    return out.getvalue()
+
+
+def entry(image, clusters=1, offsets=False):
+    """
+    :param image: JPEG bytes.
+    :param clusters: Number of clusters in the header.
+    :param offsets: Flags whether the chunks carry their byte offset, as sent by current firmware.
+    :return: List of the bodies of one entry, as the drones send them.
+    """
+    data = binascii.hexlify(image)
+    parts = [b"{Image Start,53.1,-24.2,%d,[10-00-00_01-01-21, 20.1, 50.2, 1000.3, 1.0, 2.0, 3.0]}" % clusters]
+    for i in range(0, len(data), CHUNK):
+        parts.append((b"%d:" % (i // 2) if offsets else b"") + data[i:i + CHUNK])
+    return parts + [b"{Image End}"]
+
+
+def upload(client, prefix, first, image, clusters=1, offsets=False):
+    """
+    Uploads one entry as the drones do, one object per line, under consecutive numbered keys.
+
+    :param client: boto3 S3 client.
+    :param prefix: Device key prefix, empty for none.
+    :param first: Number of the first key.
+    :param image: JPEG bytes.
+    :param clusters: Number of clusters in the header.
+    :param offsets: Flags whether the chunks carry their byte offset.
+    :return: Number of the key after the entry.
+    """
+    parts = entry(image, clusters, offsets)
+    for n, body in enumerate(parts, first):
+        client.put_object(Bucket=BUCKET, Key="{}{:013d}".format(prefix, n), Body=body)
+    return first + len(parts)
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        yield client
+
+
+def puller(path, **kwargs):
+    """
+    :param path: Directory the pull state is kept in.
+    :param kwargs: Other pullS3 keyword arguments.
+    :return: Incremental pullS3 keeping all of its state under the directory.
+    """
+    options = dict(incremental=True, cursor_path=str(path / "cursor.json"), cache_dir=None,
+                   index_path=str(path / "processed.sqlite"), store_path=str(path / "store"),
+                   snapshot_path=str(path / "snapshots"))
+    options.update(kwargs)
+    return pullS3.pullS3(**options)
+
+
+def test_incremental_pull_per_device(s3, tmp_path):
+    dev1 = upload(s3, "dev1/", 0, jpeg("red"))
+    upload(s3, "dev2/", 0, jpeg("blue"))
+    aws = puller(tmp_path)
+    assert aws.pull() == 2
+
+    # A key of dev1 sorts before the last key pulled from dev2
+    upload(s3, "dev1/", dev1, jpeg("green"))
+    assert aws.pull() == 1
+    assert aws.pull() == 0
+
+    restarted = puller(tmp_path)
+    assert restarted.pull() == 0
+    assert len(restarted.map_data) == 3
+
+
+def test_session_resumed_across_restart(s3, tmp_path):
+    image = jpeg("red")
+    data = binascii.hexlify(image)
+    header = b"{Image Start,53.1,-24.2,2,[10-00-00_01-01-21, 20.1, 50.2, 1000.3, 1.0, 2.0, 3.0]}"
+    s3.put_object(Bucket=BUCKET, Key="dev1/0000000000000", Body=header)
+    s3.put_object(Bucket=BUCKET, Key="dev1/0000000000001", Body=data)
+    upload(s3, "dev2/", 0, jpeg("blue"))
+    assert puller(tmp_path).pull() == 1
+
+    # The end of the dev1 upload arrives while no process is pulling
+    s3.put_object(Bucket=BUCKET, Key="dev1/0000000000002", Body=b"{Image End}")
+    aws = puller(tmp_path)
+    assert aws.pull() == 1
+    assert sorted(aws.store.read()["device"]) == ["dev1", "dev2"]
+
+
+def test_dead_upload_releases_cursor(s3, tmp_path):
+    header = b"{Image Start,53.1,-24.2,2,[10-00-00_01-01-21, 20.1, 50.2, 1000.3, 1.0, 2.0, 3.0]}"
+    s3.put_object(Bucket=BUCKET, Key="dev1/0000000000000", Body=header)
+    s3.put_object(Bucket=BUCKET, Key="dev1/0000000000001", Body=binascii.hexlify(jpeg("red")))
+    upload(s3, "dev2/", 0, jpeg("blue"))
+    # dev1 never sends the end of its image, and no other dev1 entry comes after it
+    aws = puller(tmp_path, session_timeout=0)
+    assert aws.pull() == 1
+    assert aws.reassembler.expired == 1
+    assert aws.cursor["dev1"] == "dev1/0000000000001"
+
+    fetched = []
+    fetch = aws.fetcher.fetch
+    aws.fetcher.fetch = lambda obj: fetched.append(obj.key) or fetch(obj)
+    assert aws.pull() == 0
+    assert fetched == []
+
+
+def test_most_recent_is_newest_upload(s3, tmp_path):
+    upload(s3, "dev2/", 0, jpeg("blue"))
+    # LastModified has a resolution of one second
+    time.sleep(1.1)
+    upload(s3, "dev1/", 0, jpeg("red"))
+    aws = puller(tmp_path)
+    assert aws.pull() == 2
+    assert aws.mostRecent.endswith("-dev1")
+    assert aws.snapshots.get(aws.mostRecent)[0] == jpeg("red")
+    assert puller(tmp_path).mostRecent == aws.mostRecent
+
+
+def test_repeated_chunks_are_kept(s3, tmp_path):
+    image = jpeg("white", size=(1296, 972))
+    data = binascii.hexlify(image)
+    chunks = [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+    assert any(a == b for a, b in zip(chunks, chunks[1:]))
+    upload(s3, "dev1/", 0, image)
+    aws = puller(tmp_path)
+    assert aws.pull() == 1
+    assert aws.snapshots.get(aws.mostRecent)[0] == image
+
+
+def test_redelivered_chunk_kept_once(s3, tmp_path):
+    image = jpeg("white", size=(1296, 972))
+    parts = entry(image, offsets=True)
+    # The broker delivers the third chunk again, after the fourth, and the IoT rule writes it under a new key
+    parts.insert(5, parts[3])
+    for n, body in enumerate(parts):
+        s3.put_object(Bucket=BUCKET, Key="dev1/{:013d}".format(n), Body=body)
+    upload(s3, "dev2/", 0, image, offsets=True)
+    aws = puller(tmp_path)
+    assert aws.pull() == 2
+    for name in aws.snapshots.names():
+        assert aws.snapshots.get(name)[0] == image
+
+
+def test_pull_without_prefixes(s3, tmp_path):
+    key = upload(s3, "", 0, jpeg("red"))
+    aws = puller(tmp_path)
+    assert aws.pull() == 1
+    upload(s3, "", key, jpeg("blue"))
+    assert aws.pull() == 1
+    assert puller(tmp_path).pull() == 0
+
+
+def test_store_rebuilt_from_bucket(s3, tmp_path):
+    upload(s3, "dev1/", 0, jpeg("red"))
+    upload(s3, "dev2/", 0, jpeg("blue"))
+    assert puller(tmp_path).pull() == 2
+
+    shutil.rmtree(tmp_path / "store")
+    aws = puller(tmp_path)
+    assert len(aws.map_data) == 0
+    assert aws.pull() == 2
+    assert sorted(aws.store.read()["device"]) == ["dev1", "dev2"]
+    assert puller(tmp_path).pull() == 0
+
+
+def test_offline_pull(s3, tmp_path):
+    upload(s3, "dev1/", 0, jpeg("red"))
+    with pytest.raises(ValueError):
+        puller(tmp_path).pull(offline=True)
+
+    aws = puller(tmp_path, cache_dir=str(tmp_path / "cache"))
+    assert aws.pull() == 1
+    shutil.rmtree(tmp_path / "store")
+    aws = puller(tmp_path, cache_dir=str(tmp_path / "cache"))
+    aws.s3 = None
+    assert aws.pull(offline=True) == 1
@@ -0,0 +1,75 @@
+"""
+Author: David Jorge
+
+Tests of the detection index behind the JSON query endpoint.
+
+Usage: python -m pytest test_query.py
+"""
+
+import numpy as np
+import pandas as pd
+import detections
+import query
+
+
+def frame(lats, lons, minutes, clusters=None):
+    """
+    :param lats: Latitudes of the detections.
+    :param lons: Longitudes of the detections.
+    :param minutes: Minutes after 2021-09-01 each detection was uploaded at.
+    :param clusters: Optional number of clusters of each detection, 1 by default.
+    :return: Detections dataframe in the map_data schema.
+    """
+    n = len(lats)
+    rows = {column: np.zeros(n) for column in query.RESULT_COLUMNS}
+    rows.update({"lat": np.asarray(lats, dtype=np.float64), "lon": np.asarray(lons, dtype=np.float64),
+                 "Number of Clusters": np.ones(n) if clusters is None else np.asarray(clusters, dtype=np.float64),
+                 "timestamp": pd.Timestamp("2021-09-01", tz="UTC") + pd.to_timedelta(minutes, unit="min"),
+                 "start_key": ["dev/{:013d}".format(i) for i in range(n)]})
+    return pd.DataFrame(rows)
+
+
+def test_empty_index():
+    index = query.detectionIndex(pd.DataFrame(columns=detections.FRAME_COLUMNS))
+    assert len(index.query(bbox=(-10, -10, 10, 10))) == 0
+    assert len(index.query()) == 0
+
+    # Detections without a position are never in a box
+    index = query.detectionIndex(frame([np.nan, np.nan], [np.nan, 1.0], [0, 1]))
+    assert len(index.query(bbox=(-180, -90, 180, 90))) == 0
+    assert len(index.query()) == 2
+
+
+def test_box_across_antimeridian():
+    index = query.detectionIndex(frame([0.5, -0.5, 0.0, 5.0], [179.5, -179.5, 0.0, 180.0], [0, 1, 2, 3]))
+    found = index.query(bbox=(170, -10, -170, 10))
+    assert found["lon"].tolist() == [179.5, -179.5, 180.0]
+    assert index.query(bbox=(170, 1, -170, 10))["lon"].tolist() == [180.0]
+
+
+def test_time_range_and_box():
+    rng = np.random.default_rng(0)
+    n = 5000
+    lats = rng.uniform(-60, 60, n)
+    lons = rng.uniform(-180, 180, n)
+    minutes = rng.integers(0, 60 * 24 * 30, n)
+    clusters = rng.integers(1, 10, n)
+    data = frame(lats, lons, minutes, clusters)
+    index = query.detectionIndex(data)
+    times = data["timestamp"]
+    # Small boxes visit their cells, large ones scan the time range, and one crosses the antimeridian
+    for bbox in ((-10, 20, -5, 25), (0, -60, 120, 60), (175, -30, -175, 30)):
+        west, south, east, north = bbox
+        inLon = (lons >= west) & (lons <= east) if west <= east else (lons >= west) | (lons <= east)
+        for start, end in ((None, None), ("2021-09-03", "2021-09-10"), ("2021-09-20", None)):
+            kwargs = {"bbox": bbox, "minClusters": 5}
+            match = (lats >= south) & (lats <= north) & inLon & (clusters >= 5)
+            if start is not None:
+                kwargs["start"] = query.parseTime(start)
+                match &= (times >= kwargs["start"]).to_numpy()
+            if end is not None:
+                kwargs["end"] = query.parseTime(end)
+                match &= (times < kwargs["end"]).to_numpy()
+            found = index.query(**kwargs)
+            assert sorted(found["start_key"]) == sorted(data["start_key"][match])
+            assert found["timestamp"].is_monotonic_increasing
@@ -0,0 +1,60 @@
+"""
+Author: David Jorge
+
+Tests of the snapshot store.
+
+Usage: python -m pytest test_snapshots.py
+"""
+
+import io
+import pytest
+from PIL import Image
+import snapshots
+
+
+def jpeg(colour, size=(64, 48)):
+    """
+    :return: Bytes of a flat coloured JPEG.
+    """
+    out = io.BytesIO()
+    Image.new("RGB", size, colour).save(out, "JPEG")
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("keep, kept", [(2, ["c", "d"]), (0, []), (None, ["a", "b", "c", "d"])])
+def test_keep(tmp_path, keep, kept):
+    store = snapshots.snapshotStore(str(tmp_path), keep=keep)
+    store.save([("a", jpeg("red")), ("b", jpeg("blue"))])
+    store.save([("c", jpeg("green")), ("d", jpeg("white"))])
+    assert store.names() == kept
+    assert [name for name in "abcd" if store.get(name) is not None] == kept
+
+
+def test_negative_keep(tmp_path):
+    with pytest.raises(ValueError):
+        snapshots.snapshotStore(str(tmp_path), keep=-1)
+
+
+def test_memory_cache(tmp_path):
+    store = snapshots.snapshotStore(str(tmp_path), memory=2)
+    store.save([("a", jpeg("red")), ("b", jpeg("blue")), ("c", jpeg("green"))])
+    assert list(store.cache) == [("b", False), ("c", False)]
+    store.get("b")
+    # Cached snapshots are served without touching the disk
+    for name in "bc":
+        (tmp_path / (name + ".jpg")).unlink()
+    assert store.get("b")[0] == jpeg("blue")
+    # Reading a from disk evicts c, the least recently used entry
+    assert store.get("a")[0] == jpeg("red")
+    assert list(store.cache) == [("b", False), ("a", False)]
+    assert store.get("c") is None
+
+
+def test_thumbnail(tmp_path):
+    store = snapshots.snapshotStore(str(tmp_path), thumb_size=(16, 16))
+    store.save([("a", jpeg("red", size=(640, 480)))])
+    data, etag = store.get("a", thumb=True)
+    with Image.open(io.BytesIO(data)) as im:
+        assert im.size == (16, 12)
+    assert etag != store.get("a")[1]
+    assert store.get("../a") is None
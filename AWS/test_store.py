@@ -0,0 +1,74 @@
+"""
+Author: David Jorge
+
+Tests of the parquet detection store.
+
+Usage: python -m pytest test_store.py
+"""
+
+import datetime
+import numpy as np
+import pandas as pd
+import store
+
+UTC = datetime.timezone.utc
+
+
+def detections(days, perDay=24, seed=0):
+    """
+    :param days: Number of days, from 2021-09-01.
+    :param perDay: Number of detections per day, one every 24 / perDay hours.
+    :param seed: Seed of the positions.
+    :return: Dataframe of detections in the store schema.
+    """
+    rng = np.random.default_rng(seed)
+    n = days * perDay
+    return pd.DataFrame({"lat": rng.uniform(40, 60, n), "lon": rng.uniform(-30, 0, n),
+                         "timestamp": pd.date_range("2021-09-01", periods=n, freq="{}min".format(24 * 60 // perDay),
+                                                    tz="UTC"),
+                         "start_key": ["dev/{:013d}".format(i) for i in range(n)]})
+
+
+def test_read_predicates(tmp_path):
+    data = detections(5)
+    parquet = store.detectionStore(str(tmp_path))
+    parquet.append(data.iloc[:50])
+    parquet.append(data.iloc[50:])
+    assert parquet.days() == ["2021-09-0{}".format(d) for d in range(1, 6)]
+    assert len(parquet) == len(data)
+
+    start = datetime.datetime(2021, 9, 2, 6, tzinfo=UTC)
+    end = datetime.datetime(2021, 9, 4, 12, tzinfo=UTC)
+    found = parquet.read(start=start, end=end, lat=(45, 55), lon=(-20, -10))
+    match = ((data["timestamp"] >= start) & (data["timestamp"] < end) & data["lat"].between(45, 55) &
+             data["lon"].between(-20, -10))
+    assert found["start_key"].tolist() == data["start_key"][match].tolist()
+    assert found["timestamp"].is_monotonic_increasing
+    assert "day" not in found
+
+
+def test_partitions_pruned(tmp_path):
+    parquet = store.detectionStore(str(tmp_path))
+    parquet.append(detections(3))
+    # Only the partitions of the time range are opened, a corrupt file outside of it is never read
+    for part in parquet.parts("2021-09-03"):
+        with open(part, "wb") as f:
+            f.write(b"not parquet")
+    found = parquet.read(end=datetime.datetime(2021, 9, 2, 12, tzinfo=UTC), columns=["start_key", "timestamp"])
+    assert len(found) == 36
+
+
+def test_compaction(tmp_path):
+    data = detections(1)
+    parquet = store.detectionStore(str(tmp_path), max_files=3)
+    for i in range(0, 24, 4):
+        parquet.append(data.iloc[i:i + 4])
+    assert len(parquet.parts("2021-09-01")) <= 3
+    assert parquet.read()["start_key"].tolist() == data["start_key"].tolist()
+
+
+def test_empty(tmp_path):
+    parquet = store.detectionStore(str(tmp_path))
+    parquet.append(detections(0))
+    assert len(parquet) == 0
+    assert len(parquet.read(start=datetime.datetime(2021, 9, 1, tzinfo=UTC))) == 0
@@ -0,0 +1,52 @@
+"""
+Author: David Jorge
+
+Tests of the per detection trajectory store and the frame index of trajectory files.
+
+Usage: python -m pytest test_trajectories.py
+"""
+
+import numpy as np
+import trajectories
+
+
+def test_empty_frame_index(tmp_path):
+    path = str(tmp_path / "sim.nc")
+    store = trajectories.trajectoryStore(path)
+    store.reset([])
+    store.save([])
+    frames = trajectories.frameIndex.load(path)
+    assert len(frames) == 0
+    assert frames.offsets.tolist() == [0]
+    assert len(frames.lat) == len(frames.lon) == len(frames.particle) == 0
+
+    # Particles without any observation
+    frames = trajectories.frameIndex(np.full((2, 3), np.datetime64("NaT")), np.zeros((2, 3)), np.zeros((2, 3)))
+    assert len(frames) == 0
+    assert frames.offsets.tolist() == [0]
+
+
+def test_frame_index_matches_per_frame_comparison():
+    start = np.datetime64("2021-09-01T00:00")
+    hours = np.array([[0, 1, 2, 3, 4, 5],
+                      # Released late, with trailing padding
+                      [2, 3, 4, np.nan, np.nan, np.nan],
+                      # Off-step observations are not shown
+                      [0, 0.5, 1, 1.5, 2, 6],
+                      # Observed before the first frame
+                      [-2, -1, 0, 1, np.nan, np.nan]])
+    time = np.where(np.isnan(hours), np.datetime64("NaT"),
+                    start + np.nan_to_num(hours * 60).astype("timedelta64[m]"))
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(40, 50, hours.shape)
+    lon = rng.uniform(-30, -20, hours.shape)
+    frames = trajectories.frameIndex(time, lat, lon)
+    assert len(frames) == 6
+    assert frames.times[0] == start
+    for t, frameTime in enumerate(frames.times):
+        shown = time == frameTime
+        assert np.array_equal(frames.frame(t)[0], lat[shown])
+        assert np.array_equal(frames.frame(t)[1], lon[shown])
+        assert np.array_equal(frames.particles(t), np.nonzero(shown)[0])
+    assert frames.particles(2).tolist() == [0, 1, 2]
+    assert frames.offsets[-1] == 14
@@ -0,0 +1,104 @@
+"""
+Author: David Jorge
+
+Tests of the background ingestion worker, on stand-ins for the pullS3 and forecasting instances.
+
+Usage: python -m pytest test_worker.py
+"""
+
+import threading
+import pandas as pd
+import detections
+import worker
+
+
+class fakePull:
+    """
+    Stand-in for pullS3, every pull finds the given number of new entries.
+    """
+
+    def __init__(self, new=1, gate=None):
+        """
+        :param new: Number of new entries every pull finds.
+        :param gate: Optional threading.Event pulls wait for.
+        """
+        self.new = new
+        self.gate = gate
+        self.started = threading.Event()
+        self.pulls = 0
+        self.map_data = pd.DataFrame(columns=detections.FRAME_COLUMNS)
+        self.hourly = pd.DataFrame(columns=["Date", "Count"])
+        self.mostRecent = None
+        self.histogram = detections.timeHistogram()
+
+    def pull(self):
+        self.pulls += 1
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait()
+        return self.new
+
+
+class fakeForecast:
+    """
+    Stand-in for forecasting, records the steps it is asked to run.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def update_particles(self, lats, lons, ids=None):
+        self.calls.append("update_particles")
+
+    def run_forecasting(self, days):
+        self.calls.append("run_forecasting")
+
+    def export_sim(self):
+        self.calls.append("export_sim")
+
+    def output_sim(self):
+        self.calls.append("output_sim")
+
+
+def test_movie_flag():
+    fc = fakeForecast()
+    assert worker.ingestionWorker(fakePull(), fc).runOnce()
+    assert fc.calls == ["update_particles", "run_forecasting", "export_sim"]
+
+    fc = fakeForecast()
+    ingestion = worker.ingestionWorker(fakePull(), fc, movie=True)
+    assert ingestion.runOnce()
+    assert fc.calls == ["update_particles", "run_forecasting", "export_sim", "output_sim"]
+    assert ingestion.latest().forecastVersion == 1
+
+
+def test_single_flight():
+    gate = threading.Event()
+    aws = fakePull(gate=gate)
+    fc = fakeForecast()
+    ingestion = worker.ingestionWorker(aws, fc)
+    results = []
+    running = threading.Thread(target=lambda: results.append(ingestion.runOnce()))
+    running.start()
+    assert aws.started.wait(5)
+    # A cycle asked for while one is running returns at once instead of overlapping it
+    assert not ingestion.runOnce()
+    gate.set()
+    running.join(5)
+    assert results == [True]
+    assert aws.pulls == 1
+    assert fc.calls.count("run_forecasting") == 1
+    assert ingestion.runOnce()
+    assert aws.pulls == 2
+
+
+def test_versions_published():
+    ingestion = worker.ingestionWorker(fakePull(new=0), fakeForecast())
+    assert ingestion.latest().stale
+    # The first cycle clears the stale flag without a forecast, until one is asked for
+    assert ingestion.runOnce()
+    assert (ingestion.latest().version, ingestion.latest().forecastVersion) == (1, 0)
+    assert not ingestion.latest().stale
+    assert ingestion.runOnce(forecast=True)
+    assert (ingestion.latest().version, ingestion.latest().forecastVersion) == (2, 1)
+    assert not ingestion.forecastPending
@@ -0,0 +1,206 @@
+"""
+Author: David Jorge
+
+This library keeps the forecast trajectory of every detection across simulation runs, so each run only has to
+advect the detections added since the last one and extend the others when the forecast horizon moves forward.
+
+Trajectories are keyed by detection id (the S3 key of the entry's {Image Start}) and saved as the same CF trajectory
+netcdf file parcels writes, with an extra "detection" variable holding the ids, so output_sim reads it unchanged.
+
+Renderers and exporters read the positions frame by frame through a frameIndex, which buckets the observations of
+such a file by output step once, instead of scanning every observation for every frame.
+"""
+
+import json
+import os
+import numpy as np
+
+
+class trajectoryStore:
+    """
+    Class for storing per detection trajectories, as (time, lat, lon) arrays in time order
+    """
+
+    def __init__(self, path):
+        """
+        Class constructor.
+
+        :param path: netcdf file the trajectories are saved to and loaded from.
+        """
+        self.path = path
+        self.tracks = {}
+        self.fields = None
+        self.load()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __contains__(self, detection):
+        return detection in self.tracks
+
+    def load(self):
+        """
+        Loads the saved trajectories. Files written by plain parcels runs have no detection ids and are ignored.
+        """
+        import xarray as xr
+
+        if not os.path.exists(self.path):
+            return
+        with xr.open_dataset(self.path) as ds:
+            if "detection" not in ds or "fields" not in ds.attrs:
+                return
+            time = ds["time"].values
+            lat = ds["lat"].values
+            lon = ds["lon"].values
+            for row, detection in enumerate(ds["detection"].values):
+                valid = ~np.isnat(time[row])
+                self.tracks[str(detection)] = (time[row][valid], lat[row][valid], lon[row][valid])
+            self.fields = json.loads(ds.attrs["fields"])
+
+    def reset(self, fields):
+        """
+        Drops every trajectory, when the current fields they were computed on changed.
+
+        :param fields: JSON serializable signature of the current fields.
+        """
+        self.tracks = {}
+        self.fields = fields
+
+    def end(self, detection):
+        """
+        :param detection: Detection id.
+        :return: (time, lat, lon) of the last position of the trajectory.
+        """
+        time, lat, lon = self.tracks[detection]
+        return time[-1], lat[-1], lon[-1]
+
+    def extend(self, detection, time, lat, lon):
+        """
+        Appends positions to a trajectory, creating it if needed. Positions not after the current end of the
+        trajectory, such as the release position of an extension, are skipped.
+
+        :param detection: Detection id.
+        :param time: datetime64 array of the new positions.
+        :param lat: Latitude array.
+        :param lon: Longitude array.
+        """
+        if detection in self.tracks:
+            old = self.tracks[detection]
+            new = time > old[0][-1]
+            self.tracks[detection] = (np.concatenate([old[0], time[new]]), np.concatenate([old[1], lat[new]]),
+                                      np.concatenate([old[2], lon[new]]))
+        else:
+            self.tracks[detection] = (time, lat, lon)
+
+    def keep(self, detections):
+        """
+        Drops the trajectories of detections that are no longer simulated.
+
+        :param detections: Iterable of the detection ids to keep.
+        """
+        detections = set(detections)
+        self.tracks = {d: track for d, track in self.tracks.items() if d in detections}
+
+    def save(self, order):
+        """
+        Saves the trajectories as a CF trajectory netcdf file, through a temporary file and a rename.
+
+        :param order: List of the detection ids, in the order their trajectories are written.
+        """
+        import xarray as xr
+
+        order = [d for d in order if d in self.tracks]
+        obs = max((len(self.tracks[d][0]) for d in order), default=0)
+        time = np.full((len(order), obs), np.datetime64("NaT"), dtype="datetime64[ns]")
+        lat = np.full((len(order), obs), np.nan, dtype=np.float32)
+        lon = np.full((len(order), obs), np.nan, dtype=np.float32)
+        for row, d in enumerate(order):
+            t, la, lo = self.tracks[d]
+            time[row, :len(t)] = t
+            lat[row, :len(t)] = la
+            lon[row, :len(t)] = lo
+        trajectory = np.where(np.isnat(time), np.nan, np.arange(len(order))[:, None].astype(np.float64))
+        ds = xr.Dataset({"trajectory": (("traj", "obs"), trajectory), "time": (("traj", "obs"), time),
+                         "lat": (("traj", "obs"), lat), "lon": (("traj", "obs"), lon),
+                         "detection": (("traj",), np.array(order, dtype=object))},
+                        attrs={"feature_type": "trajectory", "Conventions": "CF-1.6/CF-1.7",
+                               "fields": json.dumps(self.fields)})
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        ds.to_netcdf(tmp)
+        os.replace(tmp, self.path)
+
+
+class frameIndex:
+    """
+    Class for looking up the particle positions of each animation frame. Observations are sorted by frame once, with
+    CSR style offsets, so the positions of a frame are a slice of the sorted arrays.
+    """
+
+    def __init__(self, time, lat, lon, step=np.timedelta64(1, 'h'), start=None, end=None):
+        """
+        Class constructor.
+
+        :param time: datetime64 array of the observation times, particle by observation, NaT where there are none.
+        :param lat: Latitude array, same shape as time.
+        :param lon: Longitude array, same shape as time.
+        :param step: timedelta64 between two frames.
+        :param start: datetime64 of the first frame, the first observation of the first particle by default.
+        :param end: datetime64 the frames stop before, the last observation by default.
+        """
+        time = np.asarray(time, dtype="datetime64[ns]")
+        if (start is None or end is None) and not (~np.isnat(time)).any():
+            # No particles or no observations, such as before the first positioned detection: no frames
+            self.times = np.empty(0, dtype="datetime64[ns]")
+            self.lat = np.empty(0, dtype=np.asarray(lat).dtype)
+            self.lon = np.empty(0, dtype=np.asarray(lon).dtype)
+            self.particle = np.empty(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+        start = time[0, 0] if start is None else start
+        end = np.nanmax(time) if end is None else end
+        self.times = np.arange(start, end, step).astype("datetime64[ns]")
+        particle = np.broadcast_to(np.arange(time.shape[0])[:, None], time.shape)
+        valid = ~np.isnat(time)
+        time = time[valid]
+        # Only observations falling exactly on a frame time are shown, as the per frame comparison did
+        offset = time - np.datetime64(start, "ns")
+        frame = offset // step
+        onFrame = (frame >= 0) & (frame < len(self.times)) & (offset % step == np.timedelta64(0))
+        frame = frame[onFrame].astype(np.int64)
+        order = np.argsort(frame, kind="stable")
+        self.lat = np.asarray(lat)[valid][onFrame][order]
+        self.lon = np.asarray(lon)[valid][onFrame][order]
+        self.particle = particle[valid][onFrame][order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(frame, minlength=len(self.times)))])
+
+    @classmethod
+    def load(cls, path, step=np.timedelta64(1, 'h')):
+        """
+        Builds the index of a CF trajectory netcdf file, as written by parcels or a trajectoryStore.
+
+        :param path: netcdf file path.
+        :param step: timedelta64 between two frames.
+        :return: frameIndex.
+        """
+        import xarray as xr
+
+        with xr.open_dataset(str(path), decode_cf=True) as ds:
+            return cls(ds['time'].values, ds['lat'].values, ds['lon'].values, step)
+
+    def __len__(self):
+        return len(self.times)
+
+    def frame(self, t):
+        """
+        :param t: Frame number.
+        :return: (lat array, lon array) of the particles shown in the frame.
+        """
+        frame = slice(self.offsets[t], self.offsets[t + 1])
+        return self.lat[frame], self.lon[frame]
+
+    def particles(self, t):
+        """
+        :param t: Frame number.
+        :return: Array of the row, in the trajectory file, of each particle shown in the frame.
+        """
+        return self.particle[self.offsets[t]:self.offsets[t + 1]]
@@ -0,0 +1,188 @@
+"""
+Author: David Jorge
+
+This library runs the AWS pulls and drift forecasts in a background thread, so the dashboard callbacks only read
+the latest published results and never wait on S3 or a simulation.
+
+When the dashboard is served by several processes (for instance gunicorn workers), one of them is elected by a
+lock file to run the pulls and forecasts. It publishes every version in a manifest file, and the other processes
+follow it by reloading the detection store files added since their last version.
+"""
+
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+# Immutable view of the dashboard data, a new one is published after every pull that found new entries. stale flags
+# data loaded from the previous run that the first background cycle has not refreshed yet. hourlyRevision is the
+# (histogram id, revision) pair hourly was exported at.
+results = namedtuple("results", ["version", "map_data", "hourly", "mostRecent", "forecastVersion", "hourlyRevision",
+                                 "stale"])
+
+
+class ingestionWorker:
+    """
+    Class for owning the pull and forecast cycle of the dashboard
+    """
+
+    def __init__(self, aws, fc, interval=120, days=14, leader=None, manifest=None, poll=5, movie=False):
+        """
+        Class constructor.
+
+        :param aws: pullS3 instance.
+        :param fc: forecasting instance.
+        :param interval: Seconds between the start of two cycles.
+        :param days: Number of days in the future to forecast drift.
+        :param leader: Optional leaderLock shared by the dashboard processes. None runs the cycle unconditionally.
+        :param manifest: Optional manifestFile the versions are shared through.
+        :param poll: Seconds between two manifest checks while another process leads.
+        :param movie: Flags whether to also render the drift movie, assets/sim.mp4, after every forecast. The
+                      dashboard animates the exported forecast itself, the movie is for sharing outside of it.
+        """
+        self.aws = aws
+        self.fc = fc
+        self.interval = interval
+        self.days = days
+        self.leader = leader
+        self.manifest = manifest
+        self.poll = poll
+        self.movie = movie
+        self.leading = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        shared = manifest.load() if manifest else None
+        # Versions carry on from the manifest, so they keep increasing across restarts and leader changes
+        self.published = results(shared["version"] if shared else 0, aws.map_data, aws.hourly, aws.mostRecent,
+                                 shared["forecastVersion"] if shared else 0,
+                                 (aws.histogram.id, aws.histogram.revision), True)
+        self.forecastPending = True
+
+    def latest(self):
+        """
+        :return: The latest published results.
+        """
+        return self.published
+
+    def publish(self, forecastVersion):
+        """
+        Publishes the current data of the pullS3 instance as a new version, and shares it in the manifest.
+
+        :param forecastVersion: Version of the forecast artifacts on disk.
+        """
+        self.published = results(self.published.version + 1, self.aws.map_data, self.aws.hourly,
+                                 self.aws.mostRecent, forecastVersion,
+                                 (self.aws.histogram.id, self.aws.histogram.revision), False)
+        self.share()
+
+    def share(self):
+        """
+        Saves the published versions to the manifest, for the processes that do not lead.
+        """
+        if self.manifest:
+            self.manifest.save({"version": self.published.version, "forecastVersion": self.published.forecastVersion,
+                                "stale": self.published.stale, "forecastPending": self.forecastPending})
+
+    def follow(self):
+        """
+        Publishes the version the leading process last shared, reloading the detection store if the data changed.
+        """
+        shared = self.manifest.load() if self.manifest else None
+        if shared is None:
+            return
+        current = self.published
+        if (shared["version"], shared["forecastVersion"], shared["stale"]) == (current.version,
+                                                                              current.forecastVersion, current.stale):
+            return
+        if shared["version"] != current.version:
+            self.aws.refresh()
+        self.forecastPending = shared["forecastPending"]
+        self.published = results(shared["version"], self.aws.map_data, self.aws.hourly, self.aws.mostRecent,
+                                 shared["forecastVersion"], (self.aws.histogram.id, self.aws.histogram.revision),
+                                 shared["stale"])
+
+    def lead(self):
+        """
+        Tries to become the process that runs the pulls and forecasts. A process taking over from another first
+        catches up with the data, cursor and processed index it left behind. The manifest is flagged stale until
+        the first cycle of the new leader, as it may have been written by the previous run.
+
+        :return: Boolean, whether this process leads.
+        """
+        if self.leading:
+            return True
+        if self.leader is not None:
+            if not self.leader.acquire():
+                return False
+            self.follow()
+            self.aws.refresh()
+            self.aws.resume()
+        self.leading = True
+        self.published = self.published._replace(stale=True)
+        self.share()
+        return True
+
+    def runOnce(self, forecast=False):
+        """
+        Runs one pull and, if new entries were found, one forecast. Single flight: if a cycle is already running
+        this returns immediately instead of starting an overlapping one. New data is published as soon as it is
+        pulled, and published again with the new forecast version once the simulation is exported. The movie, when
+        enabled, is rendered after that, so the dashboard never waits on it.
+
+        :param forecast: Flags whether to run the forecast even if no new entries were found.
+        :return: Boolean, whether the cycle ran.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            new = self.aws.pull()
+            if new or self.published.stale:
+                self.publish(self.published.forecastVersion)
+            if new or forecast:
+                self.fc.update_particles(self.aws.map_data['lat'].tolist(), self.aws.map_data['lon'].tolist(),
+                                         self.aws.map_data['start_key'].tolist())
+                self.fc.run_forecasting(days=self.days)
+                self.fc.export_sim()
+                self.forecastPending = False
+                self.publish(self.published.forecastVersion + 1)
+                if self.movie:
+                    self.fc.output_sim()
+            return True
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """
+        Worker thread loop. Errors are printed and the cycle is retried on the next tick. Until a forecast succeeds it
+        is rerun even without new entries, since the artifacts on disk are from the previous run. Processes that do
+        not lead follow the manifest instead, and try to take over on every check.
+        """
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                if self.lead():
+                    self.runOnce(forecast=self.forecastPending)
+                else:
+                    self.follow()
+            except Exception:
+                traceback.print_exc()
+            interval = self.interval if self.leading else self.poll
+            self.stopped.wait(max(0, interval - (time.monotonic() - started)))
+
+    def start(self):
+        """
+        Starts the worker thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="ingestion-worker", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops the worker thread after its current cycle.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -208,7 +208,8 @@ def imgToChunks(byte_arr, chunk_size=5120):
 
 def mqtt_sendimg(msgs, headers=None):
     """
-    Starts the transmission loop for sending chunks of an image over MQTT.
+    Starts the transmission loop for sending chunks of an image over MQTT. Each chunk is prefixed with its byte
+    offset in the image, so AWS can drop a chunk the broker delivers twice.
 
     :param msgs: List of hex strings representing compressed image.
     :param headers: Relevant metadata to be sent to AWS.
@@ -219,8 +220,10 @@ def mqtt_sendimg(msgs, headers=None):
             header += "," + str(metadata)
     header += "}"
     mqtt_pub(header)
+    offset = 0
     for msg in msgs:
-        mqtt_pub(payload=binascii.hexlify(msg), raw=True)
+        mqtt_pub(payload=str(offset).encode() + b":" + binascii.hexlify(msg), raw=True)
+        offset += len(msg)
     mqtt_pub("{Image End}")
 
 